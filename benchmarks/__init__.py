@@ -0,0 +1 @@
+"""Benchmarks for castnet, run from the repository root with python -m"""
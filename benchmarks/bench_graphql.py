@@ -0,0 +1,141 @@
+"""
+Benchmark the GraphQL compilers (see CastNetConn graphql_compiler) on db hits
+and time, reading a generated House/Feeder/Scan/Bird graph.
+
+python -m benchmarks.bench_graphql
+python -m benchmarks.bench_graphql --houses 200 --out before.json
+
+Runs offline against the in-memory stand-in; db_hits also profiles queries on
+a Neo4j server.
+"""
+import argparse
+import sys
+
+from castnet import GRAPHQL_COMPILERS, CastNetConn
+from castnet.memory import MEMORY_SCHEME, drop_server
+from benchmarks import harness
+
+SUITE = "graphql"
+URI = MEMORY_SCHEME + "bench_graphql"
+SCHEMA = {
+    "Bird": {"attributes": {"species": str}},
+    "House": {"attributes": {"owner": str}},
+    "Feeder": {
+        "IS_IN": "House",
+        "attributes": {"height": int},
+        "relationships": {"BIRDS_OBSERVED": ["Bird"]},
+        "graphql": {"birds": {"rel": "BIRDS_OBSERVED", "dir": "OUT", "lab": "Bird"}},
+    },
+    "Scan": {"IS_IN": "Feeder", "attributes": {"quality": float}},
+}
+QUERIES = {
+    "flat": "{ House { id name owner } }",
+    "nested": "{ House { name descendantFeeder { name height descendantScan { name quality } } } }",
+    "ordered": "{ Feeder { name birds { name species __order } } }",
+    "hops": "{ House { name descendantScan { name quality } } }",
+    "filtered": "{ House { name descendantFeeder(height: 1) { name isIn { owner } } } }",
+    "top_level": "{ House { name } Feeder { height } Scan { quality } Bird { species } }",
+}
+
+
+def seed(conn, houses=50, feeders=4, scans=5, birds=20):
+    """Creates houses with feeders, scans and observed birds in a few writes"""
+    conn.write(
+        "UNWIND range(1, $birds) AS b CREATE (:Bird {id: 'Bird' + b, name: 'bird' + b, species: 'sp' + (b % 5)})",
+        birds=birds,
+    )
+    conn.write(
+        "UNWIND range(1, $houses) AS h\n"
+        "CREATE (house:House {id: 'House' + h, name: 'house' + h, owner: 'owner' + h})\n"
+        "WITH house, h UNWIND range(1, $feeders) AS f\n"
+        "CREATE (feeder:Feeder {id: 'Feeder' + h + '_' + f, name: 'feeder' + f, height: f % 3})"
+        "-[:IS_IN]->(house)\n"
+        "WITH feeder, h, f UNWIND range(1, $scans) AS s\n"
+        "CREATE (:Scan {id: 'Scan' + h + '_' + f + '_' + s, name: 'scan' + s, quality: s / 10.0})"
+        "-[:IS_IN]->(feeder)",
+        houses=houses,
+        feeders=feeders,
+        scans=scans,
+    )
+    conn.write(
+        "MATCH (feeder:Feeder), (bird:Bird) WHERE toInteger(substring(bird.id, 4)) % 5 = feeder.height\n"
+        "CREATE (feeder)-[:BIRDS_OBSERVED {order_num: toInteger(substring(bird.id, 4))}]->(bird)"
+    )
+
+
+def _profile_hits(profile):
+    """Sums the db hits of a profiled plan"""
+    if not profile:
+        return 0
+    return profile.get("dbHits", 0) + sum(
+        _profile_hits(child) for child in profile.get("children", [])
+    )
+
+
+def db_hits(conn, cypher, **params):
+    """The db hits of a read, PROFILEd on a server"""
+    with conn._get_driver().session() as session:  # pylint: disable=protected-access
+        if conn.uri.startswith(MEMORY_SCHEME):
+            return session.run(cypher, **params).consume().db_hits
+        return _profile_hits(session.run("PROFILE " + cypher, **params).consume().profile)
+
+
+def run(houses=50, min_time=0.2, repeat=5, match=None):
+    """Returns the timing and db hits of every query with every compiler, by name"""
+    drop_server("bench_graphql")
+    seed(CastNetConn(URI, None, None, SCHEMA, {}))
+    results = {}
+    for compiler in GRAPHQL_COMPILERS:
+        conn = CastNetConn(URI, None, None, SCHEMA, {}, graphql_compiler=compiler)
+        for name, query in QUERIES.items():
+            bench = f"read_graphql[{name},{compiler}]"
+            if match and match not in bench:
+                continue
+            results[bench] = harness.measure(lambda q=query: conn.read_graphql(q), min_time, repeat)
+            results[bench]["db_hits"] = db_hits(conn, conn.gql_to_cypher(query))
+        conn.close()
+    drop_server("bench_graphql")
+    return results
+
+
+def report_hits(results):
+    """Prints the db hits of each query per compiler"""
+    queries = sorted({name.split("[")[1].split(",")[0] for name in results})
+    width = max((len(query) for query in queries), default=0)
+    print(f"{'db hits':<{width}}  " + "  ".join(f"{c:>10}" for c in GRAPHQL_COMPILERS))
+    for query in queries:
+        hits = [
+            results.get(f"read_graphql[{query},{compiler}]", {}).get("db_hits", "")
+            for compiler in GRAPHQL_COMPILERS
+        ]
+        print(f"{query:<{width}}  " + "  ".join(f"{h:>10}" for h in hits))
+
+
+def main(argv=None):
+    """Runs the suite, saves it and compares it to a baseline"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--houses", type=int, default=50, help="houses in the generated graph")
+    parser.add_argument("--out", help="json file for the results (default bench_results/)")
+    parser.add_argument("--compare", help="json file of an earlier run to compare against")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1, help="relative change reported as slower/faster"
+    )
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per benchmark")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--match", help="only run benchmarks whose name contains this")
+    args = parser.parse_args(argv)
+
+    results = run(args.houses, args.min_time, args.repeat, args.match)
+    out = args.out or harness.default_path(SUITE)
+    harness.save(out, SUITE, results)
+    rows = None
+    if args.compare:
+        rows = harness.compare(harness.load(args.compare)["results"], results, args.threshold)
+    harness.report(results, rows)
+    report_hits(results)
+    print(f"saved to {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
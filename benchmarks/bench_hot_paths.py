@@ -0,0 +1,205 @@
+"""
+Benchmark the functions on castnet's request path, over generated schemas and
+queries, and save the results as json.
+
+python -m benchmarks.bench_hot_paths
+python -m benchmarks.bench_hot_paths --out before.json
+python -m benchmarks.bench_hot_paths --compare before.json --fail-above 0.2
+
+Runs offline, no database is needed.
+"""
+import argparse
+import json
+import pickle
+import sys
+from datetime import date, datetime
+
+from neo4j import time as neo4j_time
+
+from castnet import CastNetConn, compile_schema, convert_datetime, encoding, gen_id
+from benchmarks import harness
+
+SUITE = "hot_paths"
+SCHEMA_SIZES = [10, 100, 1000]
+QUERY_SHAPES = [(1, 2), (2, 4), (4, 4), (4, 16), (8, 8)]
+ATTRIBUTE_TYPES = [str, int, float, date, datetime]
+ROW_COUNTS = [10000, 100000]
+
+
+def make_schema(labels, attributes=8, branching=4):
+    """
+    A schema of labels Label0..LabelN. Labels form an IS_IN tree with the given
+    branching, and each links to the next label, so queries of any depth exist.
+    """
+    schema = {}
+    for i in range(labels):
+        spec = {
+            "attributes": {
+                f"attr{j}": ATTRIBUTE_TYPES[j % len(ATTRIBUTE_TYPES)]
+                for j in range(attributes)
+            },
+            "relationships": {
+                "LINKS": [f"Label{(i + 1) % labels}"],
+                "OWNED_BY": f"Label{(i + 2) % labels}",
+            },
+            "graphql": {
+                "linked": {"rel": "LINKS", "dir": "OUT", "lab": f"Label{(i + 1) % labels}"}
+            },
+        }
+        if i:
+            spec["IS_IN"] = f"Label{(i - 1) // branching}"
+        schema[f"Label{i}"] = spec
+    return schema
+
+
+def make_query(depth, width):
+    """
+    A GraphQL query following linked depth times from Label0, selecting width
+    attributes at every level
+    """
+    fields = " ".join(["name", "id"] + [f"attr{j % 8}" for j in range(width - 2)])
+    query = fields
+    for _ in range(depth):
+        query = f"{fields} linked {{ {query} }}"
+    return f'query {{ Label0(name: "feeder") {{ {query} }} }}'
+
+
+def make_params(with_relationships=True):
+    """A POST body for Label1, a parent of Label5"""
+    params = {
+        "name": "Feeder #1: back yard",
+        "IS_IN": "Label0__20220101__root__abcdefgh",
+        "attr0": "text",
+        "attr1": "42",
+        "attr2": "4.2",
+        "attr3": "2022-01-01",
+        "attr4": "2022-01-01T10:00:00",
+    }
+    if with_relationships:
+        params["LINKS"] = [f"Label2__20220101__n{i}__abcdefgh" for i in range(4)]
+        params["OWNED_BY"] = "Label3__20220101__owner__abcdefgh"
+    return params
+
+
+def make_rows(count):
+    """
+    A read_graphql response of count feeders, each with a few nested scans and
+    native temporal values, as the driver returns them
+    """
+    installed = neo4j_time.DateTime(2022, 1, 1, 10, 30, 0)
+    return [
+        {
+            "id": f"Feeder__20220101__feeder{i}__abcdefgh",
+            "name": f"feeder{i}",
+            "height": i % 7,
+            "installed": installed,
+            "built": neo4j_time.Date(2021, 1, 1 + i % 28),
+            "descendantScan": [{"name": f"scan{j}", "scanned": installed} for j in range(3)],
+        }
+        for i in range(count)
+    ]
+
+
+def benchmarks(sizes=None, shapes=None, row_counts=None):
+    """Yields (name, func) for every benchmark"""
+    sizes = sizes or SCHEMA_SIZES
+    shapes = shapes or QUERY_SHAPES
+    row_counts = row_counts or ROW_COUNTS
+    for size in sizes:
+        schema = make_schema(size)
+        yield f"_parse_schema[labels={size}]", lambda s=schema: CastNetConn._parse_schema(s)
+        # a worker's cold start, parsing the schema or loading a compiled one
+        snapshot = pickle.dumps(compile_schema(schema))
+        yield f"compile_schema[labels={size}]", lambda s=schema: compile_schema(s)
+        yield f"load_schema[labels={size}]", lambda b=snapshot: pickle.loads(b)
+
+    conn = CastNetConn(None, None, None, make_schema(max(sizes)), {})
+    for depth, width in shapes:
+        query = make_query(depth, width)
+        stripped = conn._strip_query(query)
+        ast = conn._gql_to_ast(stripped)
+        shape = f"depth={depth},width={width}"
+        yield f"_next_token[{shape}]", lambda q=stripped: list(conn._next_token(q))
+        yield f"_gql_to_ast[{shape}]", lambda q=stripped: conn._gql_to_ast(q)
+        yield f"_ast_to_cypher[{shape}]", lambda a=ast: conn._ast_to_cypher(a)
+        yield f"gql_to_cypher[{shape}]", lambda q=query: conn.gql_to_cypher(q)
+
+    for relationships in [False, True]:
+        params = make_params(relationships)
+        params.pop("IS_IN")
+        kind = "relationships" if relationships else "attributes"
+        yield f"parse_params[{kind}]", lambda p=params: conn.parse_params("Label1", p)
+        for method in ["POST", "PATCH"]:
+            body = dict(params)
+            if method == "PATCH":
+                body.pop("name")
+            yield (
+                f"request_to_cypher[{method},{kind}]",
+                lambda b=body, m=method: conn.request_to_cypher(
+                    "Label1", "Label1__20220101__x__abcdefgh", dict(b), m
+                ),
+            )
+
+    yield "gen_id", lambda: gen_id("Feeder", "Feeder #1: back yard")
+    for value in ["1/2/22 10:30", "01/02/2022 10:30", "01/02/2022", "2022-01-02"]:
+        yield f"convert_datetime[{value}]", lambda v=value: convert_datetime(v)
+
+    # pylint: disable=protected-access
+    for count in row_counts:
+        response = {"data": {"Feeder": make_rows(count)}}
+        yield f"to_python[rows={count}]", lambda r=response: encoding.to_python(r)
+        yield f"encode[rows={count}]", lambda r=response: encoding.encode(r)
+        yield (
+            f"json.dumps[rows={count}]",
+            lambda r=response: json.dumps(r, default=encoding._convert),
+        )
+
+
+def run(min_time=0.2, repeat=5, sizes=None, shapes=None, match=None, row_counts=None):
+    """Returns the timing of every benchmark, by name"""
+    results = {}
+    for name, func in benchmarks(sizes, shapes, row_counts):
+        if match and match not in name:
+            continue
+        results[name] = harness.measure(func, min_time, repeat)
+    return results
+
+
+def main(argv=None):
+    """Runs the suite, saves it and compares it to a baseline"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--out", help="json file for the results (default bench_results/)")
+    parser.add_argument("--compare", help="json file of an earlier run to compare against")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1, help="relative change reported as slower/faster"
+    )
+    parser.add_argument(
+        "--fail-above", type=float, help="exit with 1 if anything slows down by more than this"
+    )
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per benchmark")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--match", help="only run benchmarks whose name contains this")
+    parser.add_argument("--quick", action="store_true", help="small schemas and short runs")
+    args = parser.parse_args(argv)
+
+    sizes, shapes, row_counts, min_time = None, None, None, args.min_time
+    if args.quick:
+        sizes, shapes, row_counts, min_time = [10, 100], QUERY_SHAPES[:3], [10000], 0.02
+    results = run(min_time, args.repeat, sizes, shapes, args.match, row_counts)
+    out = args.out or harness.default_path(SUITE)
+    harness.save(out, SUITE, results)
+
+    if not args.compare:
+        harness.report(results)
+        print(f"saved to {out}")
+        return 0
+    rows = harness.compare(harness.load(args.compare)["results"], results, args.threshold)
+    harness.report(results, rows)
+    print(f"saved to {out}")
+    if args.fail_above is not None and any(row[3] > 1 + args.fail_above for row in rows):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+"""
+Benchmark id generation throughput.
+
+python -m benchmarks.bench_ids --count 1000000
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+
+import pytz
+import shortuuid
+
+from castnet import IdGenerator, gen_id
+
+
+def legacy_gen_id(label, name):
+    """gen_id as it was before IdGenerator, for comparison"""
+    name = str(name)
+    uuid = shortuuid.ShortUUID().random(length=8)
+    disallowed = '\\\n\t/_*?"<>|.: #&+'
+    for character in disallowed:
+        name = name.replace(character, "")
+    datestr = datetime.now(tz=pytz.timezone("US/Eastern")).strftime("%Y%m%d")
+    return f"{label}__{datestr}__{name}__{uuid}"
+
+
+def timed(func, count):
+    """Runs func and returns ids per second"""
+    start = time.perf_counter()
+    func()
+    return count / (time.perf_counter() - start)
+
+
+def run(count):
+    """Returns ids/sec for each way of generating count ids"""
+    names = [f"Feeder #{i}: Back yard" for i in range(count)]
+    generator = IdGenerator()
+    return {
+        "count": count,
+        "legacy_gen_id": timed(lambda: [legacy_gen_id("Feeder", n) for n in names], count),
+        "gen_id": timed(lambda: [gen_id("Feeder", n) for n in names], count),
+        "IdGenerator.gen_ids": timed(lambda: generator.gen_ids("Feeder", names), count),
+    }
+
+
+def main():
+    """Prints the benchmark as json"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=1_000_000)
+    args = parser.parse_args()
+    results = run(args.count)
+    print(json.dumps({k: round(v) for k, v in results.items()}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Timing, saving and comparing of benchmark results.
+
+Results are saved as json, so runs on different commits can be compared:
+
+python -m benchmarks.bench_hot_paths --out before.json
+git checkout other-branch
+python -m benchmarks.bench_hot_paths --compare before.json
+"""
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import castnet
+
+RESULTS_DIR = "bench_results"
+
+
+def measure(func, min_time=0.2, repeat=5):
+    """
+    Times func(), calibrating the number of calls per round so a round takes
+    at least min_time / repeat seconds. Returns seconds per call.
+    """
+    number = 1
+    round_time = min_time / repeat
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= round_time or number >= 1_000_000:
+            break
+        number *= 10 if elapsed < round_time / 10 else 2
+    timings = [elapsed / number]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - started) / number)
+    return {
+        "best_us": min(timings) * 1e6,
+        "median_us": statistics.median(timings) * 1e6,
+        "calls": number * repeat,
+    }
+
+
+def git_commit():
+    """The current commit, or None outside a git checkout"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata():
+    """Where and when the benchmark ran"""
+    return {
+        "commit": git_commit(),
+        "castnet": castnet.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": datetime.now().isoformat(),
+    }
+
+
+def default_path(suite):
+    """bench_results/<suite>-<commit>.json"""
+    return os.path.join(RESULTS_DIR, f"{suite}-{git_commit() or 'local'}.json")
+
+
+def save(path, suite, results):
+    """Saves results with metadata as json"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as handle:
+        json.dump({"suite": suite, "meta": metadata(), "results": results}, handle, indent=2)
+
+
+def load(path):
+    """Loads results saved by save"""
+    with open(path, "r", encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def compare(baseline, results, threshold=0.1, key="best_us"):
+    """
+    Compares results to a baseline, returns rows of
+    (name, baseline, current, ratio, flag) where flag is "slower", "faster" or ""
+    """
+    rows = []
+    for name, current in results.items():
+        if name not in baseline or not baseline[name].get(key):
+            continue
+        ratio = current[key] / baseline[name][key]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "slower"
+        elif ratio < 1 - threshold:
+            flag = "faster"
+        rows.append((name, baseline[name][key], current[key], ratio, flag))
+    return rows
+
+
+def report(results, rows=None, out=sys.stdout):
+    """Prints results, and the comparison if given"""
+    if rows is None:
+        width = max((len(name) for name in results), default=0)
+        for name, result in results.items():
+            print(f"{name:<{width}}  {result['best_us']:>12.2f} us", file=out)
+        return
+    width = max((len(row[0]) for row in rows), default=0)
+    for name, before, after, ratio, flag in rows:
+        print(
+            f"{name:<{width}}  {before:>12.2f} us  {after:>12.2f} us  {ratio:>6.2f}x  {flag}",
+            file=out,
+        )
@@ -1,30 +1,171 @@
-from datetime import datetime, date
-from neo4j import GraphDatabase
+from datetime import datetime, date, timedelta
+import base64
+import hashlib
+import itertools
 import json
-import pytz
-import shortuuid
+import re
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# the driver, pytz and shortuuid are imported on first use, which keeps
+# importing castnet (a worker's cold start) fast
+from castnet.callbacks import CALLBACK_MODES, CallbackDispatcher
+from castnet.casting import to_temporal
+from castnet.encoding import encode as encode_json, to_python
+from castnet.history import history_record, make_history_sink
+from castnet.loader import NodeLoader
+from castnet.schema import CompiledSchema, LabelSpec
+from castnet.views import NodeViewStore, View, encode, make_view_store
 
 
 __version__ = "0.1.2"
 
+MEMORY_SCHEME = "memory://"
+
+PURGE_HISTORY = ["keep", "summarize", "delete"]
+# archived nodes (n) whose DELETE historyRecord is older than $older_than
+ARCHIVED_BEFORE = (
+    "EXISTS { MATCH (n)<-[:RESOURCE_ID]-(d:historyRecord {method: \"DELETE\"})"
+    " WHERE d.timeStamp < $older_than }"
+)
+GRAPHQL_LAYOUTS = ["objects", "rows", "columns"]
+GRAPHQL_COMPILERS = ["subquery", "projection"]
+QUERY_LIMITS = ["timeout", "max_rows"]
+# parameter of the LIMIT on the top level nodes of a GraphQL field, max_rows + 1
+MAX_ROWS_PARAM = "castnet_max_rows"
+TEMPORAL_MODES = ["string", "native"]
+# a key: value pair of a GraphQL condition, values are strings, $variables or literals
+CONDITION_PAIR = re.compile(r"""(\w+)\s*:\s*("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|[^,]+)""")
+ENDPOINTS = ["post", "patch", "delete", "graphql"]
+IDEMPOTENCY_LABEL = "_Idempotency"
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+
+class ResultTooLarge(Exception):
+    """A read returned more rows than its max_rows"""
+
+    def __init__(self, max_rows):
+        super().__init__(f"The result has more than {max_rows} rows.")
+        self.max_rows = max_rows
+
+
+def is_timeout(err):
+    """Whether an error is a transaction timing out"""
+    from neo4j.exceptions import Neo4jError  # pylint: disable=import-outside-toplevel
+
+    return isinstance(err, Neo4jError) and "TransactionTimedOut" in (err.code or "")
+
 
 class CastNetConn:
     """
     CastNetConn is a class which handles a connection to a database.
     """
 
-    def __init__(self, uri, user, password, schema, url_key, eager=False):
+    def __init__(
+        self,
+        uri,
+        user,
+        password,
+        schema,
+        url_key,
+        eager=False,
+        history="inline",
+        history_options=None,
+        callback_options=None,
+        loader_options=None,
+        temporal="string",
+        graphql_workers=0,
+        graphql_compiler="subquery",
+        limits=None,
+        idempotency_ttl=timedelta(days=1),
+    ):
         """
         Connects to a database
+        schema: the schema, or a compiled schema (see castnet.schema), which
+            is used as is and caches the Cypher the connection generates
+        history: "inline" creates historyRecords in the same query as the write,
+            "batched" queues them and writes them in batches on a background
+            thread, "file" appends them to a local file. A HistorySink can also
+            be passed. history_options are passed to the sink.
+        callback_options: pool sizes for background callbacks, e.g.
+            {"thread_workers": 4, "process_workers": 2}
+        loader_options: batching of load_node/load_nodes, e.g.
+            {"window": 0.002, "max_batch": 1000}
+        temporal: "string" stores date and datetime attributes as ISO strings,
+            "native" as Neo4j dates and datetimes (comparable in the database
+            and range indexed, see migrate_temporal). Responses carry ISO
+            strings either way.
+        graphql_workers: run the top level fields of GraphQL queries at the
+            same time, each in its own session, on a pool of this many threads.
+            0 runs them one after another in a single statement.
+        graphql_compiler: "subquery" compiles every level of a GraphQL query
+            to a MATCH, UNWIND and CALL subquery, "projection" to map
+            projections and pattern comprehensions, with fewer rows and db hits.
+            Both return the same results.
+        limits: transaction timeouts (seconds) and result sizes of the generic_*
+            endpoints, overridden per endpoint and by a label's schema "limits":
+            {"timeout": 10, "max_rows": 10000, "endpoints": {"graphql": {"timeout": 60}}}
+            Timeouts return 504, results over max_rows 413.
+        idempotency_ttl: how long generic_post remembers idempotency keys,
+            purge_idempotency_keys forgets keys older than this.
         """
+        if temporal not in TEMPORAL_MODES:
+            raise ValueError(f"temporal must be one of {TEMPORAL_MODES}")
+        if graphql_compiler not in GRAPHQL_COMPILERS:
+            raise ValueError(f"graphql_compiler must be one of {GRAPHQL_COMPILERS}")
         self.driver = None
-        if uri and user and password and eager:
-            self.driver = GraphDatabase.driver(uri, auth=(user, password))
+        self._driver_lock = threading.Lock()
         self.uri = uri
         self.user = user
         self.password = password
-        self.schema = self._parse_schema(schema)
+        if uri and eager and (user and password or uri.startswith(MEMORY_SCHEME)):
+            self.driver = self._connect()
+        self.schema = schema if isinstance(schema, CompiledSchema) else compile_schema(schema)
         self.url_key = url_key
+        self.history = make_history_sink(self, history, history_options)
+        self.callbacks = CallbackDispatcher(**(callback_options or {}))
+        self.loader = NodeLoader(self, **(loader_options or {}))
+        self.views = {}
+        self.temporal = temporal
+        self.graphql_workers = graphql_workers
+        self.graphql_compiler = graphql_compiler
+        self.limits = self._parse_limits(limits or {})
+        self.idempotency_ttl = idempotency_ttl
+        self._graphql_pool = None
+
+    def _connect(self):
+        """
+        Creates a driver, memory:// uris connect to an in-memory stand-in (see
+        castnet.memory)
+        """
+        # pylint: disable=import-outside-toplevel
+        if self.uri.startswith(MEMORY_SCHEME):
+            from castnet.memory import memory_driver
+
+            return memory_driver(self.uri)
+        from neo4j import GraphDatabase
+
+        return GraphDatabase.driver(self.uri, auth=(self.user, self.password))
+
+    def _get_driver(self):
+        """
+        The driver every thread shares, connected on first use. It's never
+        replaced after a failed query, other threads may be using it, the
+        driver recovers its own connections.
+        """
+        if self.driver is None:
+            with self._driver_lock:
+                if self.driver is None:
+                    self.driver = self._connect()
+        return self.driver
+
+    def _response(self, value):
+        """Converts native temporal values read from the database to ISO strings"""
+        if self.temporal == "native":
+            return to_python(value)
+        return value
 
     @staticmethod
     def _parse_schema(schema):
@@ -51,6 +192,14 @@ class CastNetConn:
                 temp_callbacks = schema[key]["callbacks"]
             new_schema[key]["callbacks"] = temp_callbacks
 
+            # build limits
+            new_schema[key]["limits"] = CastNetConn._parse_limits(
+                schema[key].get("limits", {}), key
+            )
+
+            # the database holding the label, None for the default database
+            new_schema[key]["database"] = schema[key].get("database")
+
             # build graphql
             temp_dict = {}
             if "graphql" in schema[key]:
@@ -68,6 +217,25 @@ class CastNetConn:
 
             new_schema[key]["graphql"] = temp_dict
 
+        # add ancestor<Label> and descendant<Label> fields along the IS_IN hierarchy,
+        # each a single traversal of as many IS_IN hops as the labels are apart
+        for key in new_schema:
+            parent = new_schema[key]["relationships"].get("IS_IN")
+            hops = 1
+            seen = {key}
+            while parent in new_schema and parent not in seen:
+                seen.add(parent)
+                new_schema[key]["graphql"].setdefault(
+                    "ancestor" + parent,
+                    {"rel": "IS_IN", "dir": "OUT", "lab": parent, "hops": str(hops)},
+                )
+                new_schema[parent]["graphql"].setdefault(
+                    "descendant" + key,
+                    {"rel": "IS_IN", "dir": "IN", "lab": key, "hops": str(hops)},
+                )
+                parent = new_schema[parent]["relationships"].get("IS_IN")
+                hops += 1
+
         # do some checks
         for key, current in new_schema.items():
             # make sure all graphql things point to something
@@ -81,8 +249,96 @@ class CastNetConn:
 
                 if rel not in new_schema[check_label]["relationships"].keys():
                     raise Exception(f"Relationship {rel} not found in {lab}")
+            # make sure relationships stay within a database
+            for rel, targets in current["relationships"].items():
+                for target in [targets] if isinstance(targets, str) else targets:
+                    if target in new_schema and new_schema[target]["database"] != current["database"]:
+                        raise Exception(
+                            f"Relationship {rel} of {key} points to {target} in another database"
+                        )
+            # make sure callbacks run somewhere we know about
+            for callback in current["callbacks"]:
+                if callback.get("mode", "sync") not in CALLBACK_MODES:
+                    raise Exception(
+                        f"Callback mode for {key} must be one of {CALLBACK_MODES}"
+                    )
         return new_schema
 
+    @staticmethod
+    def _parse_limits(limits, label=None):
+        """Checks limits only hold known limits (and endpoints, for the connection)"""
+        where = f" in the limits of {label}" if label else " in limits"
+        for key, value in limits.items():
+            if key == "endpoints" and label is None:
+                for endpoint, endpoint_limits in value.items():
+                    if endpoint not in ENDPOINTS:
+                        raise ValueError(f"Endpoint {endpoint} must be one of {ENDPOINTS}")
+                    CastNetConn._parse_limits(endpoint_limits, endpoint)
+            elif key not in QUERY_LIMITS:
+                raise ValueError(f"Unknown limit {key}{where}, must be one of {QUERY_LIMITS}")
+        return limits
+
+    def database_of(self, labels):
+        """
+        The database holding labels (see the schema's "database"), None for the
+        default database. Raises ValueError if they are in different databases.
+        """
+        databases = {self.schema[label]["database"] for label in labels if label in self.schema}
+        if len(databases) > 1:
+            raise ValueError(f"The labels {sorted(labels)} are in different databases.")
+        return databases.pop() if databases else None
+
+    def _endpoint_options(self, endpoint, label):
+        """The limits and database of an endpoint's queries on a label"""
+        return dict(self.query_limits(endpoint, [label]), database=self.database_of([label]))
+
+    def query_limits(self, endpoint=None, labels=()):
+        """
+        The limits of a generic_* endpoint's queries: the connection's, then
+        the endpoint's, then the labels' (the most permissive of them).
+        Returns {"tx_timeout": seconds, "max_rows": rows}, None for no limit.
+        """
+        limits = {key: self.limits.get(key) for key in QUERY_LIMITS}
+        limits.update(self.limits.get("endpoints", {}).get(endpoint, {}))
+        for key in QUERY_LIMITS:
+            label_values = [self.schema[label]["limits"].get(key, limits[key]) for label in labels]
+            if label_values:
+                limits[key] = None if None in label_values else max(label_values)
+        return {"tx_timeout": limits["timeout"], "max_rows": limits["max_rows"]}
+
+    @staticmethod
+    def _error_response(err):
+        """The data and HTTP status of an error in a generic_* endpoint"""
+        if isinstance(err, ResultTooLarge):
+            return (str(err), 413)
+        if is_timeout(err):
+            return (f"The query timed out: {err.message}", 504)
+        return (f"There was an error: {err}", 400)
+
+    def _work(self, tx_timeout=None, max_rows=None):
+        """
+        The transaction function of read and write, with a timeout and a
+        maximum of rows after which it stops reading and raises ResultTooLarge
+        """
+        if tx_timeout is None and max_rows is None:
+            return self._submit_query
+
+        def work(tx, query, **kwargs):
+            if max_rows is None:
+                return list(tx.run(query, **kwargs))
+            records = []
+            for record in tx.run(query, **kwargs):
+                if len(records) >= max_rows:
+                    raise ResultTooLarge(max_rows)
+                records.append(record)
+            return records
+
+        if tx_timeout is not None:
+            from neo4j import unit_of_work  # pylint: disable=import-outside-toplevel
+
+            work = unit_of_work(timeout=tx_timeout)(work)
+        return work
+
     @staticmethod
     def _submit_query(tx, query, **kwargs):
         """
@@ -102,24 +358,44 @@ class CastNetConn:
         if not params:
             params = {}
         target_ids, clean_params = self.parse_params(label, params)
+        # the query only depends on which params and relationships are set
+        shape = (
+            label,
+            method,
+            tuple(clean_params),
+            tuple((conn_name, target_id in ["", None, []]) for conn_name, target_id in target_ids),
+        )
+        query = self.schema.cached("writes", shape, lambda: self._write_cypher(*shape))
 
+        cypher_vars = clean_params
+        if method == "PATCH":
+            cypher_vars["source_id"] = source_id
+        if method == "POST":
+            cypher_vars["source_id"] = gen_id(label, clean_params["name"])
+        for i, (conn_name, target_id) in enumerate(target_ids):
+            cypher_vars.setdefault(conn_name, []).append(target_id)
+            if target_id not in ["", None, []]:
+                cypher_vars[f"target_{i}_id"] = target_id
+        return query, cypher_vars
+
+    def _write_cypher(self, label, method, keys, targets):
+        """
+        Builds the query of request_to_cypher
+        keys: the names of the params set
+        targets: (relationship, whether the target is empty) of each target
+        """
         # generate source identifying information
         source_matches = []
         create_source_block = ""
-        cypher_vars = clean_params
         source_set_block = ""
         if method == "PATCH":
-            source_set_block += ",\n".join(
-                [f"source.{key}=${key}" for key in clean_params]
-            )
-            cypher_vars.update({"source_id": source_id})
+            source_set_block += ",\n".join([f"source.{key}=${key}" for key in keys])
             source_matches.append("(source:%s {id: $source_id})" % label)
         if method == "POST":
             create_source_block += (
                 f"(source:{label} {{id: $source_id"
-                f"{''.join([f', {p}:${p}' for p in clean_params])}}})"
+                f"{''.join([f', {p}:${p}' for p in keys])}}})"
             )
-            cypher_vars["source_id"] = gen_id(label, clean_params["name"])
 
         # generate target identifying information
         target_matches = []
@@ -127,10 +403,7 @@ class CastNetConn:
         d_t_deletes = []
         create_target = []
         rels_to_delete = set()
-        for i, (conn_name, target_id) in enumerate(target_ids):
-            if conn_name not in cypher_vars:
-                cypher_vars[conn_name] = []
-            cypher_vars[conn_name].append(target_id)
+        for i, (conn_name, empty) in enumerate(targets):
             n_target_var = f"target_{i}"
             tlabel = self.schema[label]["relationships"][conn_name]
             if isinstance(tlabel, list):
@@ -146,9 +419,8 @@ class CastNetConn:
                     rels_to_delete.add(conn_name)
 
             # if target is empty, don't create a new relationship
-            if target_id in ["", None, []]:
+            if empty:
                 continue
-            cypher_vars[n_target_var + "_id"] = target_id
             target_matches.append(
                 f"({n_target_var}:{tlabel} {{id: ${n_target_var}_id}})"
             )
@@ -163,7 +435,7 @@ class CastNetConn:
         create_target_block = ",\n".join(create_target)
 
         # Create query
-        query = (
+        return (
             (("MATCH\n" + source_match_block + "\n") if source_match_block else "")
             + (("WITH source\n" + d_t_match_block + "\n") if d_t_match_block else "")
             + (
@@ -177,8 +449,6 @@ class CastNetConn:
             + (("SET\n" + source_set_block + "\n") if source_set_block else "")
             + "RETURN\nsource"
         )
-        # build params
-        return query, cypher_vars
 
     @staticmethod
     def delete_cypher(label, source_id):  # pylint: disable-msg=too-many-locals
@@ -201,6 +471,14 @@ class CastNetConn:
         Todo: This should some day be atomic with generic_delete, can generate race conditions
         """
         resource_label = self.url_key[resource_type]
+        return self.schema.cached(
+            "writes",
+            ("dependencies", resource_label),
+            lambda: self._dependencies_cypher(resource_label),
+        )
+
+    def _dependencies_cypher(self, resource_label):
+        """Builds the query of _check_dependencies"""
         dep_labels = []  # eg. Project, SampleSet
         for label in self.schema:
             if "IS_IN" in self.schema[label]["relationships"]:
@@ -229,114 +507,1149 @@ class CastNetConn:
 
     def close(self):
         """
-        Closes a database
+        Closes a database, after draining background callbacks and flushing
+        queued history records
         """
+        self.callbacks.close()
+        self.loader.close()
+        if self._graphql_pool:
+            self._graphql_pool.shutdown(wait=True)
+        if self.history:
+            self.history.close()
         try:
             self.driver.close()
         except Exception:
             pass
 
-    def read(self, query, max_retries=3, **kwargs):
+    def history_metrics(self):
+        """Counters of the history sink, e.g. its queue depth"""
+        if self.history:
+            return self.history.metrics()
+        return {"queue_depth": 0}
+
+    def callback_metrics(self):
+        """Latency and failure counters of each callback, by name"""
+        return self.callbacks.metrics()
+
+    def loader_metrics(self):
+        """Counters of load_node/load_nodes batching"""
+        return self.loader.metrics()
+
+    def _run_callbacks(self, label, method, params):
         """
-        Reads from a Cypher query
+        Runs the label's callbacks for a method. POST and PATCH callbacks only
+        run if one of their attributes or relationships was part of the request.
         """
-        if not self.driver:
-            self.driver = GraphDatabase.driver(
-                self.uri, auth=(self.user, self.password)
-            )
+        for callback in self.schema[label]["callbacks"]:
+            if method not in callback["methods"]:
+                continue
+            if method != "DELETE" and not (
+                (
+                    "attributes" in callback
+                    and set(params.keys()).intersection(set(callback["attributes"]))
+                )
+                or (
+                    "relationships" in callback
+                    and set(params.keys()).intersection(set(callback["relationships"]))
+                )
+            ):
+                continue
+            self.callbacks.dispatch(callback, params)
+
+    def read(
+        self,
+        query,
+        max_retries=3,
+        *,
+        tx_timeout=None,
+        max_rows=None,
+        database=None,
+        params=None,
+        **kwargs,
+    ):
+        """
+        Reads from a Cypher query, with params and kwargs as its parameters
+        tx_timeout: seconds after which the database aborts the transaction
+        max_rows: raise ResultTooLarge instead of reading more rows than this
+        database: the database to read, by default the server's default
+        params: parameters, also those named like an option (e.g. database)
+        """
+        kwargs.update(params or {})
+        driver = self._get_driver()
+        work = self._work(tx_timeout, max_rows)
         retries = 0
         result = None
         # retry transaction up to max_retries times, not including original attempt
         while True:
-            with self.driver.session() as session:
+            with driver.session(database=database) as session:
                 try:
                     # Read transactions allow the driver to handle retries for transient errors
                     if hasattr(session, "execute_read"):
-                        result = session.execute_read(self._submit_query, query, **kwargs)
+                        result = session.execute_read(work, query, **kwargs)
                     else:
-                        result = session.read_transaction(self._submit_query, query, **kwargs)
+                        result = session.read_transaction(work, query, **kwargs)
                     break
                 except Exception as e:  # pylint: disable=broad-except
                     retries += 1
-                    if retries > max_retries:
+                    # an exceeded limit would be exceeded again
+                    if retries > max_retries or isinstance(e, ResultTooLarge) or is_timeout(e):
                         raise e
-                    self.driver.close()
-                    self.driver = GraphDatabase.driver(
-                        self.uri, auth=(self.user, self.password)
-                    )
         return result
 
-    def write(self, query, max_retries=3, **kwargs):
+    def write(
+        self,
+        query,
+        max_retries=3,
+        *,
+        tx_timeout=None,
+        max_rows=None,
+        database=None,
+        params=None,
+        **kwargs,
+    ):
         """
         Writes from a cypher query
+        tx_timeout, max_rows, database, params: see read, a write over max_rows
+            is rolled back
         """
-        if not self.driver:
-            self.driver = GraphDatabase.driver(
-                self.uri, auth=(self.user, self.password)
-            )
+        kwargs.update(params or {})
+        driver = self._get_driver()
+        work = self._work(tx_timeout, max_rows)
         retries = 0
         result = None
         # retry transaction up to max_retries times, not including original attempt
         while True:
-            with self.driver.session() as session:
+            with driver.session(database=database) as session:
                 try:
                     # Write transactions allow the driver to handle retries and transient errors
                     if hasattr(session, "execute_write"):
-                        result = session.execute_write(self._submit_query, query, **kwargs)
+                        result = session.execute_write(work, query, **kwargs)
                     else:
-                        result = session.write_transaction(self._submit_query, query, **kwargs)
+                        result = session.write_transaction(work, query, **kwargs)
                     break
                 except Exception as e:  # pylint: disable=broad-except
                     retries += 1
-                    if retries > max_retries:
+                    # an exceeded limit would be exceeded again
+                    if retries > max_retries or isinstance(e, ResultTooLarge) or is_timeout(e):
                         raise e
-                    self.driver.close()
-                    self.driver = GraphDatabase.driver(
-                        self.uri, auth=(self.user, self.password)
-                    )
         return result
 
-    def auto_commit(self, query, **kwargs):
+    def auto_commit(self, query, *, database=None, params=None, **kwargs):
         """
         Auto commit, use is discouraged
+        database, params: see read
         """
-        try:
-            session = self.driver.session()
-        except Exception:
-            if self.driver:
-                self.driver.close()
-            self.driver = GraphDatabase.driver(
-                self.uri, auth=(self.user, self.password)
-            )
-            session = self.driver.session()
-        with session:
+        kwargs.update(params or {})
+        with self._get_driver().session(database=database) as session:
             # unmanaged transaction, driver will not handle retries or transient errors
-            result = session.run(query, **kwargs)
+            # records are read before the session closes and discards them
+            result = self._submit_query(session, query, **kwargs)
 
         return result
 
-    def read_graphql(self, query, **kwargs):
+    def stream(
+        self, query, *, tx_timeout=None, max_rows=None, database=None, params=None, **kwargs
+    ):
+        """
+        Reads from a Cypher query, yielding records as the database sends them
+        instead of holding them all in memory. Not retried.
+        tx_timeout, max_rows, database, params: see read
+        """
+        from neo4j import READ_ACCESS  # pylint: disable=import-outside-toplevel
+
+        kwargs.update(params or {})
+        driver = self._get_driver()
+        with driver.session(database=database, default_access_mode=READ_ACCESS) as session:
+            with session.begin_transaction(timeout=tx_timeout) as tx:
+                for count, record in enumerate(tx.run(query, **kwargs)):
+                    if max_rows is not None and count >= max_rows:
+                        raise ResultTooLarge(max_rows)
+                    yield record
+
+    def load_nodes(self, label, ids):
+        """
+        Fetches nodes by id, batched with the lookups of other threads and tasks
+        made within a short window (see castnet.loader). Returns a dict of
+        properties (or None if there is no such node) for each id, in order.
+        """
+        if label not in self.schema:
+            raise ValueError(f"{label} label not found in schema.")
+        return self._response([future.result() for future in self.loader.submit(label, ids)])
+
+    def load_node(self, label, resource_id):
+        """Fetches a node by id like load_nodes, None if there is no such node"""
+        return self.load_nodes(label, [resource_id])[0]
+
+    async def load_nodes_async(self, label, ids):
+        """load_nodes for asyncio tasks, waiting without blocking the event loop"""
+        if label not in self.schema:
+            raise ValueError(f"{label} label not found in schema.")
+        import asyncio  # pylint: disable=import-outside-toplevel
+
+        futures = self.loader.submit(label, ids)
+        return self._response(
+            list(await asyncio.gather(*[asyncio.wrap_future(f) for f in futures]))
+        )
+
+    async def load_node_async(self, label, resource_id):
+        """load_node for asyncio tasks"""
+        return (await self.load_nodes_async(label, [resource_id]))[0]
+
+    def register_view(self, name, root, query, store="local"):
+        """
+        Registers a materialized view (see castnet.views): the result of a
+        GraphQL selection on each node of a root label, kept up to date by the
+        generic endpoints.
+        query: the selection, e.g. "{ name descendantFeeder { name height } }"
+        store: "local", "node" or a ViewStore
+        """
+        if root not in self.schema:
+            raise ValueError(f"{root} label not found in schema.")
+        view = View(name, root, query, make_view_store(self, store))
+        # fails on fields the schema doesn't have
+        self.gql_to_cypher(view.query)
+        self.views[name] = view
+        return view
+
+    def _compute_view(self, view, root_id):
+        """The json of a view for one root, None if the root doesn't exist"""
+        results = self.read_graphql(view.query, id=root_id)[view.root]
+        return encode(results[0]) if results else None
+
+    def read_view(self, name, root_id, raw=False):
+        """
+        Reads a view's result for a root, computing and storing it if missing.
+        Returns None if the root doesn't exist.
+        raw: return the stored json string, e.g. to send as a response as is
+        """
+        view = self.views[name]
+        value = view.store.get(name, root_id)
+        if value is None:
+            view.misses += 1
+            value = self._compute_view(view, root_id)
+            if value is None:
+                return None
+            view.store.put(name, {root_id: value})
+        else:
+            view.hits += 1
+        return value if raw else json.loads(value)
+
+    def refresh_view(self, name, root_ids=None):
+        """
+        Recomputes a view for some roots, or rebuilds it for every root.
+        Returns the number of roots stored.
+        """
+        view = self.views[name]
+        if root_ids is None:
+            results = self.read_graphql(view.all_query)[view.root]
+            view.store.clear(name)
+            view.store.put(name, {result["id"]: encode(result) for result in results})
+            view.refreshes += len(results)
+            return len(results)
+        rows, missing = {}, []
+        for root_id in root_ids:
+            value = self._compute_view(view, root_id)
+            if value is None:
+                missing.append(root_id)
+            else:
+                rows[root_id] = value
+        if rows:
+            view.store.put(name, rows)
+        if missing:
+            view.store.delete(name, missing)
+        view.refreshes += len(root_ids)
+        return len(rows)
+
+    def view_metrics(self):
+        """Hit, miss and refresh counters of each view, by name"""
+        return {name: view.metrics() for name, view in self.views.items()}
+
+    def _affected_roots(self, label, resource_id):
+        """Roots of each view a write to a resource affects, by view name"""
+        if not self.views:
+            return {}
+        ancestor_labels = []
+        parent = self.schema[label]["relationships"].get("IS_IN")
+        while parent and parent not in ancestor_labels:
+            ancestor_labels.append(parent)
+            parent = self.schema[parent]["relationships"].get("IS_IN")
+        affected = {}
+        ancestors = None
+        for name, view in self.views.items():
+            if view.root == label:
+                affected[name] = [resource_id]
+            elif view.root in ancestor_labels:
+                if ancestors is None:
+                    ancestors = self.get_ancestors(resource_id, label)
+                affected[name] = [a["id"] for a in ancestors if a["__label"] == view.root]
+        return affected
+
+    def _forget_view_roots(self, label, root_ids):
+        """Drops archived or purged roots of a label from the views rooted there"""
+        for name, view in self.views.items():
+            if view.root != label or not root_ids:
+                continue
+            try:
+                view.store.delete(name, root_ids)
+            except Exception:  # pylint: disable=broad-except
+                view.failures += 1
+
+    def _refresh_views(self, affected):
+        """
+        Refreshes the affected roots. A failed refresh invalidates them instead,
+        so the next read recomputes them; the write itself already succeeded.
+        """
+        for name, root_ids in affected.items():
+            if not root_ids:
+                continue
+            try:
+                self.refresh_view(name, root_ids)
+            except Exception:  # pylint: disable=broad-except
+                self.views[name].failures += 1
+                try:
+                    self.views[name].store.delete(name, root_ids)
+                except Exception:  # pylint: disable=broad-except
+                    pass
+
+    @staticmethod
+    def purge_cypher(
+        label, older_than=False, relationships_only=False, history="keep", batch_size=1000
+    ):
+        """
+        Builds the query purging a round of archived nodes of a label, in
+        batched transactions. Must be run with auto_commit.
+        older_than: only nodes whose DELETE historyRecord is older than $older_than
+        relationships_only: only delete their relationships (except history links)
+        history: "keep" leaves history records (unlinked), "summarize" collapses
+            them into one PURGE record per node, "delete" removes them
+        """
+        if history not in PURGE_HISTORY:
+            raise ValueError(f"history must be one of {PURGE_HISTORY}.")
+        batch_size = int(batch_size)
+        age_check = ARCHIVED_BEFORE
+        if relationships_only:
+            query = f"MATCH (n:_archived_{label})-[r]-()\nWHERE type(r) <> \"RESOURCE_ID\""
+            if older_than:
+                query += " AND " + age_check
+            return query + (
+                "\nWITH DISTINCT r LIMIT $round_size\n"
+                "CALL (r) {\nDELETE r\n}"
+                f" IN TRANSACTIONS OF {batch_size} ROWS\n"
+                "RETURN count(r) AS purged"
+            )
+
+        query = f"MATCH (n:_archived_{label})\n"
+        if older_than:
+            query += "WHERE " + age_check + "\n"
+        query += "WITH n LIMIT $round_size\nCALL (n) {\n"
+        if history == "summarize":
+            query += (
+                "OPTIONAL MATCH (n)<-[:RESOURCE_ID]-(h:historyRecord)\n"
+                "WITH n, h ORDER BY h.timeStamp\n"
+                "WITH n, COLLECT(h) AS records\n"
+                "CREATE (:historyRecord {timeStamp: $timeStamp, email: $requester,"
+                " method: \"PURGE\", resourceId: n.id,"
+                " summary: [h IN records | h.timeStamp + \" \" + h.method]})\n"
+                "FOREACH (h IN records | DETACH DELETE h)\n"
+            )
+        elif history == "delete":
+            query += (
+                "OPTIONAL MATCH (n)<-[:RESOURCE_ID]-(h:historyRecord)\n"
+                "WITH n, COLLECT(h) AS records\n"
+                "FOREACH (h IN records | DETACH DELETE h)\n"
+            )
+        return query + (
+            "DETACH DELETE n\n}"
+            f" IN TRANSACTIONS OF {batch_size} ROWS\n"
+            "RETURN count(n) AS purged"
+        )
+
+    def purge_archived(
+        self,
+        label,
+        older_than=None,
+        batch_size=1000,
+        relationships_only=False,
+        history="keep",
+        requester=None,
+        progress=None,
+        round_size=None,
+    ):
+        """
+        Permanently removes archived (_archived_<label>) nodes, or only their
+        relationships, so they stop adding degree to the nodes they pointed at.
+        older_than: datetime, ISO string or timedelta (age); only nodes archived
+            before then, going by their DELETE historyRecord
+        batch_size: rows per transaction
+        round_size: rows per query, progress is reported after each round
+        progress: called with the running summary after each round
+        Returns a summary, e.g. {"label": "Scan", "nodes": 1200, "relationships": 0}
+        """
+        if label not in self.schema:
+            raise ValueError(f"{label} label not found in schema.")
+        if isinstance(older_than, timedelta):
+            older_than = datetime.now() - older_than
+        if isinstance(older_than, (datetime, date)):
+            older_than = older_than.isoformat()
+        if not relationships_only and any(v.root == label for v in self.views.values()):
+            # the ids are gone once purged
+            records = self.read(
+                f"MATCH (n:_archived_{label})\n"
+                + (f"WHERE {ARCHIVED_BEFORE}\n" if older_than else "")
+                + "RETURN n.id AS id",
+                database=self.database_of([label]),
+                older_than=older_than,
+            )
+            self._forget_view_roots(label, [record["id"] for record in records])
+        query = self.purge_cypher(
+            label, bool(older_than), relationships_only, history, batch_size
+        )
+        round_size = round_size or batch_size * 10
+        summary = {"label": label, "nodes": 0, "relationships": 0, "history": history}
+        while True:
+            records = self.auto_commit(
+                query,
+                database=self.database_of([label]),
+                older_than=older_than,
+                round_size=round_size,
+                timeStamp=str(datetime.now().isoformat()),
+                requester=requester,
+            )
+            purged = records[0]["purged"] if records else 0
+            summary["relationships" if relationships_only else "nodes"] += purged
+            if progress:
+                progress(dict(summary))
+            if purged < round_size:
+                return summary
+
+    def purge_idempotency_keys(self, older_than=None, batch_size=1000):
+        """
+        Forgets idempotency keys, run it periodically (e.g. hourly)
+        older_than: datetime, ISO string or timedelta (age), idempotency_ttl by
+            default
+        batch_size: keys per transaction
+        Returns the number of keys removed
+        """
+        if older_than is None:
+            older_than = self.idempotency_ttl
+        if isinstance(older_than, timedelta):
+            older_than = datetime.now() - older_than
+        if isinstance(older_than, (datetime, date)):
+            older_than = older_than.isoformat()
+        query = (
+            f"MATCH (i:{IDEMPOTENCY_LABEL}) WHERE i.created < $older_than\n"
+            "WITH i LIMIT $batch_size DELETE i RETURN count(i) AS purged"
+        )
+        total = 0
+        for database in self.databases():
+            while True:
+                records = self.write(
+                    query, database=database, older_than=older_than, batch_size=batch_size
+                )
+                purged = records[0]["purged"] if records else 0
+                total += purged
+                if purged < batch_size:
+                    break
+        return total
+
+    def subtree_labels(self, label):
+        """
+        Lists the labels which are IS_IN label, directly or through other labels,
+        with their depth below it. Deepest first, so leaves are archived first.
+        eg. [("Scan", 2), ("Feeder", 1)] for a House
+        """
+        levels = []
+        parents = [label]
+        seen = {label}
+        depth = 0
+        while parents:
+            depth += 1
+            children = [
+                child
+                for child, spec in self.schema.items()
+                if spec["relationships"].get("IS_IN") in parents and child not in seen
+            ]
+            seen.update(children)
+            levels += [(child, depth) for child in children]
+            parents = children
+        return sorted(levels, key=lambda level: -level[1])
+
+    def subtree_cypher(self, label, descendant, depth, count=False):
+        """
+        Builds the query archiving a batch of descendant nodes, depth IS_IN hops
+        below a label's node, or counting them for a dry run.
+        """
+        query = (
+            f"MATCH (:{label} {{id: $source_id}})<-[:IS_IN*{depth}]-(source:{descendant})\n"
+        )
+        if count:
+            return query + "RETURN count(source) AS count"
+        query += (
+            "WITH source LIMIT $batch_size\n"
+            f"REMOVE source:{descendant}\n"
+            f"SET source:_archived_{descendant}\n"
+        )
+        if not self.history:
+            query += (
+                "CREATE (:historyRecord {timeStamp: $timeStamp, email: $requester,"
+                ' method: "DELETE", resourceId: source.id})-[:RESOURCE_ID]->(source)\n'
+            )
+        return query + "RETURN source.id AS id"
+
+    def archive_subtree(
+        self,
+        label,
+        resource_id,
+        requester=None,
+        batch_size=1000,
+        dry_run=False,
+        progress=None,
+    ):
+        """
+        Archives a node and everything IS_IN it, leaves first, batch_size nodes
+        per transaction, with a DELETE historyRecord and callbacks for each node.
+        An interrupted archive can simply be run again.
+        dry_run: only count the nodes which would be archived
+        progress: called with the running counts after each batch
+        Returns the number of nodes archived by label, eg. {"Scan": 5000, "Feeder": 40, "House": 1}
+        """
+        if label not in self.schema:
+            raise ValueError(f"{label} label not found in schema.")
+        # IS_IN never crosses databases, the whole subtree is in one
+        database = self.database_of([label])
+        if not self.read(
+            f"MATCH (source:{label} {{id: $source_id}})\nRETURN source.id AS id",
+            source_id=resource_id,
+            database=database,
+        ):
+            raise ValueError(f"{label} {resource_id} not found.")
+        levels = self.subtree_labels(label)
+
+        summary = {}
+        if not dry_run:
+            # views of ancestors lose the subtree, views rooted inside it lose their roots
+            affected = self._affected_roots(label, resource_id)
+        if dry_run:
+            for descendant, depth in levels:
+                records = self.read(
+                    self.subtree_cypher(label, descendant, depth, count=True),
+                    source_id=resource_id,
+                    database=database,
+                )
+                summary[descendant] = records[0]["count"] if records else 0
+            summary[label] = 1
+            return summary
+
+        for descendant, depth in levels:
+            query = self.subtree_cypher(label, descendant, depth)
+            summary[descendant] = 0
+            while True:
+                records = self.write(
+                    query,
+                    database=database,
+                    source_id=resource_id,
+                    batch_size=batch_size,
+                    timeStamp=str(datetime.now().isoformat()),
+                    requester=requester,
+                )
+                for record in records:
+                    self._record_history(descendant, record["id"], "DELETE", requester)
+                    self._run_callbacks(descendant, "DELETE", {"source_id": record["id"]})
+                self._forget_view_roots(descendant, [record["id"] for record in records])
+                summary[descendant] += len(records)
+                if progress:
+                    progress(dict(summary))
+                if len(records) < batch_size:
+                    break
+
+        cypher, params = self.delete_cypher(label, resource_id)
+        cypher = self._add_history(cypher, params, resource_id, "DELETE", requester)
+        records = self.write(cypher, database=database, **params)
+        if records:
+            self._record_history(label, resource_id, "DELETE", requester)
+            self._refresh_views(affected)
+        self._run_callbacks(label, "DELETE", params)
+        summary[label] = len(records)
+        if progress:
+            progress(dict(summary))
+        return summary
+
+    def _label_of(self, resource_id, label=None):
+        """The label of a resource, from its id (Label__date__name__xxx) if not given"""
+        label = label or str(resource_id).split("__")[0]
+        if label not in self.schema:
+            raise ValueError(f"{label} label not found in schema.")
+        return label
+
+    @staticmethod
+    def ancestors_cypher(label):
+        """
+        Builds the query finding every IS_IN ancestor of a node in one traversal
+        """
+        return (
+            f"MATCH path = (:{label} {{id: $source_id}})-[:IS_IN*1..]->(n)\n"
+            "RETURN n, [l IN labels(n) WHERE l IN $labels][0] AS label,"
+            " length(path) AS depth\n"
+            "ORDER BY depth"
+        )
+
+    @staticmethod
+    def descendants_cypher(label, max_depth=None):
+        """
+        Builds the query finding the nodes IS_IN a node, directly or not, in one
+        traversal. $labels are the labels to return; archived nodes never are.
+        """
+        hops = f"1..{int(max_depth)}" if max_depth else "1.."
+        return (
+            f"MATCH path = (:{label} {{id: $source_id}})<-[:IS_IN*{hops}]-(n)\n"
+            "WHERE any(l IN labels(n) WHERE l IN $labels)\n"
+            "RETURN n, [l IN labels(n) WHERE l IN $labels][0] AS label,"
+            " length(path) AS depth, [x IN nodes(path)[..-1] | x.id] AS path"
+        )
+
+    def get_ancestors(self, resource_id, label=None):
+        """
+        Returns the IS_IN ancestors of a resource, parent first, eg. a scan's
+        feeder and house. Each is a dict of its properties with __label and __depth.
+        label: the resource's label, by default taken from its id
+        """
+        label = self._label_of(resource_id, label)
+        records = self.read(
+            self.ancestors_cypher(label),
+            database=self.database_of([label]),
+            source_id=resource_id,
+            labels=list(self.schema),
+        )
+        return [
+            self._response(
+                dict(record["n"], __label=record["label"], __depth=record["depth"])
+            )
+            for record in records
+        ]
+
+    def iter_subtree(self, resource_id, labels=None, max_depth=None, label=None):
+        """
+        Streams the nodes IS_IN a resource, directly or not, in no particular
+        order. Each is a dict of its properties with __label, __depth, __parent
+        (the id of the node it IS_IN) and __path (the ids from the resource down
+        to __parent).
+        labels: only return nodes of these labels, by default every descendant label
+        max_depth: only go this many IS_IN hops down
+        """
+        label = self._label_of(resource_id, label)
+        if labels is None:
+            labels = [descendant for descendant, _ in self.subtree_labels(label)]
+        query = self.descendants_cypher(label, max_depth)
+        records = self.stream(
+            query, database=self.database_of([label]), source_id=resource_id, labels=list(labels)
+        )
+        for record in records:
+            yield self._response(
+                dict(
+                    record["n"],
+                    __label=record["label"],
+                    __depth=record["depth"],
+                    __parent=record["path"][-1],
+                    __path=record["path"],
+                )
+            )
+
+    def get_subtree(
+        self, resource_id, labels=None, max_depth=None, nested=False, label=None
+    ):
+        """
+        Returns the nodes IS_IN a resource, see iter_subtree, as a flat list
+        ordered by depth, or nested: each node's children under "__children".
+        Nodes whose parent was not returned (see labels) hang under their
+        nearest returned ancestor.
+        """
+        nodes = sorted(
+            self.iter_subtree(resource_id, labels, max_depth, label),
+            key=lambda node: (node["__depth"], node.get("id") or ""),
+        )
+        if not nested:
+            return nodes
+        # parents sort before their children, so they are always in by_id already
+        roots = []
+        by_id = {}
+        for node in nodes:
+            node["__children"] = []
+            parent = next(
+                (by_id[i] for i in reversed(node["__path"]) if i in by_id), None
+            )
+            (parent["__children"] if parent else roots).append(node)
+            by_id[node.get("id")] = node
+        return roots
+
+    def databases(self):
+        """The databases the schema's labels are in, None for the default database"""
+        databases = {spec["database"] for spec in self.schema.values()}
+        return sorted(databases, key=lambda database: database or "")
+
+    def index_cypher(self, database=None):
+        """
+        Statements creating the indexes castnet relies on in a database: node
+        ids, for lookups and keyset pagination, the history timestamp, for the
+        change feed, the uniqueness of idempotency keys, and view lookups when
+        views are stored on nodes. In native temporal mode date and datetime
+        attributes get range indexes too.
+        database: only the labels in this database, see the schema's "database"
+        """
+        statements = [
+            "CREATE RANGE INDEX castnet_historyRecord_timeStamp IF NOT EXISTS "
+            "FOR (n:historyRecord) ON (n.timeStamp)"
+        ]
+        for label in self.schema:
+            if self.schema[label]["database"] != database:
+                continue
+            for index_label in [label, "_archived_" + label]:
+                statements.append(
+                    f"CREATE RANGE INDEX castnet_{index_label}_id IF NOT EXISTS "
+                    f"FOR (n:{index_label}) ON (n.id)"
+                )
+            if self.temporal == "native":
+                for key in self.temporal_attributes(label):
+                    statements.append(
+                        f"CREATE RANGE INDEX castnet_{label}_{key} IF NOT EXISTS "
+                        f"FOR (n:{label}) ON (n.{key})"
+                    )
+        statements.append(
+            f"CREATE CONSTRAINT castnet{IDEMPOTENCY_LABEL}_key IF NOT EXISTS "
+            f"FOR (n:{IDEMPOTENCY_LABEL}) REQUIRE n.key IS UNIQUE"
+        )
+        statements.append(
+            f"CREATE RANGE INDEX castnet{IDEMPOTENCY_LABEL}_created IF NOT EXISTS "
+            f"FOR (n:{IDEMPOTENCY_LABEL}) ON (n.created)"
+        )
+        # views are stored in the default database
+        node_views = any(isinstance(view.store, NodeViewStore) for view in self.views.values())
+        if node_views and database is None:
+            statements.append(NodeViewStore.index_cypher())
+        return statements
+
+    def ensure_indexes(self):
+        """
+        Creates any missing castnet indexes in every database. Returns the
+        statements run.
+        """
+        statements = []
+        databases = self.databases()
+        if None not in databases and self.views:
+            databases.insert(0, None)
+        for database in databases:
+            for statement in self.index_cypher(database):
+                self.write(statement, database=database)
+                statements.append(statement)
+        return statements
+
+    def temporal_attributes(self, label):
+        """The date and datetime attributes of a label, by name"""
+        return {
+            key: param_type
+            for key, param_type in self.schema[label]["attributes"].items()
+            if param_type in [date, datetime]
+        }
+
+    @staticmethod
+    def migrate_temporal_cypher(label, key, param_type):
+        """
+        Builds the query converting a batch of a label's ISO string values of an
+        attribute to native dates or datetimes. Only strings compare to '', so
+        values already converted are skipped.
+        """
+        if param_type is date:
+            convert = f"date(substring(n.{key}, 0, 10))"
+        else:
+            convert = f"datetime(n.{key})"
+        return (
+            f"MATCH (n:{label}) WHERE n.{key} >= ''\n"
+            "WITH n LIMIT $batch_size\n"
+            f"SET n.{key} = {convert}\n"
+            "RETURN count(n) AS converted"
+        )
+
+    def migrate_temporal(self, labels=None, batch_size=1000, progress=None):
+        """
+        Converts date and datetime attributes stored as ISO strings to native
+        values, for switching a database to temporal="native". Runs online, one
+        transaction per batch, and can be stopped and run again. Archived nodes
+        are converted too.
+        progress: called with (label, attribute, converted) after each batch
+        Returns the number of values converted by label and attribute.
+        """
+        converted = {}
+        for label in labels or list(self.schema):
+            for key, param_type in self.temporal_attributes(label).items():
+                for node_label in [label, "_archived_" + label]:
+                    query = self.migrate_temporal_cypher(node_label, key, param_type)
+                    while True:
+                        count = self.write(
+                            query, database=self.database_of([label]), batch_size=batch_size
+                        )[0]["converted"]
+                        converted.setdefault(label, {}).setdefault(key, 0)
+                        converted[label][key] += count
+                        if progress and count:
+                            progress(node_label, key, count)
+                        if count < batch_size:
+                            break
+        return converted
+
+    @staticmethod
+    def _encode_cursor(time_stamp, element_id):
+        """Encodes a change feed position as an opaque string"""
+        return (
+            base64.urlsafe_b64encode(json.dumps([time_stamp, element_id]).encode())
+            .decode()
+            .rstrip("=")
+        )
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        """Decodes a change feed cursor, None starts from the beginning"""
+        if not cursor:
+            return "", ""
+        try:
+            padded = cursor + "=" * (-len(cursor) % 4)
+            time_stamp, element_id = json.loads(base64.urlsafe_b64decode(padded))
+        except ValueError as err:
+            raise ValueError(f"'{cursor}' is not a valid change cursor.") from err
+        return time_stamp, element_id
+
+    @staticmethod
+    def changes_cypher(labels=False, until=False):
+        """
+        Builds the change feed query, ordered by history timestamp with the
+        element id as a tie breaker so the cursor is exact.
+        """
+        query = (
+            "MATCH (h:historyRecord)\n"
+            "WHERE (h.timeStamp > $after OR (h.timeStamp = $after AND elementId(h) > $after_id))"
+        )
+        if until:
+            query += " AND h.timeStamp <= $until"
+        query += "\nOPTIONAL MATCH (h)-[:RESOURCE_ID]->(s)\n"
+        if labels:
+            query += "WITH h, s WHERE any(l IN labels(s) WHERE l IN $labels)\n"
+        query += (
+            "WITH h, s ORDER BY h.timeStamp, elementId(h) LIMIT $limit\n"
+            "RETURN h, elementId(h) AS element_id, labels(s) AS labels"
+        )
+        return query
+
+    def changes_since(self, cursor=None, labels=None, limit=1000, lag=0):
+        """
+        Returns a page of changes recorded by historyRecords after a cursor.
+        cursor: the cursor of a previous page, None for the beginning
+        labels: only changes to these labels (live or archived), read from
+            their database; without labels the default database is read
+        lag: seconds, leave out records younger than this so records of
+            transactions still in flight aren't skipped
+        Returns {"changes": [...], "cursor": "..."}. Pass the cursor back to get
+        the next page, the cursor doesn't move if there are no changes.
+
+        Example change:
+        {"timeStamp": "2022-04-29T10:00:00", "method": "PATCH", "label": "Feeder",
+         "resourceId": "Feeder__...", "email": "a@b.c", "jsonRequest": "{...}"}
         """
-        Executes a graphql query with variables
+        after, after_id = self._decode_cursor(cursor)
+        params = {"after": after, "after_id": after_id, "limit": limit}
+        if labels:
+            params["labels"] = list(labels) + ["_archived_" + l for l in labels]
+        if lag:
+            params["until"] = (datetime.now() - timedelta(seconds=lag)).isoformat()
+        records = self.read(
+            self.changes_cypher(bool(labels), bool(lag)),
+            database=self.database_of(labels or []),
+            **params,
+        )
+        changes = []
+        for record in records:
+            change = dict(record["h"])
+            node_labels = record["labels"] or []
+            change["label"] = None
+            for node_label in node_labels:
+                if node_label.startswith("_archived_"):
+                    node_label = node_label[len("_archived_") :]
+                if node_label in self.schema:
+                    change["label"] = node_label
+            changes.append(change)
+        if records:
+            cursor = self._encode_cursor(
+                records[-1]["h"]["timeStamp"], records[-1]["element_id"]
+            )
+        return {"changes": changes, "cursor": cursor}
+
+    def iter_changes(self, cursor=None, labels=None, page_size=1000, lag=0):
+        """
+        Streams pages of changes_since after a cursor until caught up
+        """
+        while True:
+            page = self.changes_since(cursor, labels, page_size, lag)
+            if page["changes"]:
+                yield page
+            cursor = page["cursor"]
+            if len(page["changes"]) < page_size:
+                return
+
+    def read_graphql(
+        self,
+        query,
+        layout="objects",
+        parallel=None,
+        tx_timeout=None,
+        max_rows=None,
+        variables=None,
+        **kwargs,
+    ):
+        """
+        Executes a graphql query with variables, given as variables and kwargs
         Returns a dictionary containing top level labels and data
+        layout: "objects" returns each list of nodes as a list of dicts,
+            "rows" as {"fields": [...], "rows": [[...], ...]} and "columns" as
+            {"fields": [...], "columns": [[...], ...]}, also for nested lists
+        parallel: run the top level fields at the same time, see
+            graphql_workers, by default if graphql_workers is set or the
+            fields are in different databases
+        tx_timeout: seconds after which the database aborts the query
+        max_rows: raise ResultTooLarge if a top level field has more nodes, the
+            database reads at most one more. Nested lists aren't limited.
+        variables: the query's variables, also those named like an option
+            (e.g. layout), which kwargs can't pass
         """
+        if layout not in GRAPHQL_LAYOUTS:
+            raise ValueError(f"layout must be one of {GRAPHQL_LAYOUTS}")
+        kwargs.update(variables or {})
+        database = None
+        if len(self.databases()) > 1:
+            try:
+                database = self.database_of(self.graphql_labels(query))
+            except ValueError:
+                # each field is read from its own database
+                parallel = True if parallel is None else parallel
+        if parallel is None:
+            parallel = self.graphql_workers > 0
+
+        if parallel:
+            futures = self._submit_graphql(query, layout, kwargs, tx_timeout, max_rows)
+            records = {}
+            for future in futures:
+                records.update(future.result())
+            return self._graphql_response(records, layout)
 
         # Convert graphql to cypher
-        cypher = self.gql_to_cypher(query)
-        results = self.read(cypher, **kwargs)
+        cypher = self.gql_to_cypher(query, rows=layout != "objects", limit=max_rows is not None)
+        records = self._read_graphql_cypher(cypher, kwargs, tx_timeout, max_rows, database)
+        return self._graphql_response(records, layout)
+
+    async def read_graphql_async(
+        self, query, layout="objects", tx_timeout=None, max_rows=None, variables=None, **kwargs
+    ):
+        """
+        read_graphql for asyncio tasks, running the top level fields at the
+        same time on the graphql_workers pool without blocking the event loop
+        """
+        if layout not in GRAPHQL_LAYOUTS:
+            raise ValueError(f"layout must be one of {GRAPHQL_LAYOUTS}")
+        kwargs.update(variables or {})
+        import asyncio  # pylint: disable=import-outside-toplevel
+
+        futures = self._submit_graphql(query, layout, kwargs, tx_timeout, max_rows)
+        records = {}
+        for result in await asyncio.gather(*[asyncio.wrap_future(f) for f in futures]):
+            records.update(result)
+        return self._graphql_response(records, layout)
+
+    def _get_graphql_pool(self):
+        """The pool of top level GraphQL fields, started on first use"""
+        # one driver and pool for every thread
+        self._get_driver()
+        with self._driver_lock:
+            if self._graphql_pool is None:
+                self._graphql_pool = ThreadPoolExecutor(
+                    self.graphql_workers or 4, thread_name_prefix="castnet-graphql"
+                )
+        return self._graphql_pool
+
+    def _submit_graphql(self, query, layout, params, tx_timeout=None, max_rows=None):
+        """Submits a read per top level field to the graphql pool, returns the futures"""
+        cyphers = self._field_cyphers(
+            query, rows=layout != "objects", limit=max_rows is not None
+        )
+        pool = self._get_graphql_pool()
+        return [
+            pool.submit(
+                self._read_graphql_cypher, cypher, params, tx_timeout, max_rows, database
+            )
+            for cypher, database in cyphers
+        ]
+
+    def _field_cyphers(self, query, rows=False, limit=False):
+        """The cypher and database of each top level field of a GraphQL request"""
+        return self.schema.cached(
+            "graphql",
+            ("fields", query, rows, limit, self.graphql_compiler, self.temporal),
+            lambda: tuple(
+                (
+                    self._ast_to_cypher([single_query], rows=rows, limit=limit),
+                    self.database_of([single_query["label"]]),
+                )
+                for single_query in self._gql_to_ast(self._strip_query(query))
+            ),
+        )
+
+    def _read_graphql_cypher(
+        self, cypher, params, tx_timeout=None, max_rows=None, database=None
+    ):
+        """Reads a graphql query's cypher, returns its top level fields by name"""
+        if max_rows is not None:
+            # one more than max_rows, to tell a full result from a larger one
+            params = dict(params, **{MAX_ROWS_PARAM: max_rows + 1})
+        results = self.read(cypher, tx_timeout=tx_timeout, database=database, params=params)
 
         # convert the top level results to graphql-like response?
+        records = {}
         for result in results:
-            labels = result.__dict__["_Record__keys"]
-            records = {label: r for (label, r) in zip(labels, result)}
-
+            records = dict(zip(result.keys(), result.values()))
+        if max_rows is not None:
+            for value in records.values():
+                # a list of nodes, or {fields, rows} for the rows layouts
+                if len(value["rows"] if isinstance(value, dict) else value) > max_rows:
+                    raise ResultTooLarge(max_rows)
         return records
 
-    def gql_to_cypher(self, query):
-        """Converts a GraphQL request to Cypher"""
-        query = self._strip_query(query)
-        parsed_query = self._gql_to_ast(query)
-        return self._ast_to_cypher(parsed_query)
+    def _graphql_response(self, records, layout):
+        """Converts graphql results to the layout and temporal values to ISO strings"""
+        if layout == "columns":
+            records = {name: self._rows_to_columns(table) for name, table in records.items()}
+        return self._response(records)
+
+    @classmethod
+    def _rows_to_columns(cls, table):
+        """Transposes {"fields", "rows"} to {"fields", "columns"}, nested lists too"""
+        columns = [list(column) for column in zip(*table["rows"])]
+        if not columns:
+            columns = [[] for _ in table["fields"]]
+        for column in columns:
+            for i, value in enumerate(column):
+                # properties can't be maps, so maps are nested lists of nodes
+                if isinstance(value, dict):
+                    column[i] = cls._rows_to_columns(value)
+        return {"fields": table["fields"], "columns": columns}
+
+    def warm(self, graphql=(), writes=()):
+        """
+        Fills the caches of the compiled schema (see castnet.schema) before
+        serving, e.g. before saving it
+        graphql: GraphQL queries, compiled for every layout and for parallel
+            and streamed reads
+        writes: (label, method, body) of sample POST and PATCH requests
+        Returns the entries per cache
+        """
+        for query in graphql:
+            self.graphql_labels(query)
+            for rows, limit in itertools.product([False, True], repeat=2):
+                self.gql_to_cypher(query, rows, limit)
+                self._field_cyphers(query, rows, limit)
+            for rows in [False, True]:
+                self.gql_to_stream_cypher(query, rows)
+        for label, method, body in writes:
+            self.request_to_cypher(label, params=dict(body), method=method)
+        for resource_type in self.url_key:
+            self._check_dependencies(resource_type)
+        return self.schema.cache_metrics()
+
+    def graphql_labels(self, query):
+        """The labels of the top level fields of a GraphQL request"""
+        labels = self.schema.cached(
+            "graphql",
+            ("labels", query),
+            lambda: tuple(q["label"] for q in self._gql_to_ast(self._strip_query(query))),
+        )
+        return list(labels)
+
+    def gql_to_cypher(self, query, rows=False, limit=False):
+        """
+        Converts a GraphQL request to Cypher
+        rows: lists of nodes as {fields, rows}, see read_graphql
+        limit: read at most $castnet_max_rows nodes of each top level field
+        """
+        return self.schema.cached(
+            "graphql",
+            ("cypher", query, rows, limit, self.graphql_compiler, self.temporal),
+            lambda: self._ast_to_cypher(
+                self._gql_to_ast(self._strip_query(query)), rows=rows, limit=limit
+            ),
+        )
+
+    def gql_to_stream_cypher(self, query, rows=False):
+        """
+        Converts a GraphQL request to a Cypher query per top level field, each
+        returning a row per node so the results can be streamed.
+        rows: each node as a list of values, see read_graphql
+        Returns a list of (field name, the names of its values, cypher, the
+        database to read it from).
+        """
+
+        def build():
+            return tuple(
+                (
+                    single_query["name"],
+                    [field for field, _ in self._ast_fields(single_query)],
+                    self._ast_to_cypher(single_query, collect=False, rows=rows),
+                    self.database_of([single_query["label"]]),
+                )
+                for single_query in self._gql_to_ast(self._strip_query(query))
+            )
+
+        return list(
+            self.schema.cached(
+                "graphql", ("stream", query, rows, self.graphql_compiler, self.temporal), build
+            )
+        )
+
+    def stream_graphql(
+        self,
+        query,
+        chunk_size=65536,
+        layout="objects",
+        tx_timeout=None,
+        max_rows=None,
+        variables=None,
+        **kwargs,
+    ):
+        """
+        Executes a graphql query like read_graphql, yielding the json of its
+        result in chunks of about chunk_size bytes. Each top level field is
+        read with stream, so only a chunk is held in memory at a time.
+        layout: "objects" or "rows", see read_graphql
+        tx_timeout, max_rows: per top level field, see read_graphql
+        variables: see read_graphql
+        """
+        if layout not in GRAPHQL_LAYOUTS[:2]:
+            raise ValueError(f"layout must be one of {GRAPHQL_LAYOUTS[:2]} to stream")
+        kwargs.update(variables or {})
+        queries = self.gql_to_stream_cypher(query, rows=layout == "rows")
+        buffer = bytearray(b"{")
+        for i, (name, fields, cypher, database) in enumerate(queries):
+            buffer += (b',"' if i else b'"') + name.encode() + b'":'
+            if layout == "rows":
+                buffer += b'{"fields":' + encode_json(fields) + b',"rows":'
+            buffer += b"["
+            first = True
+            records = self.stream(
+                cypher, tx_timeout=tx_timeout, max_rows=max_rows, database=database, params=kwargs
+            )
+            for record in records:
+                if not first:
+                    buffer += b","
+                buffer += encode_json(record[0])
+                first = False
+                if len(buffer) >= chunk_size:
+                    yield bytes(buffer)
+                    buffer.clear()
+            buffer += b"]}" if layout == "rows" else b"]"
+        buffer += b"}"
+        yield bytes(buffer)
 
     def parse_params(self, label, params):
         """
@@ -379,12 +1692,15 @@ class CastNetConn:
                 # If there is no value, it is none
                 if value is None or value == "":
                     attribute_params[key] = None
-                # dates are cast to ISO format
+                # dates are cast to ISO format, or to dates in native mode
                 elif param_type in [datetime, date]:
                     try:
-                        attribute_params[key] = param_type.isoformat(
-                            param_type.fromisoformat(value)
-                        )
+                        if self.temporal == "native":
+                            attribute_params[key] = to_temporal(value, param_type)
+                        else:
+                            attribute_params[key] = param_type.isoformat(
+                                param_type.fromisoformat(value)
+                            )
                     except ValueError as err:
                         raise ValueError(
                             f"For label '{key}', '{value}' is not suitable. Must be"
@@ -426,9 +1742,51 @@ class CastNetConn:
         """
         param_type = self.schema[label]["attributes"][attr_name]
         if param_type in [date, datetime]:
+            if self.temporal == "native":
+                value = convert_datetime(value)
+                return to_temporal(value[:10] if param_type is date else value, param_type)
             return convert_datetime(value)
         return param_type(value)
 
+    def convert_column(self, values, attr_name, label="Injection"):
+        """
+        Converts a column of values to the correct type for Neo4j, detecting the
+        date format once for the whole column.
+        Returns the converted values and the indexes of values that failed.
+        """
+        from castnet.casting import cast_column  # pylint: disable=import-outside-toplevel
+
+        param_type = self.schema[label]["attributes"][attr_name]
+        cast, failed = cast_column(values, param_type)
+        if self.temporal == "native" and param_type in [date, datetime]:
+            cast = [None if v is None else to_temporal(v, param_type) for v in cast]
+        return cast, failed
+
+    def _add_history(
+        self, query, params, resource_id, method, requester, json_request=None
+    ):
+        """
+        Adds the historyRecord to a write query when history is inline
+        """
+        if self.history:
+            return query
+        query, history_params = self.add_history(
+            query, resource_id, method, requester, json_request
+        )
+        params.update(history_params)
+        return query
+
+    def _record_history(
+        self, label, resource_id, method, requester, json_request=None
+    ):
+        """
+        Hands the historyRecord of a successful write to the history sink
+        """
+        if self.history:
+            self.history.submit(
+                history_record(label, resource_id, method, requester, json_request)
+            )
+
     @staticmethod
     def add_history(query, resource_id, method, requester=None, json_request=None):
         params = {
@@ -456,16 +1814,79 @@ class CastNetConn:
 
         return query, params
 
-    def generic_post(self, request, requester=None):
+    @staticmethod
+    def request_hash(json_request):
+        """A digest of a request body, telling apart reuses of an idempotency key"""
+        body = json.dumps(json_request, sort_keys=True, default=str)
+        return hashlib.sha256(body.encode()).hexdigest()
+
+    @staticmethod
+    def add_idempotency(query, key, label, json_request=None):
+        """
+        Makes a create query write only if its idempotency key is unused, and
+        record the key in the same transaction
+        """
+        params = {
+            "idempotencyKey": key,
+            "idempotencyLabel": label,
+            "requestHash": CastNetConn.request_hash(json_request),
+            "idempotencyCreated": str(datetime.now().isoformat()),
+        }
+        query = (
+            f"OPTIONAL MATCH (used:{IDEMPOTENCY_LABEL} {{key: $idempotencyKey}})\n"
+            "WITH used WHERE used IS NULL\n"
+            + query[:-13]
+            + f"""
+            \nWITH source
+            CREATE (:{IDEMPOTENCY_LABEL} {{key: $idempotencyKey, label: $idempotencyLabel, resourceId: source.id, requestHash: $requestHash, created: $idempotencyCreated}})\n"""
+            + query[-13:]
+        )
+        return query, params
+
+    def _replay_post(self, label, key, json_request, limits):
+        """
+        The response of the POST that used an idempotency key, the node it
+        created as it is now, or None if the key is unused
+        """
+        records = self.read(
+            f"MATCH (i:{IDEMPOTENCY_LABEL} {{key: $key}}) "
+            f"OPTIONAL MATCH (s:{label} {{id: i.resourceId}}) RETURN i, s",
+            key=key,
+            **limits,
+        )
+        if not records:
+            return None
+        used = records[0]["i"]
+        if used["label"] != label or used["requestHash"] != self.request_hash(json_request):
+            return (f"The idempotency key {key} was used for a different request.", 422)
+        if records[0]["s"] is None:
+            return (f"The resource {used['resourceId']} created with this key was deleted.", 410)
+        return (self._response([dict(records[0]["s"])]), 200)
+
+    def generic_post(self, request, requester=None, idempotency_key=None):
         """
         Creates a new record from a request and creates a historyRecord.
         request: Flask-Request like object, with attributes
             json: String, json payload from front end
             path: String, routing path, e.g "/birdfeeders"
+        idempotency_key: makes retries of the request safe, a request repeating
+            the key returns the node the first one created instead of writing
+            again. Defaults to the request's Idempotency-Key header.
         Returns a tuple with data and expected HTTP status.
         """
         path_params = self.get_path(request.path)
         label = self.url_key[path_params[0]]
+        limits = self._endpoint_options("post", label)
+        headers = getattr(request, "headers", None) or {}
+        idempotency_key = idempotency_key or headers.get(IDEMPOTENCY_HEADER)
+        if idempotency_key:
+            # a retry would otherwise fail on the name the first request took
+            try:
+                replay = self._replay_post(label, idempotency_key, request.json, limits)
+            except Exception as err:  # pylint: disable=broad-except
+                return self._error_response(err)
+            if replay:
+                return replay
         # check it has a name
         if not request.json["name"]:
             return ("You must specify a name.", 400)
@@ -484,9 +1905,9 @@ class CastNetConn:
                 f"(a)-[:IS_IN]-(b:{label}) RETURN a, b"
             )
             try:
-                records = self.read(cypher, id=request.json["IS_IN"])
+                records = self.read(cypher, id=request.json["IS_IN"], **limits)
             except Exception as err:  # pylint: disable=broad-except
-                return (f"There was an error: {err}", 400)
+                return self._error_response(err)
 
             if len(records) == 0:
                 return (
@@ -505,9 +1926,9 @@ class CastNetConn:
             # Todo this should be atomic but isn't
             cypher = f"MATCH (a:{label} {{name: $name}}) RETURN a"
             try:
-                records = self.read(cypher, name=request.json["name"])
+                records = self.read(cypher, name=request.json["name"], **limits)
             except Exception as err:  # pylint: disable=broad-except
-                return (f"There was an error: {err}", 400)
+                return self._error_response(err)
             if len(records) > 0:
                 return (
                     "You already have a resource with that name.",
@@ -518,39 +1939,47 @@ class CastNetConn:
             cypher, params = self.request_to_cypher(
                 label, params=request.json, method=request.method
             )
-            cypher, history_params = self.add_history(
-                cypher, params["source_id"], "POST", requester, request.json
+            resource_id = params["source_id"]
+            cypher = self._add_history(
+                cypher, params, resource_id, "POST", requester, request.json
             )
-            params.update(history_params)
+            if idempotency_key:
+                cypher, idempotency_params = self.add_idempotency(
+                    cypher, idempotency_key, label, request.json
+                )
+                params.update(idempotency_params)
         except (KeyError, ValueError) as err:
-            return (f"There was an error: {err}", 400)
+            return self._error_response(err)
         try:
-            records = self.write(cypher, **params)
+            records = self.write(cypher, params=params, **limits)
         except Exception as err:  # pylint: disable=broad-except
-            return (f"There was an error: {err}", 400)
-
+            if not idempotency_key:
+                return self._error_response(err)
+            # e.g. the commit went through but its acknowledgement was lost
+            try:
+                replay = self._replay_post(label, idempotency_key, request.json, limits)
+            except Exception:  # pylint: disable=broad-except
+                replay = None
+            return replay or self._error_response(err)
+
+        if len(records) == 0 and idempotency_key:
+            # a retry of the write found the key taken
+            replay = self._replay_post(label, idempotency_key, request.json, limits)
+            if replay:
+                return replay
         if len(records) == 0:
             return (
                 f"Error creating new {label}. Your fields might be the wrong type,"
                 f" or the connections might not exist.",
                 400,
             )
+        self._record_history(label, resource_id, "POST", requester, request.json)
+        self._refresh_views(self._affected_roots(label, resource_id))
 
         # execute a callback
-        for callback in self.schema[label]["callbacks"]:
-            if "POST" in callback["methods"] and (
-                (
-                    "attributes" in callback
-                    and set(params.keys()).intersection(set(callback["attributes"]))
-                )
-                or (
-                    "relationships" in callback
-                    and set(params.keys()).intersection(set(callback["relationships"]))
-                )
-            ):
-                callback["callback"](params)
+        self._run_callbacks(label, "POST", params)
 
-        return ([dict(r["source"]) for r in records], 200)
+        return (self._response([dict(r["source"]) for r in records]), 200)
 
     def generic_patch(self, request, requester=None):
         """
@@ -565,6 +1994,7 @@ class CastNetConn:
         path_params = self.get_path(request.path)
         label = self.url_key[path_params[0]]
         resource_id = path_params[1]
+        limits = self._endpoint_options("patch", label)
         # Disable changing the name or hierarchy
         if "id" in request.json or "IS_IN" in request.json or "name" in request.json:
             return (
@@ -573,52 +2003,57 @@ class CastNetConn:
             )
         try:
             cypher, params = self.request_to_cypher(label, resource_id, request.json)
-            cypher, history_params = self.add_history(
-                cypher, resource_id, "PATCH", requester, request.json
+            cypher = self._add_history(
+                cypher, params, resource_id, "PATCH", requester, request.json
             )
-            params.update(history_params)
 
         except (KeyError, ValueError) as err:
-            return (f"There was an error: {err}", 400)
+            return self._error_response(err)
         try:
-            records = self.write(cypher, **params)
+            records = self.write(cypher, params=params, **limits)
         except Exception as err:  # pylint: disable=broad-except
-            return (f"There was an error: {err}", 400)
+            return self._error_response(err)
         if len(records) == 0:
             return (
                 f"Error updating {label}. It may not exist, or your entries might be"
                 f" the wrong type.",
                 400,
             )
+        self._record_history(label, resource_id, "PATCH", requester, request.json)
+        self._refresh_views(self._affected_roots(label, resource_id))
 
         # execute a callback
-        for callback in self.schema[label]["callbacks"]:
-            if "PATCH" in callback["methods"] and (
-                (
-                    "attributes" in callback
-                    and set(params.keys()).intersection(set(callback["attributes"]))
-                )
-                or (
-                    "relationships" in callback
-                    and set(params.keys()).intersection(set(callback["relationships"]))
-                )
-            ):
-                callback["callback"](params)
-        return (dict(records[0][0]), 200)
+        self._run_callbacks(label, "PATCH", params)
+        return (self._response(dict(records[0][0])), 200)
 
-    def generic_delete(self, request, requester=None):
+    def generic_delete(self, request, requester=None, cascade=False):
         """Deletes a record and creates a historyRecord.
+        cascade: also archive everything IS_IN the record, see archive_subtree.
+            The data returned is then the number of nodes archived by label.
         Returns a tuple with data and status code"""
         path_params = self.get_path(request.path)
         label = self.url_key[path_params[0]]
         path_params = self.get_path(request.path)
         resource_id = path_params[1]
+        limits = self._endpoint_options("delete", label)
+        if cascade:
+            # archive_subtree keeps the views up to date
+            try:
+                summary = self.archive_subtree(label, resource_id, requester)
+            except Exception as err:  # pylint: disable=broad-except
+                return self._error_response(err)
+            return (summary, 200)
+        # the affected roots are found while the resource is still live
+        try:
+            affected = self._affected_roots(label, resource_id)
+        except Exception as err:  # pylint: disable=broad-except
+            return self._error_response(err)
         dependency_query = self._check_dependencies(path_params[0])
         if dependency_query:
             try:
-                num_dependencies = len(self.read(dependency_query, id=resource_id))
+                num_dependencies = len(self.read(dependency_query, id=resource_id, **limits))
             except Exception as err:  # pylint: disable=broad-except
-                return (f"There was an error: {err}", 400)
+                return self._error_response(err)
             if num_dependencies > 0:
                 return (
                     "Your resource still has dependencies and "
@@ -627,22 +2062,21 @@ class CastNetConn:
                 )
 
         cypher, params = self.delete_cypher(label, resource_id)
-        cypher, history_params = self.add_history(
-            cypher, resource_id, "DELETE", requester
-        )
-        params.update(history_params)
+        cypher = self._add_history(cypher, params, resource_id, "DELETE", requester)
         try:
-            self.write(cypher, **params)
+            records = self.write(cypher, params=params, **limits)
         except Exception as err:  # pylint: disable=broad-except
-            return (f"There was an error: {err}", 400)
-        for callback in self.schema[label]["callbacks"]:
-            if "DELETE" in callback["methods"]:
-                callback["callback"](params)
+            return self._error_response(err)
+        if records:
+            self._record_history(label, resource_id, "DELETE", requester)
+            self._refresh_views(affected)
+        self._run_callbacks(label, "DELETE", params)
 
         return ("Deleted", 200)
 
     def generic_graphql(self, request):
         """Executes a graphql request from an HTTP request
+        The request's json may ask for a "layout", see read_graphql
         Returns tuple, data and expected response"""
         query = request.json["query"]
         try:
@@ -651,12 +2085,33 @@ class CastNetConn:
             params = {}
         if not params:
             params = {}
+        layout = request.json.get("layout") or "objects"
         try:
-            results = self.read_graphql(query, **params)
+            limits = self.query_limits("graphql", self.graphql_labels(query))
+            results = self.read_graphql(query, layout, **limits, variables=params)
         except Exception as err:  # pylint: disable=broad-except
-            return (f"There was an error: {err}", 400)
+            return self._error_response(err)
         return ([True, {"data": results}], 200)
 
+    def generic_graphql_stream(self, request, chunk_size=65536):
+        """
+        Executes a graphql request like generic_graphql, with the data as an
+        iterator of json byte chunks, e.g. for a Flask streaming response:
+        Response(data, status, mimetype="application/json")
+        Errors before the first chunk return 400, later ones end the stream.
+        """
+        query = request.json["query"]
+        params = request.json.get("variables") or {}
+        layout = request.json.get("layout") or "objects"
+        try:
+            limits = self.query_limits("graphql", self.graphql_labels(query))
+            chunks = self.stream_graphql(query, chunk_size, layout, **limits, variables=params)
+            first = next(chunks)
+        except Exception as err:  # pylint: disable=broad-except
+            return self._error_response(err)
+        # the same document generic_graphql's data serializes to
+        return (itertools.chain([b'[true,{"data":', first], chunks, [b"}]"]), 200)
+
     @staticmethod
     def get_path(path):
         """
@@ -669,8 +2124,35 @@ class CastNetConn:
     #######
     # Graphql Conversion Functions
     #######
-    def _ast_to_cypher(self, query, p_varname="a"):
-        """Translates graphql ast to cypher"""
+    @staticmethod
+    def _ast_fields(query, c_varname="a_1"):
+        """
+        The field names of a single query of a graphql ast and the cypher of
+        their values, in the order rows list them
+        """
+        ordered = "dir" in query and "hops" not in query
+        fields = [
+            (attr, "r.order_num" if attr == "__order" and ordered else f"{c_varname}.{attr}")
+            for attr in query["attributes"]
+            if isinstance(attr, str)
+        ]
+        fields += [
+            (attr["name"], attr["name"])
+            for attr in query["attributes"]
+            if isinstance(attr, dict)
+        ]
+        return fields
+
+    def _ast_to_cypher(self, query, p_varname="a", collect=True, rows=False, limit=False):
+        """
+        Translates graphql ast to cypher
+        collect: return a query's nodes as one list, else a row per node
+        rows: return each node as a list of values, and each list of nodes as
+            {fields: [...], rows: [[...], ...]}, so keys aren't repeated
+        limit: match at most $castnet_max_rows top level nodes
+        """
+        if self.graphql_compiler == "projection":
+            return self._ast_to_projection(query, p_varname, collect, rows, limit)
         cypher = ""
         # top level, some special rules
         if isinstance(query, list):  # top level, slightly special rules
@@ -678,7 +2160,9 @@ class CastNetConn:
             for i, single_query in enumerate(query):
                 returns.append(single_query["name"])
                 cypher += "CALL (){\n"
-                cypher += self._ast_to_cypher(single_query, p_varname=p_varname)
+                cypher += self._ast_to_cypher(
+                    single_query, p_varname=p_varname, rows=rows, limit=limit
+                )
                 cypher += "\n}\n"
             cypher += "RETURN " + ",".join(returns)
             return cypher
@@ -692,26 +2176,38 @@ class CastNetConn:
         cypher += f"MATCH ({c_varname}:{label}"
 
         # this is an insecure hack to allow for conditions
-        if "condition" in query:
-            cypher += " {" + query["condition"][1:-1] + "}"
+        cypher += self._condition_cypher(query)
         cypher += ")"
         if "dir" in query:
             rel = query["rel"]
+            # hops, e.g. "2" or "1..", makes it a variable length relationship
+            if "hops" in query:
+                rel += "*" + query["hops"]
             arrows = ("-", "->") if query["dir"].lower() == "in" else ("<-", "-")
             cypher += f"{arrows[0]}[r:{rel}]{arrows[1]}({p_varname}_s)"
+        if limit:
+            cypher += f"\nWITH {c_varname} LIMIT ${MAX_ROWS_PARAM}"
 
         cypher += f"\nUNWIND {c_varname} as {c_varname + '_s'}"
         for rel in relationships:
             cypher += f"\nCALL ({c_varname+'_s'}){{\nWITH {c_varname+'_s'}\n"
-            cypher += self._ast_to_cypher(rel, c_varname)
+            cypher += self._ast_to_cypher(rel, c_varname, rows=rows)
             cypher += "\n}"
 
+        if rows:
+            fields = self._ast_fields(query, c_varname)
+            values = "[" + ",".join(value for _, value in fields) + "]"
+            if collect:
+                names = ",".join(f"'{field}'" for field, _ in fields)
+                values = f"{{fields: [{names}], rows: COLLECT({values})}}"
+            return cypher + f"\nRETURN {values} as {name}"
+
         # create a return collect with attributes and subqueries
-        cypher += "\nRETURN COLLECT({"
+        cypher += "\nRETURN COLLECT({" if collect else "\nRETURN {"
         attr_str = [f"{attr}: {c_varname}.{attr}" for attr in attributes]
 
         cypher += ",".join(attr_str)
-        if "dir" in query and "__order" in attributes:
+        if "dir" in query and "hops" not in query and "__order" in attributes:
             cypher += ",__order: r.order_num"
 
         rel_str = [rel["name"] + ": " + rel["name"] for rel in relationships]
@@ -719,10 +2215,106 @@ class CastNetConn:
             if attr_str:
                 cypher += ','
             cypher += ",".join(rel_str)
-        cypher += "}) as " + name
+        cypher += ("})" if collect else "}") + " as " + name
 
         return cypher
 
+    def _ast_to_projection(self, query, p_varname="a", collect=True, rows=False, limit=False):
+        """
+        Translates graphql ast to cypher like _ast_to_cypher, projecting each
+        top level node with a map projection and each relationship field with
+        a pattern comprehension, so no level multiplies rows:
+
+        MATCH (a_1:House)
+        RETURN COLLECT(a_1 {.name, descendantFeeder: [(a_1_1:Feeder)-[r:IS_IN*1]->(a_1) | a_1_1 {.height}]}) as House
+        """
+        if isinstance(query, list):
+            returns = []
+            cypher = ""
+            for single_query in query:
+                returns.append(single_query["name"])
+                cypher += "CALL (){\n"
+                cypher += self._ast_to_projection(single_query, p_varname, rows=rows, limit=limit)
+                cypher += "\n}\n"
+            return cypher + "RETURN " + ",".join(returns)
+        c_varname = p_varname + "_1"
+        cypher = f"MATCH ({c_varname}:{query['label']}"
+        # this is an insecure hack to allow for conditions
+        cypher += self._condition_cypher(query)
+        cypher += ")"
+        if limit:
+            cypher += f"\nWITH {c_varname} LIMIT ${MAX_ROWS_PARAM}"
+        value = self._projection(query, c_varname, rows)
+        if collect:
+            value = f"COLLECT({value})"
+            if rows:
+                value = f"{{fields: {self._field_names(query)}, rows: {value}}}"
+        return cypher + f"\nRETURN {value} as {query['name']}"
+
+    @staticmethod
+    def _field_names(query):
+        """A cypher list of the field names of a single query of a graphql ast"""
+        return "[" + ",".join(f"'{field}'" for field, _ in CastNetConn._ast_fields(query)) + "]"
+
+    def _projection(self, query, c_varname, rows=False):
+        """
+        The cypher value of a node of a single query of a graphql ast: a map
+        projection, or a list of values for rows
+        """
+        ordered = "dir" in query and "hops" not in query
+        fields = []
+        for attr in query["attributes"]:
+            if isinstance(attr, str):
+                order = attr == "__order" and ordered
+                fields.append((attr, f"r_{c_varname}.order_num" if order else None))
+        for attr in query["attributes"]:
+            if isinstance(attr, dict):
+                fields.append((attr["name"], self._comprehension(attr, c_varname, rows)))
+        if rows:
+            values = [value or f"{c_varname}.{field}" for field, value in fields]
+            return "[" + ",".join(values) + "]"
+        entries = [f"{field}: {value}" if value else "." + field for field, value in fields]
+        return f"{c_varname} {{" + ", ".join(entries) + "}"
+
+    def _comprehension(self, query, p_varname, rows=False):
+        """
+        The pattern comprehension of a relationship field of a graphql ast,
+        relationship variables are named after their node so nested
+        comprehensions don't bind their parents'
+        """
+        c_varname = p_varname + "_1"
+        node = f"({c_varname}:{query['label']}" + self._condition_cypher(query) + ")"
+        rel = query["rel"]
+        if "hops" in query:
+            rel += "*" + query["hops"]
+        arrows = ("-", "->") if query["dir"].lower() == "in" else ("<-", "-")
+        pattern = f"{node}{arrows[0]}[r_{c_varname}:{rel}]{arrows[1]}({p_varname})"
+        value = f"[{pattern} | {self._projection(query, c_varname, rows)}]"
+        if rows:
+            value = f"{{fields: {self._field_names(query)}, rows: {value}}}"
+        return value
+
+    def _condition_cypher(self, query):
+        """
+        The property map of a query's condition, e.g. ' {name: "a"}'. In native
+        temporal mode values of date and datetime attributes, strings or
+        $variables, are cast with date() or datetime() to match what is stored.
+        """
+        if "condition" not in query:
+            return ""
+        condition = query["condition"][1:-1]
+        if self.temporal != "native":
+            return " {" + condition + "}"
+        attributes = self.schema[query["label"]]["attributes"]
+        pairs = []
+        for match in CONDITION_PAIR.finditer(condition):
+            key, value = match.group(1), match.group(2).strip()
+            param_type = attributes.get(key)
+            if param_type in [date, datetime]:
+                value = f"{param_type.__name__}({value})"
+            pairs.append(f"{key}: {value}")
+        return " {" + ", ".join(pairs) + "}"
+
     def _gql_to_ast(self, query_str, label=None):
         """
         Parses a graphql request and converts to an ast. See unit tests for example
@@ -774,6 +2366,8 @@ class CastNetConn:
                         "rel": self.schema[label]["graphql"][token]["rel"],
                     },
                 )
+                if "hops" in self.schema[label]["graphql"][token]:
+                    parsed_subquery["hops"] = self.schema[label]["graphql"][token]["hops"]
 
             # check if the new label is in the schema, else complain
             if subquery_label not in self.schema:
@@ -873,16 +2467,112 @@ class CastNetConn:
         yield None, None
 
 
+class IdGenerator:
+    """
+    Generates node ids in the same format as gen_id. The alphabet, timezone,
+    date and sanitizer are cached, so ids for bulk loads can be made in one call.
+    """
+
+    # remove for gcp bucket and uri compatibility
+    DISALLOWED = '\\\n\t/_*?"<>|.: #&+'
+
+    def __init__(self, length=8, timezone="US/Eastern"):
+        import pytz  # pylint: disable=import-outside-toplevel
+        import shortuuid  # pylint: disable=import-outside-toplevel
+
+        self.length = length
+        self.alphabet = shortuuid.ShortUUID().get_alphabet()
+        self.timezone = pytz.timezone(timezone)
+        self._sanitizer = str.maketrans("", "", self.DISALLOWED)
+        # random bytes are mapped onto the alphabet, bytes at or above the limit
+        # are dropped so every character is equally likely (like secrets.choice)
+        limit = 256 - 256 % len(self.alphabet)
+        self._byte_table = bytes(
+            ord(self.alphabet[b % len(self.alphabet)]) for b in range(256)
+        )
+        self._rejected_bytes = bytes(range(limit, 256))
+        self._datestr = None
+        self._date_expires = 0.0
+
+    def datestr(self):
+        """Today's date in the generator's timezone, recomputed after midnight"""
+        if time.time() >= self._date_expires:
+            now = datetime.now(tz=self.timezone)
+            midnight = self.timezone.localize(
+                datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+            )
+            self._datestr = now.strftime("%Y%m%d")
+            self._date_expires = midnight.timestamp()
+        return self._datestr
+
+    def random(self, count=1):
+        """Returns count * length cryptographically secure random characters"""
+        needed = count * self.length
+        chars = b""
+        while len(chars) < needed:
+            # about 11% of bytes are rejected, ask for a little extra
+            data = secrets.token_bytes((needed - len(chars)) * 9 // 8 + 8)
+            chars += data.translate(self._byte_table, self._rejected_bytes)
+        return chars[:needed].decode("ascii")
+
+    def sanitize(self, name):
+        """Removes characters which aren't uri or bucket compatible"""
+        return str(name).translate(self._sanitizer)
+
+    def gen_id(self, label, name):
+        """Generates an ID for a node"""
+        return f"{label}__{self.datestr()}__{self.sanitize(name)}__{self.random()}"
+
+    def gen_ids(self, label, names):
+        """Generates a list of IDs for nodes of one label"""
+        names = list(names)
+        uuids = self.random(len(names))
+        datestr = self.datestr()
+        length = self.length
+        return [
+            f"{label}__{datestr}__{self.sanitize(name)}__{uuids[i * length:(i + 1) * length]}"
+            for i, name in enumerate(names)
+        ]
+
+
+def compile_schema(schema):
+    """
+    Parses a schema once into a CompiledSchema (see castnet.schema), which
+    connections use as is and which can be saved for later workers
+    """
+    return CompiledSchema(
+        {label: LabelSpec(**spec) for label, spec in CastNetConn._parse_schema(schema).items()},
+        __version__,
+    )
+
+
+def load_schema(path):
+    """Loads a compiled schema saved by CompiledSchema.save"""
+    compiled = CompiledSchema.load(path)
+    if compiled.version != __version__:
+        raise ValueError(
+            f"{path} was compiled by castnet {compiled.version}, compile it again."
+        )
+    return compiled
+
+
+_ID_GENERATOR = None
+
+
 def gen_id(label, name):
     """Generates and ID for a node"""
-    name = str(name)
-    uuid = shortuuid.ShortUUID().random(length=8)
-    # remove for gcp bucket and uri compatibility
-    disallowed = '\\\n\t/_*?"<>|.: #&+'
-    for character in disallowed:
-        name = name.replace(character, "")
-    datestr = datetime.now(tz=pytz.timezone("US/Eastern")).strftime("%Y%m%d")
-    return f"{label}__{datestr}__{name}__{uuid}"
+    global _ID_GENERATOR  # pylint: disable=global-statement
+    if _ID_GENERATOR is None:
+        _ID_GENERATOR = IdGenerator()
+    return _ID_GENERATOR.gen_id(label, name)
+
+
+def gen_ids(label, names):
+    """Generates IDs for a list of node names"""
+    global _ID_GENERATOR  # pylint: disable=global-statement
+    if _ID_GENERATOR is None:
+        _ID_GENERATOR = IdGenerator()
+    return _ID_GENERATOR.gen_ids(label, names)
 
 
 def convert_datetime(value):
@@ -0,0 +1,5 @@
+import sys
+
+from castnet.cli import main
+
+sys.exit(main())
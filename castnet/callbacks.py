@@ -0,0 +1,249 @@
+"""
+Execution of schema callbacks.
+
+Callbacks run synchronously at the end of generic_post, generic_patch and
+generic_delete unless they set a mode:
+
+"callbacks": [{
+    "callback": sync_to_bucket,
+    "methods": ["POST", "PATCH"],
+    "attributes": ["filePath"],
+    "mode": "thread",  # "sync" (default), "thread" or "process"
+    "queue_limit": 100,  # calls queued or running at once
+    "block": 1.0,  # seconds to wait for a queue slot before rejecting the call
+    "timeout": 30,  # seconds per attempt
+    "retries": 2,  # extra attempts after a failure or timeout
+    "retry_delay": 0.5,  # seconds, doubled after every attempt
+}]
+
+Background calls never fail the request. Their failures are counted, and
+CastNetConn.close() waits for queued calls to finish.
+"""
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+CALLBACK_MODES = ["sync", "thread", "process"]
+
+
+def callback_name(callback):
+    """Name used for a callback's counters"""
+    if "name" in callback:
+        return callback["name"]
+    func = callback["callback"]
+    return f"{getattr(func, '__module__', '')}.{getattr(func, '__qualname__', repr(func))}"
+
+
+class CallbackStats:
+    """
+    Latency and failure counters of a single callback
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_error = None
+
+    def add(self, **counts):
+        """Increments counters"""
+        with self._lock:
+            for key, value in counts.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def attempt(self, seconds, error=None, timed_out=False):
+        """Records an attempt"""
+        with self._lock:
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            if timed_out:
+                self.timeouts += 1
+            elif error is not None:
+                self.errors += 1
+                self.last_error = repr(error)
+
+    def as_dict(self):
+        """Counters, suitable for json"""
+        with self._lock:
+            attempts = self.succeeded + self.errors + self.timeouts
+            return {
+                "calls": self.calls,
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "retries": self.retries,
+                "rejected": self.rejected,
+                "inFlight": self.in_flight,
+                "meanSeconds": self.total_seconds / attempts if attempts else None,
+                "maxSeconds": self.max_seconds,
+                "lastError": self.last_error,
+            }
+
+
+class CallbackDispatcher:
+    """
+    Runs callbacks inline or on bounded thread and process pools.
+    Pools are only started when a callback needs them.
+    """
+
+    def __init__(self, thread_workers=4, process_workers=2):
+        self.thread_workers = thread_workers
+        self.process_workers = process_workers
+        self.stats = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+        self._executors = {}
+        self._closed = False
+
+    def _get(self, callback):
+        """Returns the stats and queue slots of a callback"""
+        name = callback_name(callback)
+        with self._lock:
+            if name not in self.stats:
+                self.stats[name] = CallbackStats()
+                self._slots[name] = threading.BoundedSemaphore(
+                    callback.get("queue_limit", 100)
+                )
+            return self.stats[name], self._slots[name]
+
+    def _executors_for(self, mode):
+        """
+        The supervisor pool and the pool of a mode, created under the lock close
+        takes, so close shuts down every pool a call can use
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The callback dispatcher is closed.")
+            for kind in ["supervisor", mode]:
+                if kind in self._executors:
+                    continue
+                if kind == "process":
+                    self._executors[kind] = ProcessPoolExecutor(self.process_workers)
+                elif kind == "thread":
+                    self._executors[kind] = ThreadPoolExecutor(
+                        self.thread_workers, thread_name_prefix="castnet-callback"
+                    )
+                else:
+                    # supervisors wait on attempts, one per queued or running call
+                    self._executors[kind] = ThreadPoolExecutor(
+                        thread_name_prefix="castnet-supervisor"
+                    )
+            return self._executors["supervisor"], self._executors[mode]
+
+    def dispatch(self, callback, params):
+        """
+        Runs a callback according to its mode. Sync callbacks raise like before,
+        background callbacks return a future, or None if the call was rejected.
+        """
+        mode = callback.get("mode", "sync")
+        if mode not in CALLBACK_MODES:
+            raise ValueError(f"Callback mode must be one of {CALLBACK_MODES}.")
+        stats, slots = self._get(callback)
+        stats.add(calls=1)
+        if mode == "sync":
+            started = time.monotonic()
+            try:
+                callback["callback"](params)
+            except Exception as err:
+                stats.attempt(time.monotonic() - started, err)
+                stats.add(failed=1)
+                raise
+            stats.attempt(time.monotonic() - started)
+            stats.add(succeeded=1)
+            return None
+
+        supervisors, executor = self._executors_for(mode)
+        # backpressure, wait for a free slot in the callback's queue
+        if not slots.acquire(timeout=callback.get("block", 1.0)):
+            stats.add(rejected=1)
+            return None
+        stats.add(in_flight=1)
+        try:
+            return supervisors.submit(
+                self._supervise, callback, dict(params), executor, stats, slots
+            )
+        except RuntimeError:
+            # closed while waiting for the slot
+            stats.add(in_flight=-1)
+            slots.release()
+            raise
+
+    def _supervise(self, callback, params, executor, stats, slots):
+        """Runs the attempts of a background call, returns True on success"""
+        abandoned = []
+        try:
+            attempts = 1 + callback.get("retries", 0)
+            delay = callback.get("retry_delay", 0.5)
+            for attempt in range(attempts):
+                if attempt:
+                    stats.add(retries=1)
+                    time.sleep(delay * 2 ** (attempt - 1))
+                started = time.monotonic()
+                future = executor.submit(callback["callback"], params)
+                try:
+                    future.result(timeout=callback.get("timeout"))
+                except FutureTimeout:
+                    # the attempt can't be interrupted, it is abandoned
+                    stats.attempt(time.monotonic() - started, timed_out=True)
+                    abandoned.append(future)
+                    continue
+                except Exception as err:  # pylint: disable=broad-except
+                    stats.attempt(time.monotonic() - started, err)
+                    continue
+                stats.attempt(time.monotonic() - started)
+                stats.add(succeeded=1)
+                return True
+            stats.add(failed=1)
+            return False
+        finally:
+            self._release_after(abandoned, stats, slots)
+
+    @staticmethod
+    def _release_after(abandoned, stats, slots):
+        """
+        Frees a call's queue slot once its abandoned attempts finish too, they
+        still take a worker until then
+        """
+        if not abandoned:
+            stats.add(in_flight=-1)
+            slots.release()
+            return
+        remaining = [len(abandoned)]
+        lock = threading.Lock()
+
+        def finished(_future):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            stats.add(in_flight=-1)
+            slots.release()
+
+        for future in abandoned:
+            future.add_done_callback(finished)
+
+    def metrics(self):
+        """Counters of every callback that has run, by name"""
+        with self._lock:
+            stats = dict(self.stats)
+        return {name: value.as_dict() for name, value in stats.items()}
+
+    def close(self, wait=True):
+        """Stops accepting calls and, by default, drains queued calls"""
+        with self._lock:
+            self._closed = True
+            executors = dict(self._executors)
+        # supervisors first, so no attempts are submitted to closed pools
+        for kind in ["supervisor", "thread", "process"]:
+            if kind in executors:
+                executors[kind].shutdown(wait=wait)
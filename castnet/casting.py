@@ -0,0 +1,213 @@
+"""
+Column-wise casting of values to schema attribute types.
+
+convert_datetime and parse_params cast one value at a time and find the date
+format by raising exceptions. For bulk data the format of a column is detected
+once from a sample and the whole column is cast on a fast path. Results match
+parse_params: dates and datetimes become ISO strings.
+
+With temporal="native" (see CastNetConn) dates and datetimes are stored as
+Neo4j temporal values instead: to_temporal casts values for writing, and
+castnet.encoding turns what the database returns back into ISO strings.
+"""
+import re
+from datetime import date, datetime, timezone
+
+try:
+    import numpy
+except ImportError:  # numpy is optional
+    numpy = None
+
+ISO = "iso"
+# the formats accepted by convert_datetime, in the order it tries them
+DATE_FORMATS = [ISO, "%m/%d/%y %H:%M", "%m/%d/%Y %H:%M", "%m/%d/%Y"]
+SAMPLE_SIZE = 100
+# the only dates handed to numpy, which also takes "2021", "2021-03", "today"
+# and datetimes, all of which date.fromisoformat rejects
+_ISO_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+_PATTERNS = {
+    "%m/%d/%y %H:%M": re.compile(r"(\d{1,2})/(\d{1,2})/(\d{2}) (\d{1,2}):(\d{1,2})"),
+    "%m/%d/%Y %H:%M": re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4}) (\d{1,2}):(\d{1,2})"),
+    "%m/%d/%Y": re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4})"),
+}
+
+
+def _is_empty(value):
+    return value is None or value == ""
+
+
+def _parser(fmt, param_type):
+    """Returns a function converting a single string in fmt to param_type"""
+    if fmt == ISO:
+        return param_type.fromisoformat
+    pattern = _PATTERNS[fmt]
+    two_digit_year = "%y" in fmt
+
+    def parse(value):
+        match = pattern.fullmatch(value)
+        if not match:
+            raise ValueError(f"'{value}' does not match {fmt}")
+        parts = [int(p) for p in match.groups()]
+        month, day, year = parts[:3]
+        if two_digit_year:
+            # same pivot as strptime's %y
+            year += 1900 if year >= 69 else 2000
+        if param_type is date:
+            return date(year, month, day)
+        return datetime(year, month, day, *parts[3:])
+
+    return parse
+
+
+def detect_format(values, param_type, sample_size=SAMPLE_SIZE):
+    """
+    Detects the date format of a column from a sample of its non empty values.
+    Returns the format parsing the most of the sample, ISO when in doubt.
+    """
+    sample = []
+    for value in values:
+        if not _is_empty(value):
+            sample.append(value)
+            if len(sample) >= sample_size:
+                break
+    best, best_count = ISO, -1
+    for fmt in DATE_FORMATS:
+        parse = _parser(fmt, param_type)
+        count = 0
+        for value in sample:
+            try:
+                parse(value)
+                count += 1
+            except (ValueError, TypeError):
+                pass
+        if count > best_count:
+            best, best_count = fmt, count
+        if count == len(sample):
+            break
+    return best
+
+
+def _numpy_dates(values):
+    """
+    Casts ISO date strings with numpy, returns None if numpy can't take them all
+    """
+    if not all(isinstance(value, str) and _ISO_DATE.fullmatch(value) for value in values):
+        return None
+    try:
+        array = numpy.array(values, dtype="datetime64[D]")
+    except (ValueError, TypeError):
+        return None
+    if numpy.isnat(array).any():
+        return None
+    return numpy.datetime_as_string(array).tolist()
+
+
+def cast_column(values, param_type, fmt=None, sample_size=SAMPLE_SIZE):
+    """
+    Casts a column of values to a schema attribute type.
+    Empty values ("" or None) become None.
+
+    Returns a tuple (cast_values, failed), where failed is a list of the
+    indexes of values which couldn't be cast (their cast value is None).
+
+    Example:
+    cast_column(["01/02/2021", "", "13/40/2021"], date)
+    (["2021-01-02", None, None], [2])
+    """
+    values = list(values)
+    cast = [None] * len(values)
+    failed = []
+    present = [i for i, value in enumerate(values) if not _is_empty(value)]
+
+    if param_type in [datetime, date]:
+        fmt = fmt or detect_format(values, param_type, sample_size)
+        if fmt == ISO and param_type is date and numpy is not None and present:
+            converted = _numpy_dates([values[i] for i in present])
+            if converted is not None:
+                for i, value in zip(present, converted):
+                    cast[i] = value
+                return cast, failed
+        parse = _parser(fmt, param_type)
+        to_iso = param_type.isoformat
+        for i in present:
+            try:
+                cast[i] = to_iso(parse(values[i]))
+            except (ValueError, TypeError):
+                failed.append(i)
+        return cast, failed
+
+    # fast path, fall back to value by value when something doesn't convert
+    try:
+        converted = list(map(param_type, [values[i] for i in present]))
+    except (ValueError, TypeError):
+        converted = None
+    if converted is not None:
+        for i, value in zip(present, converted):
+            cast[i] = value
+        return cast, failed
+    for i in present:
+        try:
+            cast[i] = param_type(values[i])
+        except (ValueError, TypeError):
+            failed.append(i)
+    return cast, failed
+
+
+def to_temporal(value, param_type):
+    """
+    Casts an ISO string (or a date/datetime) to a native date or datetime.
+    Datetimes without a time zone are taken as UTC, as Neo4j's datetime() does.
+    """
+    if isinstance(value, str):
+        value = param_type.fromisoformat(value)
+    elif param_type is date and isinstance(value, datetime):
+        value = value.date()
+    elif not isinstance(value, param_type):
+        raise ValueError(f"'{value}' is not a {param_type.__name__}")
+    if param_type is datetime and value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+class ColumnCaster:
+    """
+    Casts rows column by column for a label's attributes, remembering the date
+    format detected for each column so later chunks skip detection.
+    """
+
+    def __init__(self, attributes):
+        self.attributes = attributes
+        self.formats = {}
+
+    def cast_rows(self, rows):
+        """
+        Casts the attributes of a list of dict rows in place.
+        Returns {row_index: error message} for rows with values that failed.
+        """
+        errors = {}
+        keys = set()
+        for row in rows:
+            keys.update(row)
+        for key in keys:
+            param_type = self.attributes.get(key)
+            if param_type is None:
+                continue
+            positions = [i for i, row in enumerate(rows) if key in row]
+            values = [rows[i][key] for i in positions]
+            fmt = self.formats.get(key)
+            if param_type in [datetime, date] and fmt is None:
+                fmt = detect_format(values, param_type)
+                # a blank sample says nothing, detect again on the next chunk
+                if not all(_is_empty(value) for value in values):
+                    self.formats[key] = fmt
+            cast, failed = cast_column(values, param_type, fmt)
+            for i, value in zip(positions, cast):
+                rows[i][key] = value
+            for i in failed:
+                errors.setdefault(
+                    positions[i],
+                    f"For label '{key}', '{values[i]}' is not suitable. Must be"
+                    f" convertible to {param_type}.",
+                )
+        return errors
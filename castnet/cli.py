@@ -0,0 +1,239 @@
+"""
+Command line entry point, e.g.
+
+castnet import --schema birds.schema:SCHEMA House=houses.ndjson Feeder=feeders.csv
+castnet export --schema birds.schema:SCHEMA --out backup --archived --history --gzip
+castnet loadtest --schema birds.schema:SCHEMA --workers 16 --duration 10
+"""
+import argparse
+import importlib
+import json
+import os
+import sys
+
+from castnet import CastNetConn
+
+
+def load_object(spec):
+    """Loads an object from a 'package.module:ATTRIBUTE' string"""
+    module_name, _, attribute = spec.partition(":")
+    if not attribute:
+        raise ValueError(f"'{spec}' must look like 'package.module:ATTRIBUTE'.")
+    sys.path.insert(0, os.getcwd())
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def connect(args):
+    """Creates a CastNetConn from the common arguments"""
+    schema = load_object(args.schema)
+    url_key = load_object(args.url_key) if args.url_key else {}
+    return CastNetConn(args.uri, args.user, args.password, schema, url_key)
+
+
+def _add_connection_args(parser):
+    parser.add_argument(
+        "--schema",
+        required=True,
+        help="Schema to use, as 'package.module:SCHEMA'",
+    )
+    parser.add_argument("--url-key", help="URL key, as 'package.module:URL_KEY'")
+    parser.add_argument("--uri", default=os.environ.get("NEO4J_URI"))
+    parser.add_argument("--user", default=os.environ.get("NEO4J_USER", "neo4j"))
+    parser.add_argument("--password", default=os.environ.get("NEO4J_PASSWORD"))
+
+
+def _label_path(value):
+    label, sep, path = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"'{value}' must look like Label=path")
+    return label, path
+
+
+def run_import(args):
+    """castnet import"""
+    from castnet.importer import (  # pylint: disable=import-outside-toplevel
+        import_export,
+        import_files,
+    )
+
+    if bool(args.files) == bool(args.from_export):
+        print("Specify either Label=path files or --from-export.", file=sys.stderr)
+        return 2
+    conn = connect(args)
+    for directory in [args.checkpoint_dir, args.rejects_dir]:
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def progress(report):
+        print(f"\r{report}", end="", file=sys.stderr, flush=True)
+
+    kwargs = {
+        "checkpoint_dir": args.checkpoint_dir,
+        "rejects_dir": args.rejects_dir,
+        "batch_size": args.batch_size,
+        "workers": args.workers,
+        "processes": not args.threads,
+        "requester": args.requester,
+        "progress": progress,
+    }
+    try:
+        if args.from_export:
+            reports = import_export(conn, args.from_export, **kwargs)
+        else:
+            reports = import_files(
+                conn,
+                args.files,
+                fmt=args.format,
+                history=not args.no_history,
+                **kwargs,
+            )
+    finally:
+        conn.close()
+    print(file=sys.stderr)
+    for report in reports:
+        print(report)
+    return 1 if any(report.rows_rejected for report in reports) else 0
+
+
+def run_export(args):
+    """castnet export"""
+    from castnet.exporter import export_all  # pylint: disable=import-outside-toplevel
+
+    conn = connect(args)
+    try:
+        export_all(
+            conn,
+            args.out,
+            labels=args.labels,
+            include_archived=args.archived,
+            include_history=args.history,
+            compress=args.gzip,
+            page_size=args.page_size,
+            progress=lambda label, rows: print(f"{label}: {rows} rows"),
+        )
+    finally:
+        conn.close()
+    return 0
+
+
+def run_loadtest(args):
+    """castnet loadtest"""
+    from castnet.loadtest import (  # pylint: disable=import-outside-toplevel
+        parse_mix,
+        run_loadtest as loadtest,
+    )
+    from castnet.memory import MEMORY_SCHEME  # pylint: disable=import-outside-toplevel
+
+    args.uri = args.uri or MEMORY_SCHEME + "loadtest"
+    conn = connect(args)
+    if args.fault_rate:
+        if not args.uri.startswith(MEMORY_SCHEME):
+            print("--fault-rate needs a memory:// uri.", file=sys.stderr)
+            return 2
+        driver = conn._get_driver()  # pylint: disable=protected-access
+        driver.server.inject_fault(times=-1, probability=args.fault_rate)
+    try:
+        report = loadtest(
+            conn,
+            workers=args.workers,
+            duration=None if args.operations else args.duration,
+            operations=args.operations,
+            mix=parse_mix(args.mix),
+            mode=args.mode,
+            labels=args.labels,
+            seed=args.seed,
+            random_seed=args.random_seed,
+        )
+    finally:
+        if args.fault_rate:
+            conn.driver.server.clear_faults()
+        conn.close()
+    print(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as handle:
+            json.dump(report.as_dict(), handle, indent=2)
+    return 0
+
+
+def build_parser():
+    """Builds the argument parser"""
+    parser = argparse.ArgumentParser(prog="castnet")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    importer = subparsers.add_parser(
+        "import", help="Bulk import NDJSON/CSV files, one label per file"
+    )
+    _add_connection_args(importer)
+    importer.add_argument(
+        "files",
+        nargs="*",
+        type=_label_path,
+        help="Label=path pairs, imported in order (parents first)",
+    )
+    importer.add_argument(
+        "--from-export", help="Restore a directory written by castnet export"
+    )
+    importer.add_argument("--format", choices=["ndjson", "csv"])
+    importer.add_argument("--batch-size", type=int, default=1000)
+    importer.add_argument("--workers", type=int, default=4)
+    importer.add_argument(
+        "--threads", action="store_true", help="Use threads instead of processes"
+    )
+    importer.add_argument(
+        "--checkpoint-dir", help="Directory for checkpoints, rerun to resume"
+    )
+    importer.add_argument("--rejects-dir", help="Directory for rejected rows")
+    importer.add_argument("--no-history", action="store_true")
+    importer.add_argument("--requester", help="Email recorded in the history")
+    importer.set_defaults(func=run_import)
+
+    exporter = subparsers.add_parser(
+        "export", help="Stream labels to NDJSON files, one file per label"
+    )
+    _add_connection_args(exporter)
+    exporter.add_argument("--out", required=True, help="Output directory")
+    exporter.add_argument("--labels", nargs="+", help="Labels to export, default all")
+    exporter.add_argument(
+        "--archived", action="store_true", help="Include _archived_ nodes"
+    )
+    exporter.add_argument(
+        "--history", action="store_true", help="Include historyRecord nodes"
+    )
+    exporter.add_argument("--gzip", action="store_true")
+    exporter.add_argument("--page-size", type=int, default=1000)
+    exporter.set_defaults(func=run_export)
+
+    load = subparsers.add_parser(
+        "loadtest", help="Drive concurrent generic endpoint calls and report latency"
+    )
+    _add_connection_args(load)
+    load.add_argument("--workers", type=int, default=8)
+    load.add_argument("--mode", choices=["threads", "asyncio"], default="threads")
+    load.add_argument("--duration", type=float, default=10.0, help="Seconds to run")
+    load.add_argument("--operations", type=int, help="Total calls, instead of --duration")
+    load.add_argument(
+        "--mix",
+        default="post=4,patch=4,delete=1,graphql=1",
+        help="Weights of post, patch, delete and graphql calls",
+    )
+    load.add_argument("--labels", nargs="+", help="Labels to exercise, default all")
+    load.add_argument("--seed", type=int, default=4, help="Nodes seeded per label")
+    load.add_argument("--random-seed", type=int)
+    load.add_argument(
+        "--fault-rate",
+        type=float,
+        help="Chance of a retryable failure per query (memory:// only)",
+    )
+    load.add_argument("--json", help="Write the report as json to this file")
+    load.set_defaults(func=run_loadtest)
+    return parser
+
+
+def main(argv=None):
+    """Runs the castnet command"""
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
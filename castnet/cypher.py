@@ -0,0 +1,2591 @@
+"""
+An in-memory property graph and an interpreter for the subset of Cypher castnet
+generates, used by castnet.memory to stand in for a Neo4j server.
+
+Supported: MATCH/OPTIONAL MATCH (labels, inline properties, variable length
+relationships, path variables), WHERE, WITH and RETURN (DISTINCT, aggregation,
+ORDER BY, SKIP, LIMIT), UNWIND, CREATE, MERGE, SET, REMOVE, DELETE/DETACH DELETE,
+FOREACH, CALL subqueries (including IN TRANSACTIONS), UNION [ALL], EXISTS/COUNT/
+COLLECT subqueries, list and pattern comprehensions, map projections, CASE,
+common functions, and index/constraint statements.
+
+Errors are raised as CypherError with a Neo4j status code.
+"""
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import timezone
+from functools import lru_cache
+
+from neo4j import time as neo4j_time
+
+_MISSING = object()
+
+SYNTAX_ERROR = "Neo.ClientError.Statement.SyntaxError"
+TYPE_ERROR = "Neo.ClientError.Statement.TypeError"
+SEMANTIC_ERROR = "Neo.ClientError.Statement.SemanticError"
+ARGUMENT_ERROR = "Neo.ClientError.Statement.ArgumentError"
+PARAMETER_MISSING = "Neo.ClientError.Statement.ParameterMissing"
+ACCESS_MODE = "Neo.ClientError.Statement.AccessMode"
+CONSTRAINT_FAILED = "Neo.ClientError.Schema.ConstraintValidationFailed"
+SCHEMA_EXISTS = "Neo.ClientError.Schema.EquivalentSchemaRuleAlreadyExists"
+SCHEMA_MISSING = "Neo.ClientError.Schema.IndexNotFound"
+TIMED_OUT = "Neo.ClientError.Transaction.TransactionTimedOutClientConfiguration"
+
+
+class CypherError(Exception):
+    """A query failed, code is the Neo4j status code"""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+#######
+# Graph
+#######
+class Node:
+    """A node of the in-memory graph"""
+
+    __slots__ = ("id", "element_id", "labels", "props", "out", "inc", "deleted")
+
+    def __init__(self, id_, element_id, labels, props):
+        self.id = id_
+        self.element_id = element_id
+        self.labels = dict.fromkeys(labels)
+        self.props = props
+        self.out = {}
+        self.inc = {}
+        self.deleted = False
+
+    def __repr__(self):
+        return f"<Node {self.element_id} {list(self.labels)} {self.props}>"
+
+
+class Relationship:
+    """A relationship of the in-memory graph"""
+
+    __slots__ = ("id", "element_id", "type", "start", "end", "props", "deleted")
+
+    def __init__(self, id_, element_id, type_, start, end, props):
+        self.id = id_
+        self.element_id = element_id
+        self.type = type_
+        self.start = start
+        self.end = end
+        self.props = props
+        self.deleted = False
+
+    def other(self, node):
+        """The node at the other end"""
+        return self.start if self.end is node else self.end
+
+    def __repr__(self):
+        return f"<Relationship {self.element_id} {self.type} {self.props}>"
+
+
+class Path:
+    """A path, a start node followed by relationships"""
+
+    __slots__ = ("start", "rels")
+
+    def __init__(self, start, rels):
+        self.start = start
+        self.rels = rels
+
+    @property
+    def nodes(self):
+        nodes = [self.start]
+        for rel in self.rels:
+            nodes.append(rel.other(nodes[-1]))
+        return nodes
+
+
+class Graph:
+    """
+    Nodes and relationships of one database, with label and property indexes.
+    Every change takes an undo list, to which the change's inverse is appended.
+    """
+
+    def __init__(self, name="neo4j"):
+        self.name = name
+        self.nodes = {}
+        self.rels = {}
+        self.labels = {}
+        # nodes by their id property, castnet's key, whatever their label
+        self.ids = {}
+        # nodes by (label, property) for declared indexes and constraints
+        self.values = {}
+        self.unique = {}
+        self.schema = {}
+        self.lock = threading.RLock()
+        self._last_id = 0
+
+    def _new_id(self):
+        self._last_id += 1
+        return self._last_id
+
+    def _element_id(self, id_):
+        return f"4:{self.name}:{id_}"
+
+    # indexes
+    def _index(self, node, key, value, add):
+        if value is _MISSING:
+            return
+        hashed = hashable(value)
+        maps = []
+        if key == "id":
+            maps.append(self.ids)
+        for label in node.labels:
+            if (label, key) in self.values:
+                maps.append(self.values[(label, key)])
+        for values in maps:
+            if add:
+                values.setdefault(hashed, {})[node] = None
+            else:
+                bucket = values.get(hashed)
+                if bucket is not None:
+                    bucket.pop(node, None)
+                    if not bucket:
+                        del values[hashed]
+
+    def _check_unique(self, node, labels, key, value):
+        if value is None or value is _MISSING:
+            return
+        for label in labels:
+            if (label, key) not in self.unique:
+                continue
+            for other in self.values[(label, key)].get(hashable(value), ()):
+                if other is not node:
+                    raise CypherError(
+                        CONSTRAINT_FAILED,
+                        f"Node({other.id}) already exists with label `{label}` and"
+                        f" property `{key}` = {value!r}",
+                    )
+
+    def candidates(self, labels, props):
+        """Nodes which may match labels and props, using the smallest index"""
+        if props:
+            if "id" in props:
+                return list(self.ids.get(hashable(props["id"]), ()))
+            for label in labels:
+                for key, value in props.items():
+                    if (label, key) in self.values:
+                        return list(self.values[(label, key)].get(hashable(value), ()))
+        if labels:
+            smallest = min(labels, key=lambda label: len(self.labels.get(label, ())))
+            return list(self.labels.get(smallest, ()))
+        return list(self.nodes.values())
+
+    # nodes
+    def _link_node(self, node):
+        node.deleted = False
+        self.nodes[node.id] = node
+        for label in node.labels:
+            self.labels.setdefault(label, {})[node] = None
+        for key, value in node.props.items():
+            self._index(node, key, value, True)
+
+    def _unlink_node(self, node):
+        for key, value in node.props.items():
+            self._index(node, key, value, False)
+        for label in node.labels:
+            self.labels[label].pop(node, None)
+        del self.nodes[node.id]
+        node.deleted = True
+
+    def create_node(self, labels, props, undo):
+        """Creates a node"""
+        id_ = self._new_id()
+        node = Node(id_, self._element_id(id_), labels, {})
+        for key, value in props.items():
+            self._check_unique(node, node.labels, key, value)
+        node.props = dict(props)
+        self._link_node(node)
+        undo.append((self._unlink_node, node))
+        return node
+
+    def delete_node(self, node, undo):
+        """Deletes a node, which must not have relationships left"""
+        if node.out or node.inc:
+            raise CypherError(
+                CONSTRAINT_FAILED,
+                f"Cannot delete node<{node.id}>, because it still has relationships."
+                " To delete this node, you must first delete its relationships.",
+            )
+        self._unlink_node(node)
+        undo.append((self._link_node, node))
+
+    # relationships
+    def _link_rel(self, rel):
+        rel.deleted = False
+        self.rels[rel.id] = rel
+        rel.start.out[rel] = None
+        rel.end.inc[rel] = None
+
+    def _unlink_rel(self, rel):
+        del self.rels[rel.id]
+        rel.start.out.pop(rel, None)
+        rel.end.inc.pop(rel, None)
+        rel.deleted = True
+
+    def create_rel(self, type_, start, end, props, undo):
+        """Creates a relationship"""
+        id_ = self._new_id()
+        rel = Relationship(id_, self._element_id(id_), type_, start, end, dict(props))
+        self._link_rel(rel)
+        undo.append((self._unlink_rel, rel))
+        return rel
+
+    def delete_rel(self, rel, undo):
+        """Deletes a relationship"""
+        self._unlink_rel(rel)
+        undo.append((self._link_rel, rel))
+
+    # properties and labels
+    def _put_prop(self, entity, key, value):
+        if isinstance(entity, Node):
+            self._index(entity, key, entity.props.get(key, _MISSING), False)
+            self._index(entity, key, value, True)
+        if value is _MISSING:
+            entity.props.pop(key, None)
+        else:
+            entity.props[key] = value
+
+    def set_prop(self, entity, key, value, undo):
+        """Sets (or with None removes) a property, returns whether it changed"""
+        old = entity.props.get(key, _MISSING)
+        if value is None:
+            if old is _MISSING:
+                return False
+            value = _MISSING
+        elif isinstance(entity, Node):
+            self._check_unique(entity, entity.labels, key, value)
+        self._put_prop(entity, key, value)
+        undo.append((self._put_prop, entity, key, old))
+        return True
+
+    def _put_label(self, node, label, add):
+        for key, value in node.props.items():
+            self._index(node, key, value, False)
+        if add:
+            node.labels[label] = None
+            self.labels.setdefault(label, {})[node] = None
+        else:
+            node.labels.pop(label, None)
+            self.labels[label].pop(node, None)
+        for key, value in node.props.items():
+            self._index(node, key, value, True)
+
+    def add_label(self, node, label, undo):
+        """Adds a label, returns whether it was added"""
+        if label in node.labels:
+            return False
+        for key, value in node.props.items():
+            self._check_unique(node, [label], key, value)
+        self._put_label(node, label, True)
+        undo.append((self._put_label, node, label, False))
+        return True
+
+    def remove_label(self, node, label, undo):
+        """Removes a label, returns whether it was removed"""
+        if label not in node.labels:
+            return False
+        self._put_label(node, label, False)
+        undo.append((self._put_label, node, label, True))
+        return True
+
+    # schema
+    def create_schema(self, kind, name, label, keys, if_not_exists, unique=False):
+        """Creates an index or constraint, returns whether it was created"""
+        for existing_name, spec in self.schema.items():
+            same = (spec["label"], spec["keys"], spec["unique"]) == (label, keys, unique)
+            if existing_name == name or same:
+                if if_not_exists:
+                    return False
+                raise CypherError(
+                    SCHEMA_EXISTS, f"An equivalent {kind} already exists, '{existing_name}'."
+                )
+        indexed = [(label, key) for key in keys]
+        for pair in indexed:
+            if pair not in self.values:
+                values = {}
+                for node in self.labels.get(label, ()):
+                    if pair[1] in node.props:
+                        values.setdefault(hashable(node.props[pair[1]]), {})[node] = None
+                self.values[pair] = values
+        if unique:
+            for pair in indexed:
+                for nodes in self.values[pair].values():
+                    if len(nodes) > 1:
+                        raise CypherError(
+                            CONSTRAINT_FAILED,
+                            f"Unable to create constraint {name}, nodes with label"
+                            f" `{label}` have the same `{pair[1]}`.",
+                        )
+                self.unique[pair] = name
+        self.schema[name] = {
+            "kind": kind,
+            "label": label,
+            "keys": keys,
+            "unique": unique,
+        }
+        return True
+
+    def drop_schema(self, kind, name, if_exists):
+        """Drops an index or constraint, returns whether it was dropped"""
+        spec = self.schema.get(name)
+        if spec is None or spec["kind"] != kind:
+            if if_exists:
+                return False
+            raise CypherError(SCHEMA_MISSING, f"There is no such {kind}: '{name}'.")
+        del self.schema[name]
+        for key in spec["keys"]:
+            pair = (spec["label"], key)
+            if spec["unique"]:
+                self.unique.pop(pair, None)
+            still_used = any(
+                other["label"] == pair[0] and key in other["keys"]
+                for other in self.schema.values()
+            )
+            if not still_used:
+                self.values.pop(pair, None)
+        return True
+
+
+def rollback(undo, mark=0):
+    """Reverts the changes recorded in undo after mark"""
+    while len(undo) > mark:
+        func, *args = undo.pop()
+        func(*args)
+
+
+#######
+# Values
+#######
+def hashable(value):
+    """A hashable key for a value, equal for values Cypher considers equal"""
+    if isinstance(value, bool):
+        return ("b", value)
+    if isinstance(value, (list, tuple)):
+        return ("l", tuple(hashable(v) for v in value))
+    if isinstance(value, dict):
+        return ("m", tuple(sorted((k, hashable(v)) for k, v in value.items())))
+    if isinstance(value, Path):
+        return ("p", value.start, tuple(value.rels))
+    return value
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def equals(left, right):
+    """Cypher equality: True, False or None (unknown)"""
+    if left is None or right is None:
+        return None
+    if isinstance(left, bool) or isinstance(right, bool):
+        return isinstance(left, bool) and isinstance(right, bool) and left is right
+    if _is_number(left) and _is_number(right):
+        return left == right
+    if isinstance(left, (list, tuple)) and isinstance(right, (list, tuple)):
+        if len(left) != len(right):
+            return False
+        result = True
+        for item_l, item_r in zip(left, right):
+            same = equals(item_l, item_r)
+            if same is False:
+                return False
+            if same is None:
+                result = None
+        return result
+    if isinstance(left, dict) and isinstance(right, dict):
+        if set(left) != set(right):
+            return False
+        return equals([left[k] for k in sorted(left)], [right[k] for k in sorted(right)])
+    if isinstance(left, (Node, Relationship)):
+        return left is right
+    if isinstance(left, Path) and isinstance(right, Path):
+        return left.start is right.start and left.rels == right.rels
+    if type(left) is not type(right) and not (
+        isinstance(left, str) and isinstance(right, str)
+    ):
+        return False
+    return left == right
+
+
+def compare(left, right):
+    """Cypher ordering comparison: -1, 0, 1 or None when not comparable"""
+    if left is None or right is None:
+        return None
+    if _is_number(left) and _is_number(right):
+        pass
+    elif isinstance(left, str) and isinstance(right, str):
+        pass
+    elif isinstance(left, bool) and isinstance(right, bool):
+        pass
+    elif isinstance(left, (list, tuple)) and isinstance(right, (list, tuple)):
+        for item_l, item_r in zip(left, right):
+            result = compare(item_l, item_r)
+            if result != 0:
+                return result
+        return (len(left) > len(right)) - (len(left) < len(right))
+    elif type(left) is type(right) and not isinstance(
+        left, (dict, Node, Relationship, Path)
+    ):
+        try:
+            return (left > right) - (left < right)
+        except TypeError:
+            return None
+    else:
+        return None
+    return (left > right) - (left < right)
+
+
+def sort_key(value):
+    """Total order used by ORDER BY, nulls last"""
+    if value is None:
+        return (9,)
+    if isinstance(value, bool):
+        return (7, value)
+    if _is_number(value):
+        return (8, value if value == value else math.inf)
+    if isinstance(value, str):
+        return (6, value)
+    if isinstance(value, dict):
+        return (0, tuple(sorted((k, sort_key(v)) for k, v in value.items())))
+    if isinstance(value, Node):
+        return (1, value.id)
+    if isinstance(value, Relationship):
+        return (2, value.id)
+    if isinstance(value, (list, tuple)):
+        return (3, tuple(sort_key(v) for v in value))
+    if isinstance(value, Path):
+        return (4, tuple(rel.id for rel in value.rels))
+    return (5, type(value).__name__, value)
+
+
+def to_string(value):
+    """Cypher toString"""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, str):
+        return value
+    if hasattr(value, "iso_format"):
+        return value.iso_format()
+    return str(value)
+
+
+def _check_property(key, value):
+    """Property values must be primitives or homogeneous lists of them"""
+    items = value if isinstance(value, (list, tuple)) else [value]
+    for item in items:
+        if item is None and items is not value:
+            raise CypherError(
+                TYPE_ERROR, f"Collections containing null values can not be stored in properties ({key})."
+            )
+        if isinstance(item, (dict, list, tuple, Node, Relationship, Path)):
+            raise CypherError(
+                TYPE_ERROR,
+                f"Property values can only be of primitive types or arrays thereof ({key}).",
+            )
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return value
+
+
+#######
+# Tokenizer
+#######
+_TOKEN = re.compile(
+    r"""
+    (?P<ws>\s+|//[^\n]*|/\*.*?\*/)
+    |(?P<num>\d+\.\d+(?:[eE][-+]?\d+)?|\d+(?:[eE][-+]?\d+)?)
+    |(?P<str>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+    |(?P<param>\$(?:[A-Za-z_][A-Za-z0-9_]*|\d+))
+    |(?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    |(?P<qname>`(?:[^`]|``)*`)
+    |(?P<op>\.\.|<>|<=|>=|=~|\+=|[-+*/%^=<>(){}\[\],.:|;])
+    """,
+    re.X | re.S,
+)
+_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f", "\\": "\\", "'": "'", '"': '"'}
+
+
+class Token:
+    """A token with its position in the query"""
+
+    __slots__ = ("kind", "value", "start", "end")
+
+    def __init__(self, kind, value, start, end):
+        self.kind = kind
+        self.value = value
+        self.start = start
+        self.end = end
+
+
+def _unescape(text):
+    out = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == "\\" and i + 1 < len(text):
+            nxt = text[i + 1]
+            if nxt == "u":
+                out.append(chr(int(text[i + 2 : i + 6], 16)))
+                i += 6
+                continue
+            out.append(_ESCAPES.get(nxt, "\\" + nxt))
+            i += 2
+            continue
+        out.append(char)
+        i += 1
+    return "".join(out)
+
+
+def tokenize(text):
+    """Splits a query into tokens, ending with an eof token"""
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if not match:
+            raise CypherError(SYNTAX_ERROR, f"Invalid input '{text[pos]}' at {pos}")
+        kind = match.lastgroup
+        raw = match.group()
+        if kind == "num":
+            value = float(raw) if "." in raw or "e" in raw.lower() else int(raw)
+        elif kind == "str":
+            value = _unescape(raw[1:-1])
+        elif kind == "param":
+            value = raw[1:]
+        elif kind == "qname":
+            value, kind = raw[1:-1].replace("``", "`"), "name"
+        else:
+            value = raw
+        if kind != "ws":
+            tokens.append(Token(kind, value, match.start(), match.end()))
+        pos = match.end()
+    tokens.append(Token("eof", None, len(text), len(text)))
+    return tokens
+
+
+#######
+# Parser
+#######
+class NodePattern:
+    __slots__ = ("var", "labels", "props")
+
+    def __init__(self, var, labels, props):
+        self.var = var
+        self.labels = labels
+        self.props = props
+
+
+class RelPattern:
+    __slots__ = ("var", "types", "direction", "props", "length")
+
+    def __init__(self, var, types, direction, props, length):
+        self.var = var
+        self.types = types
+        self.direction = direction
+        self.props = props
+        self.length = length
+
+
+class PatternPart:
+    __slots__ = ("var", "elements", "variables")
+
+    def __init__(self, var, elements):
+        self.var = var
+        self.elements = elements
+        self.variables = [e.var for e in elements if e.var] + ([var] if var else [])
+
+
+class Query:
+    """Single queries joined by UNION, the last one decides the columns"""
+
+    def __init__(self, parts, union_all):
+        self.parts = parts
+        self.union_all = union_all
+
+
+class Clause:
+    """A clause, kind is its keyword and the rest its arguments"""
+
+    def __init__(self, kind, **args):
+        self.kind = kind
+        self.__dict__.update(args)
+
+
+AGGREGATES = {"count", "collect", "sum", "avg", "min", "max"}
+_SCHEMA_COUNTERS = {"index": "indexes", "constraint": "constraints"}
+
+
+class Parser:
+    """
+    Recursive descent parser producing clauses, with expressions compiled to
+    closures taking (executor, row).
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.pos = 0
+        self.aggregates = 0
+
+    # token helpers
+    def peek(self, offset=0):
+        return self.tokens[min(self.pos + offset, len(self.tokens) - 1)]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def is_kw(self, *words, offset=0):
+        token = self.peek(offset)
+        return token.kind == "name" and token.value.upper() in words
+
+    def is_op(self, *ops, offset=0):
+        token = self.peek(offset)
+        return token.kind == "op" and token.value in ops
+
+    def accept_kw(self, *words):
+        if self.is_kw(*words):
+            return self.next().value.upper()
+        return None
+
+    def accept_op(self, *ops):
+        if self.is_op(*ops):
+            return self.next().value
+        return None
+
+    def expect_kw(self, *words):
+        if not self.is_kw(*words):
+            self.error(f"expected {' or '.join(words)}")
+        return self.next().value.upper()
+
+    def expect_op(self, op):
+        if not self.is_op(op):
+            self.error(f"expected '{op}'")
+        return self.next()
+
+    def name(self):
+        token = self.peek()
+        if token.kind != "name":
+            self.error("expected a name")
+        self.pos += 1
+        return token.value
+
+    def error(self, message):
+        token = self.peek()
+        found = "end of input" if token.kind == "eof" else repr(self.text[token.start : token.end])
+        line = self.text.count("\n", 0, token.start) + 1
+        raise CypherError(SYNTAX_ERROR, f"Invalid input {found}, {message} (line {line})")
+
+    # statements
+    def parse(self):
+        if self.is_kw("CREATE") and self.is_kw(
+            "INDEX", "CONSTRAINT", "RANGE", "TEXT", "POINT", "LOOKUP", offset=1
+        ):
+            statement = self.schema_create()
+        elif self.is_kw("DROP"):
+            statement = self.schema_drop()
+        elif self.is_kw("SHOW"):
+            statement = self.schema_show()
+        else:
+            statement = self.query()
+        self.accept_op(";")
+        if self.peek().kind != "eof":
+            self.error("expected the end of the query")
+        return statement
+
+    def query(self):
+        parts = [self.single_query()]
+        union_all = []
+        while self.accept_kw("UNION"):
+            union_all.append(bool(self.accept_kw("ALL")))
+            parts.append(self.single_query())
+        return Query(parts, union_all)
+
+    def single_query(self):
+        clauses = []
+        while not (
+            self.peek().kind == "eof" or self.is_op("}", ")", ";") or self.is_kw("UNION")
+        ):
+            clauses.append(self.clause())
+        if not clauses:
+            self.error("expected a clause")
+        return clauses
+
+    def clause(self):
+        word = self.expect_kw(
+            "MATCH", "OPTIONAL", "UNWIND", "WITH", "RETURN", "CREATE", "MERGE",
+            "SET", "REMOVE", "DELETE", "DETACH", "CALL", "FOREACH",
+        )
+        if word == "OPTIONAL":
+            self.expect_kw("MATCH")
+            return self.match(True)
+        if word == "MATCH":
+            return self.match(False)
+        if word == "UNWIND":
+            expr = self.expr()
+            self.expect_kw("AS")
+            return Clause("UNWIND", expr=expr, var=self.name())
+        if word in ["WITH", "RETURN"]:
+            return self.projection(word)
+        if word == "CREATE":
+            return Clause("CREATE", parts=self.pattern())
+        if word == "MERGE":
+            part = self.pattern_part()
+            on_create, on_match = [], []
+            while self.is_kw("ON"):
+                self.next()
+                which = self.expect_kw("CREATE", "MATCH")
+                self.expect_kw("SET")
+                (on_create if which == "CREATE" else on_match).extend(self.set_items())
+            return Clause("MERGE", part=part, on_create=on_create, on_match=on_match)
+        if word == "SET":
+            return Clause("SET", items=self.set_items())
+        if word == "REMOVE":
+            return Clause("REMOVE", items=self.remove_items())
+        if word in ["DELETE", "DETACH"]:
+            detach = word == "DETACH"
+            if detach:
+                self.expect_kw("DELETE")
+            exprs = [self.expr()]
+            while self.accept_op(","):
+                exprs.append(self.expr())
+            return Clause("DELETE", exprs=exprs, detach=detach)
+        if word == "CALL":
+            return self.call()
+        # FOREACH
+        self.expect_op("(")
+        var = self.name()
+        self.expect_kw("IN")
+        source = self.expr()
+        self.expect_op("|")
+        clauses = self.single_query()
+        self.expect_op(")")
+        return Clause("FOREACH", var=var, source=source, clauses=clauses)
+
+    def match(self, optional):
+        parts = self.pattern()
+        where = self.expr() if self.accept_kw("WHERE") else None
+        return Clause("MATCH", optional=optional, parts=parts, where=where)
+
+    def projection(self, kind):
+        distinct = bool(self.accept_kw("DISTINCT"))
+        star = bool(self.accept_op("*"))
+        items = []
+        if not star or self.accept_op(","):
+            while True:
+                start = self.peek().start
+                before = self.aggregates
+                expr = self.expr()
+                text = self.text[start : self.tokens[self.pos - 1].end]
+                alias = self.name() if self.accept_kw("AS") else text.strip()
+                items.append((expr, alias, self.aggregates > before))
+                if not self.accept_op(","):
+                    break
+        order = []
+        if self.accept_kw("ORDER"):
+            self.expect_kw("BY")
+            while True:
+                expr = self.expr()
+                desc = self.accept_kw("DESC", "DESCENDING", "ASC", "ASCENDING") or ""
+                order.append((expr, desc.startswith("DESC")))
+                if not self.accept_op(","):
+                    break
+        skip = self.expr() if self.accept_kw("SKIP", "OFFSET") else None
+        limit = self.expr() if self.accept_kw("LIMIT") else None
+        where = self.expr() if kind == "WITH" and self.accept_kw("WHERE") else None
+        return Clause(
+            kind,
+            distinct=distinct,
+            star=star,
+            items=items,
+            order=order,
+            skip=skip,
+            limit=limit,
+            where=where,
+            aggregate=any(item[2] for item in items),
+        )
+
+    def set_items(self):
+        items = []
+        while True:
+            var = self.name()
+            if self.is_op(":"):
+                labels = []
+                while self.accept_op(":"):
+                    labels.append(self.name())
+                items.append(("labels", var, labels))
+            elif self.accept_op("+="):
+                items.append(("merge", var, self.expr()))
+            elif self.accept_op("="):
+                items.append(("replace", var, self.expr()))
+            else:
+                self.expect_op(".")
+                key = self.name()
+                self.expect_op("=")
+                items.append(("prop", var, key, self.expr()))
+            if not self.accept_op(","):
+                return items
+
+    def remove_items(self):
+        items = []
+        while True:
+            var = self.name()
+            if self.is_op(":"):
+                labels = []
+                while self.accept_op(":"):
+                    labels.append(self.name())
+                items.append(("labels", var, labels))
+            else:
+                self.expect_op(".")
+                items.append(("prop", var, self.name()))
+            if not self.accept_op(","):
+                return items
+
+    def call(self):
+        imports = None
+        if self.accept_op("("):
+            imports = []
+            if self.accept_op("*"):
+                imports = "*"
+            else:
+                while not self.is_op(")"):
+                    imports.append(self.name())
+                    if not self.accept_op(","):
+                        break
+            self.expect_op(")")
+        if imports is None and not self.is_op("{"):
+            return self.procedure()
+        self.expect_op("{")
+        body = self.subquery_body()
+        self.expect_op("}")
+        batch = None
+        if self.is_kw("IN") and self.is_kw("TRANSACTIONS", offset=1):
+            self.pos += 2
+            batch = lambda x, row: 1000
+            if self.accept_kw("OF"):
+                batch = self.expr()
+                self.expect_kw("ROW", "ROWS")
+            if self.accept_kw("ON"):
+                self.expect_kw("ERROR")
+                self.expect_kw("FAIL")
+        return Clause("CALL", imports=imports, body=body, batch=batch)
+
+    def procedure(self):
+        name = self.name()
+        while self.accept_op("."):
+            name += "." + self.name()
+        self.expect_op("(")
+        self.expect_op(")")
+        name = name.lower()
+        if name not in PROCEDURES:
+            raise CypherError(
+                "Neo.ClientError.Procedure.ProcedureNotFound",
+                f"There is no procedure with the name `{name}` registered.",
+            )
+        yields = []
+        if self.accept_kw("YIELD"):
+            while True:
+                yields.append(self.name())
+                if not self.accept_op(","):
+                    break
+        return Clause("PROCEDURE", name=name, yields=yields)
+
+    def subquery_body(self):
+        """A query in braces, or just a pattern with an optional WHERE"""
+        saved = self.aggregates
+        if self.is_op("("):
+            body = Query([[self.match(False)]], [])
+        else:
+            body = self.query()
+        self.aggregates = saved
+        return body
+
+    # schema
+    def _schema_name(self, kind):
+        if self.peek().kind == "name" and not self.is_kw("IF", "FOR", "ON"):
+            return self.name()
+        return None
+
+    def _if(self, *words):
+        if self.accept_kw("IF"):
+            for word in words:
+                self.expect_kw(word)
+            return True
+        return False
+
+    def _schema_target(self):
+        self.expect_kw("FOR", "ON")
+        self.expect_op("(")
+        var = self.name()
+        self.expect_op(":")
+        label = self.name()
+        self.expect_op(")")
+        return var, label
+
+    def _schema_keys(self, var):
+        keys = []
+        parens = bool(self.accept_op("("))
+        while True:
+            if self.name() != var:
+                self.error(f"expected properties of {var}")
+            self.expect_op(".")
+            keys.append(self.name())
+            if not self.accept_op(","):
+                break
+        if parens:
+            self.expect_op(")")
+        return tuple(keys)
+
+    def schema_create(self):
+        self.next()
+        if self.accept_kw("CONSTRAINT"):
+            name = self._schema_name("constraint")
+            if_not_exists = self._if("NOT", "EXISTS")
+            var, label = self._schema_target()
+            self.expect_kw("REQUIRE", "ASSERT")
+            keys = self._schema_keys(var)
+            self.expect_kw("IS")
+            unique = False
+            if self.accept_kw("UNIQUE"):
+                unique = True
+            elif self.accept_kw("NODE"):
+                self.expect_kw("KEY")
+                unique = True
+            else:
+                self.expect_kw("NOT")
+                self.expect_kw("NULL")
+            name = name or f"constraint_{label}_{'_'.join(keys)}"
+            self._options()
+            return Clause(
+                "SCHEMA", action="create", target="constraint", name=name, label=label,
+                keys=keys, exists=if_not_exists, unique=unique,
+            )
+        self.accept_kw("RANGE", "TEXT", "POINT", "LOOKUP")
+        self.expect_kw("INDEX")
+        name = self._schema_name("index")
+        if_not_exists = self._if("NOT", "EXISTS")
+        var, label = self._schema_target()
+        self.expect_kw("ON")
+        keys = self._schema_keys(var)
+        name = name or f"index_{label}_{'_'.join(keys)}"
+        self._options()
+        return Clause(
+            "SCHEMA", action="create", target="index", name=name, label=label,
+            keys=keys, exists=if_not_exists, unique=False,
+        )
+
+    def _options(self):
+        if self.accept_kw("OPTIONS"):
+            self.map_literal()
+
+    def schema_drop(self):
+        self.next()
+        kind = self.expect_kw("INDEX", "CONSTRAINT").lower()
+        name = self.name()
+        if_exists = self._if("EXISTS")
+        return Clause("SCHEMA", action="drop", target=kind, name=name, exists=if_exists)
+
+    def schema_show(self):
+        self.next()
+        self.accept_kw("ALL", "RANGE", "TEXT", "POINT", "LOOKUP", "UNIQUE")
+        word = self.expect_kw("INDEX", "INDEXES", "CONSTRAINT", "CONSTRAINTS")
+        kind = "index" if word.startswith("INDEX") else "constraint"
+        return Clause("SCHEMA", action="show", target=kind)
+
+    # patterns
+    def pattern(self):
+        parts = [self.pattern_part()]
+        while self.accept_op(","):
+            parts.append(self.pattern_part())
+        return parts
+
+    def pattern_part(self):
+        var = None
+        if self.peek().kind == "name" and self.is_op("=", offset=1):
+            var = self.name()
+            self.next()
+        elements = [self.node_pattern()]
+        while self.is_op("-") or (self.is_op("<") and self.is_op("-", offset=1)):
+            elements.append(self.rel_pattern())
+            elements.append(self.node_pattern())
+        return PatternPart(var, elements)
+
+    def _pattern_props(self):
+        if self.is_op("{"):
+            return self.map_literal()
+        if self.peek().kind == "param":
+            return self.atom()
+        return None
+
+    def node_pattern(self):
+        self.expect_op("(")
+        var = self.name() if self.peek().kind == "name" else None
+        labels = []
+        while self.accept_op(":"):
+            labels.append(self.name())
+        props = self._pattern_props()
+        self.expect_op(")")
+        return NodePattern(var, tuple(labels), props)
+
+    def rel_pattern(self):
+        left = bool(self.accept_op("<"))
+        self.expect_op("-")
+        var, types, props, length = None, (), None, None
+        if self.accept_op("["):
+            if self.peek().kind == "name":
+                var = self.name()
+            if self.accept_op(":"):
+                types = [self.name()]
+                while self.accept_op("|"):
+                    self.accept_op(":")
+                    types.append(self.name())
+                types = tuple(types)
+            if self.accept_op("*"):
+                low, high = 1, None
+                if self.peek().kind == "num":
+                    low = high = self.next().value
+                if self.accept_op(".."):
+                    high = self.next().value if self.peek().kind == "num" else None
+                length = (low, high)
+            props = self._pattern_props()
+            self.expect_op("]")
+        self.expect_op("-")
+        right = bool(self.accept_op(">"))
+        direction = "both"
+        if right and not left:
+            direction = "out"
+        elif left and not right:
+            direction = "in"
+        return RelPattern(var, types, direction, props, length)
+
+    # expressions
+    def expr(self):
+        return self.or_expr()
+
+    def or_expr(self):
+        left = self.xor_expr()
+        while self.accept_kw("OR"):
+            left = _or(left, self.xor_expr())
+        return left
+
+    def xor_expr(self):
+        left = self.and_expr()
+        while self.accept_kw("XOR"):
+            left = _xor(left, self.and_expr())
+        return left
+
+    def and_expr(self):
+        left = self.not_expr()
+        while self.accept_kw("AND"):
+            left = _and(left, self.not_expr())
+        return left
+
+    def not_expr(self):
+        if self.accept_kw("NOT"):
+            return _not(self.not_expr())
+        return self.comparison()
+
+    def comparison(self):
+        left = self.additive()
+        while True:
+            op = self.accept_op("=", "<>", "<", ">", "<=", ">=", "=~")
+            if op:
+                left = _comparison(op, left, self.additive())
+            elif self.accept_kw("IS"):
+                negate = bool(self.accept_kw("NOT"))
+                self.expect_kw("NULL")
+                left = _is_null(left, negate)
+            elif self.is_kw("STARTS", "ENDS") and self.is_kw("WITH", offset=1):
+                word = self.next().value.upper()
+                self.next()
+                left = _string_op(word, left, self.additive())
+            elif self.accept_kw("CONTAINS"):
+                left = _string_op("CONTAINS", left, self.additive())
+            elif self.accept_kw("IN"):
+                left = _in(left, self.additive())
+            else:
+                return left
+
+    def additive(self):
+        left = self.multiplicative()
+        while True:
+            op = self.accept_op("+", "-")
+            if not op:
+                return left
+            left = _arithmetic(op, left, self.multiplicative())
+
+    def multiplicative(self):
+        left = self.power()
+        while True:
+            op = self.accept_op("*", "/", "%")
+            if not op:
+                return left
+            left = _arithmetic(op, left, self.power())
+
+    def power(self):
+        left = self.unary()
+        while self.accept_op("^"):
+            left = _arithmetic("^", left, self.unary())
+        return left
+
+    def unary(self):
+        op = self.accept_op("-", "+")
+        if op == "-":
+            return _arithmetic("-", lambda x, row: 0, self.unary())
+        if op == "+":
+            return self.unary()
+        return self.postfix()
+
+    def postfix(self):
+        expr = self.atom()
+        while True:
+            if self.accept_op("."):
+                expr = _property(expr, self.name())
+            elif self.accept_op("["):
+                start = None if self.is_op("..") else self.expr()
+                if self.accept_op(".."):
+                    end = None if self.is_op("]") else self.expr()
+                    self.expect_op("]")
+                    expr = _slice(expr, start, end)
+                else:
+                    self.expect_op("]")
+                    expr = _subscript(expr, start)
+            elif self.is_op(":") and self.peek(1).kind == "name":
+                labels = []
+                while self.accept_op(":"):
+                    labels.append(self.name())
+                expr = _has_labels(expr, labels)
+            else:
+                return expr
+
+    def atom(self):
+        token = self.peek()
+        if token.kind in ["num", "str"]:
+            self.next()
+            value = token.value
+            return lambda x, row: value
+        if token.kind == "param":
+            self.next()
+            return _parameter(token.value)
+        if token.kind == "op":
+            if token.value == "(":
+                return self.parenthesized()
+            if token.value == "[":
+                return self.list_expr()
+            if token.value == "{":
+                return self.map_literal()
+            self.error("expected an expression")
+        if token.kind != "name":
+            self.error("expected an expression")
+        word = token.value.upper()
+        following = self.peek(1)
+        if word in ["TRUE", "FALSE", "NULL"]:
+            self.next()
+            value = {"TRUE": True, "FALSE": False, "NULL": None}[word]
+            return lambda x, row: value
+        if word == "CASE":
+            self.next()
+            return self.case()
+        if word in ["EXISTS", "COUNT", "COLLECT"] and self.is_op("{", offset=1):
+            self.pos += 2
+            body = self.subquery_body()
+            self.expect_op("}")
+            return _subquery(word, body)
+        if (
+            word in ["ANY", "ALL", "NONE", "SINGLE"]
+            and self.is_op("(", offset=1)
+            and self.peek(2).kind == "name"
+            and self.is_kw("IN", offset=3)
+        ):
+            self.pos += 2
+            var = self.name()
+            self.expect_kw("IN")
+            source = self.expr()
+            predicate = self.expr() if self.accept_kw("WHERE") else None
+            self.expect_op(")")
+            return _quantifier(word, var, source, predicate)
+        if word == "REDUCE" and self.is_op("(", offset=1):
+            self.pos += 2
+            acc = self.name()
+            self.expect_op("=")
+            init = self.expr()
+            self.expect_op(",")
+            var = self.name()
+            self.expect_kw("IN")
+            source = self.expr()
+            self.expect_op("|")
+            expr = self.expr()
+            self.expect_op(")")
+            return _reduce(acc, init, var, source, expr)
+        if following.kind == "op" and following.value == "(":
+            return self.function_call()
+        self.next()
+        var = _variable(token.value)
+        if self.is_op("{"):
+            return self.map_projection(var)
+        return var
+
+    def parenthesized(self):
+        saved = self.pos
+        try:
+            part = self.pattern_part()
+            if len(part.elements) > 1:
+                return _pattern_predicate(part)
+        except CypherError:
+            pass
+        self.pos = saved
+        self.expect_op("(")
+        expr = self.expr()
+        self.expect_op(")")
+        return expr
+
+    def list_expr(self):
+        self.expect_op("[")
+        if self.accept_op("]"):
+            return lambda x, row: []
+        if self.peek().kind == "name" and self.is_kw("IN", offset=1):
+            var = self.name()
+            self.next()
+            source = self.expr()
+            predicate = self.expr() if self.accept_kw("WHERE") else None
+            projection = self.expr() if self.accept_op("|") else None
+            self.expect_op("]")
+            return _list_comprehension(var, source, predicate, projection)
+        if self.is_op("(") or (self.peek().kind == "name" and self.is_op("=", offset=1)):
+            saved = self.pos
+            try:
+                part = self.pattern_part()
+                if len(part.elements) > 1 and (self.is_kw("WHERE") or self.is_op("|")):
+                    predicate = self.expr() if self.accept_kw("WHERE") else None
+                    self.expect_op("|")
+                    projection = self.expr()
+                    self.expect_op("]")
+                    return _pattern_comprehension(part, predicate, projection)
+            except CypherError:
+                pass
+            self.pos = saved
+        items = [self.expr()]
+        while self.accept_op(","):
+            items.append(self.expr())
+        self.expect_op("]")
+        return lambda x, row: [item(x, row) for item in items]
+
+    def map_literal(self):
+        self.expect_op("{")
+        entries = []
+        while not self.is_op("}"):
+            key = self.next()
+            if key.kind not in ["name", "str"]:
+                self.error("expected a map key")
+            self.expect_op(":")
+            entries.append((key.value, self.expr()))
+            if not self.accept_op(","):
+                break
+        self.expect_op("}")
+        return lambda x, row: {key: value(x, row) for key, value in entries}
+
+    def map_projection(self, var):
+        self.expect_op("{")
+        entries = []
+        while not self.is_op("}"):
+            if self.accept_op("."):
+                if self.accept_op("*"):
+                    entries.append(("*", None))
+                else:
+                    entries.append(("." + self.name(), None))
+            else:
+                key = self.name()
+                if self.accept_op(":"):
+                    entries.append((key, self.expr()))
+                else:
+                    entries.append((key, _variable(key)))
+            if not self.accept_op(","):
+                break
+        self.expect_op("}")
+        return _map_projection(var, entries)
+
+    def case(self):
+        test = None if self.is_kw("WHEN") else self.expr()
+        branches = []
+        while self.accept_kw("WHEN"):
+            when = self.expr()
+            self.expect_kw("THEN")
+            branches.append((when, self.expr()))
+        default = self.expr() if self.accept_kw("ELSE") else None
+        self.expect_kw("END")
+        return _case(test, branches, default)
+
+    def function_call(self):
+        name = self.name().lower()
+        self.expect_op("(")
+        if name == "count" and self.accept_op("*"):
+            self.expect_op(")")
+            self.aggregates += 1
+            return _count_star
+        distinct = bool(self.accept_kw("DISTINCT"))
+        args = []
+        while not self.is_op(")"):
+            args.append(self.expr())
+            if not self.accept_op(","):
+                break
+        self.expect_op(")")
+        if name in AGGREGATES:
+            self.aggregates += 1
+            return _aggregate(name, args, distinct)
+        if name not in FUNCTIONS:
+            raise CypherError(
+                "Neo.ClientError.Statement.SyntaxError", f"Unknown function '{name}'"
+            )
+        func = FUNCTIONS[name]
+        if len(args) == 1:
+            arg = args[0]
+            return lambda x, row: func(x, arg(x, row))
+        return lambda x, row: func(x, *[arg(x, row) for arg in args])
+
+
+@lru_cache(maxsize=2048)
+def parse(text):
+    """Parses a query, cached since castnet sends the same queries repeatedly"""
+    return Parser(text).parse()
+
+
+#######
+# Expression closures
+#######
+def _parameter(name):
+    def parameter(x, row):
+        try:
+            return x.params[name]
+        except KeyError:
+            raise CypherError(PARAMETER_MISSING, f"Expected parameter(s): {name}") from None
+
+    return parameter
+
+
+def _variable(name):
+    def variable(x, row):
+        try:
+            return row[name]
+        except KeyError:
+            raise CypherError(SYNTAX_ERROR, f"Variable `{name}` not defined") from None
+
+    return variable
+
+
+def _property(expr, key):
+    def prop(x, row):
+        value = expr(x, row)
+        if value is None:
+            return None
+        if isinstance(value, (Node, Relationship)):
+            x.hits += 1
+            return value.props.get(key)
+        if isinstance(value, dict):
+            return value.get(key)
+        try:
+            return getattr(value, key)
+        except AttributeError:
+            raise CypherError(
+                TYPE_ERROR, f"Type mismatch: expected a map but was {value!r}"
+            ) from None
+
+    return prop
+
+
+def _subscript(expr, index):
+    def subscript(x, row):
+        value, key = expr(x, row), index(x, row)
+        if value is None or key is None:
+            return None
+        if isinstance(value, (Node, Relationship)):
+            return value.props.get(key)
+        if isinstance(value, dict):
+            return value.get(key)
+        if not _is_number(key):
+            raise CypherError(TYPE_ERROR, "List index must be an integer")
+        try:
+            return value[int(key)]
+        except IndexError:
+            return None
+
+    return subscript
+
+
+def _slice(expr, start, end):
+    def slicer(x, row):
+        value = expr(x, row)
+        low = start(x, row) if start else None
+        high = end(x, row) if end else None
+        if value is None:
+            return None
+        return value[low:high]
+
+    return slicer
+
+
+def _has_labels(expr, labels):
+    def has_labels(x, row):
+        node = expr(x, row)
+        if node is None:
+            return None
+        return all(label in node.labels for label in labels)
+
+    return has_labels
+
+
+def _boolean(value):
+    if value is None or isinstance(value, bool):
+        return value
+    raise CypherError(TYPE_ERROR, f"Type mismatch: expected Boolean but was {value!r}")
+
+
+def _and(left, right):
+    def and_(x, row):
+        first = _boolean(left(x, row))
+        if first is False:
+            return False
+        second = _boolean(right(x, row))
+        if second is False:
+            return False
+        if first is None or second is None:
+            return None
+        return True
+
+    return and_
+
+
+def _or(left, right):
+    def or_(x, row):
+        first = _boolean(left(x, row))
+        if first is True:
+            return True
+        second = _boolean(right(x, row))
+        if second is True:
+            return True
+        if first is None or second is None:
+            return None
+        return False
+
+    return or_
+
+
+def _xor(left, right):
+    def xor(x, row):
+        first, second = _boolean(left(x, row)), _boolean(right(x, row))
+        if first is None or second is None:
+            return None
+        return first is not second
+
+    return xor
+
+
+def _not(expr):
+    def not_(x, row):
+        value = _boolean(expr(x, row))
+        return None if value is None else not value
+
+    return not_
+
+
+def _comparison(op, left, right):
+    def comparison(x, row):
+        first, second = left(x, row), right(x, row)
+        if op == "=":
+            return equals(first, second)
+        if op == "<>":
+            same = equals(first, second)
+            return None if same is None else not same
+        if op == "=~":
+            if first is None or second is None:
+                return None
+            return re.fullmatch(second, first) is not None
+        result = compare(first, second)
+        if result is None:
+            return None
+        return {"<": result < 0, ">": result > 0, "<=": result <= 0, ">=": result >= 0}[op]
+
+    return comparison
+
+
+def _is_null(expr, negate):
+    return lambda x, row: (expr(x, row) is None) is not negate
+
+
+def _string_op(word, left, right):
+    def string_op(x, row):
+        first, second = left(x, row), right(x, row)
+        if not isinstance(first, str) or not isinstance(second, str):
+            return None
+        if word == "STARTS":
+            return first.startswith(second)
+        if word == "ENDS":
+            return first.endswith(second)
+        return second in first
+
+    return string_op
+
+
+def _in(left, right):
+    def in_(x, row):
+        value, items = left(x, row), right(x, row)
+        if items is None:
+            return None
+        if not isinstance(items, (list, tuple)):
+            raise CypherError(TYPE_ERROR, f"Type mismatch: expected a list but was {items!r}")
+        if value is None:
+            return None if items else False
+        unknown = False
+        for item in items:
+            same = equals(value, item)
+            if same:
+                return True
+            if same is None:
+                unknown = True
+        return None if unknown else False
+
+    return in_
+
+
+def _arithmetic(op, left, right):
+    def arithmetic(x, row):
+        first, second = left(x, row), right(x, row)
+        if first is None or second is None:
+            return None
+        if op == "+":
+            if isinstance(first, list):
+                return first + (second if isinstance(second, list) else [second])
+            if isinstance(second, list):
+                return [first] + second
+            if isinstance(first, str) or isinstance(second, str):
+                return to_string(first) + to_string(second)
+        if not (_is_number(first) and _is_number(second)):
+            if op in "+-" and not isinstance(first, (str, list, dict)):
+                try:
+                    return first + second if op == "+" else first - second
+                except TypeError:
+                    pass
+            raise CypherError(
+                TYPE_ERROR, f"Cannot apply '{op}' to {first!r} and {second!r}"
+            )
+        if op == "+":
+            return first + second
+        if op == "-":
+            return first - second
+        if op == "*":
+            return first * second
+        if op == "^":
+            return float(first) ** second
+        both_int = isinstance(first, int) and isinstance(second, int)
+        if op == "/":
+            if both_int:
+                if second == 0:
+                    raise CypherError(ARGUMENT_ERROR, "/ by zero")
+                quotient = abs(first) // abs(second)
+                return quotient if (first >= 0) == (second >= 0) else -quotient
+            if second == 0:
+                return math.nan if first == 0 else math.copysign(math.inf, first)
+            return first / second
+        # %
+        if both_int:
+            if second == 0:
+                raise CypherError(ARGUMENT_ERROR, "/ by zero")
+            return int(math.copysign(abs(first) % abs(second), first))
+        return math.fmod(first, second)
+
+    return arithmetic
+
+
+def _map_projection(var, entries):
+    def map_projection(x, row):
+        value = var(x, row)
+        if value is None:
+            return None
+        props = value.props if isinstance(value, (Node, Relationship)) else value
+        result = {}
+        for key, expr in entries:
+            if key == "*":
+                result.update(props)
+            elif key.startswith("."):
+                x.hits += 1
+                result[key[1:]] = props.get(key[1:])
+            else:
+                result[key] = expr(x, row)
+        return result
+
+    return map_projection
+
+
+def _case(test, branches, default):
+    def case(x, row):
+        if test is not None:
+            value = test(x, row)
+            for when, then in branches:
+                if equals(value, when(x, row)):
+                    return then(x, row)
+        else:
+            for when, then in branches:
+                if when(x, row) is True:
+                    return then(x, row)
+        return default(x, row) if default else None
+
+    return case
+
+
+def _list_comprehension(var, source, predicate, projection):
+    def comprehension(x, row):
+        items = source(x, row)
+        if items is None:
+            return None
+        result = []
+        inner = dict(row)
+        for item in items:
+            inner[var] = item
+            if predicate is not None and predicate(x, inner) is not True:
+                continue
+            result.append(projection(x, inner) if projection else item)
+        return result
+
+    return comprehension
+
+
+def _quantifier(word, var, source, predicate):
+    def quantifier(x, row):
+        items = source(x, row)
+        if items is None:
+            return None
+        inner = dict(row)
+        count = unknown = 0
+        for item in items:
+            inner[var] = item
+            value = predicate(x, inner) if predicate else True
+            if value is True:
+                count += 1
+            elif value is None:
+                unknown += 1
+        if word == "ANY":
+            return True if count else (None if unknown else False)
+        if word == "ALL":
+            if count + unknown < len(items):
+                return False
+            return None if unknown else True
+        if word == "NONE":
+            return False if count else (None if unknown else True)
+        if count > 1:
+            return False
+        return None if unknown else count == 1
+
+    return quantifier
+
+
+def _reduce(acc, init, var, source, expr):
+    def reduce_(x, row):
+        items = source(x, row)
+        if items is None:
+            return None
+        inner = dict(row)
+        inner[acc] = init(x, row)
+        for item in items:
+            inner[var] = item
+            inner[acc] = expr(x, inner)
+        return inner[acc]
+
+    return reduce_
+
+
+def _pattern_comprehension(part, predicate, projection):
+    def comprehension(x, row):
+        result = []
+        for env in x.match_parts([part], row):
+            if predicate is None or predicate(x, env) is True:
+                result.append(projection(x, env))
+        return result
+
+    return comprehension
+
+
+def _pattern_predicate(part):
+    def predicate(x, row):
+        for _ in x.match_parts([part], row):
+            return True
+        return False
+
+    return predicate
+
+
+def _subquery(word, body):
+    def subquery(x, row):
+        columns, rows = x.run_query(body, [dict(row)])
+        if word == "EXISTS":
+            return bool(rows)
+        if word == "COUNT":
+            return len(rows)
+        if not columns or len(columns) != 1:
+            raise CypherError(SEMANTIC_ERROR, "A COLLECT subquery must return one column")
+        return [r[columns[0]] for r in rows]
+
+    return subquery
+
+
+def _count_star(x, row):
+    if x.group is None:
+        raise CypherError(SYNTAX_ERROR, "Invalid use of aggregating function count(...)")
+    return len(x.group)
+
+
+def _aggregate(name, args, distinct):
+    arg = args[0] if args else None
+
+    def aggregate(x, row):
+        group = x.group
+        if group is None:
+            raise CypherError(SYNTAX_ERROR, f"Invalid use of aggregating function {name}(...)")
+        x.group = None
+        try:
+            values = [arg(x, r) for r in group]
+        finally:
+            x.group = group
+        values = [v for v in values if v is not None]
+        if distinct:
+            seen = set()
+            unique = []
+            for value in values:
+                key = hashable(value)
+                if key not in seen:
+                    seen.add(key)
+                    unique.append(value)
+            values = unique
+        if name == "count":
+            return len(values)
+        if name == "collect":
+            return values
+        if name == "sum":
+            return sum(values) if values else 0
+        if not values:
+            return None
+        if name == "avg":
+            return sum(values) / len(values)
+        keys = [sort_key(v) for v in values]
+        index = keys.index(min(keys) if name == "min" else max(keys))
+        return values[index]
+
+    return aggregate
+
+
+#######
+# Functions
+#######
+def _entity_props(value):
+    if isinstance(value, (Node, Relationship)):
+        return value.props
+    return value
+
+
+def _to_integer(x, value):
+    if value is None or isinstance(value, bool):
+        return None if value is None else int(value)
+    try:
+        return int(float(value)) if isinstance(value, str) else int(value)
+    except (ValueError, OverflowError):
+        return None
+
+
+def _to_float(x, value):
+    try:
+        return None if value is None else float(value)
+    except ValueError:
+        return None
+
+
+def _to_boolean(x, value):
+    if isinstance(value, str):
+        return {"true": True, "false": False}.get(value.strip().lower())
+    return value if value is None or isinstance(value, bool) else bool(value)
+
+
+def _temporal(kind):
+    def temporal(x, value=None):
+        if isinstance(value, (neo4j_time.Date, neo4j_time.DateTime)) and kind != "date":
+            return value
+        if value is None:
+            now = neo4j_time.DateTime.now()
+            return now.date() if kind == "date" else now
+        if isinstance(value, neo4j_time.DateTime):
+            return value.date()
+        if isinstance(value, neo4j_time.Date):
+            return value
+        if not isinstance(value, str):
+            raise CypherError(TYPE_ERROR, f"Cannot convert {value!r} to a {kind}")
+        try:
+            if kind == "date":
+                return neo4j_time.Date.from_iso_format(value[:10])
+            value = neo4j_time.DateTime.from_iso_format(value)
+        except ValueError as err:
+            raise CypherError(
+                "Neo.ClientError.Statement.ArgumentError", f"Text cannot be parsed to a {kind}: {value}"
+            ) from err
+        # like the database's default time zone setting, strings without a zone are UTC
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+    return temporal
+
+
+def _range(x, start, end, step=1):
+    return list(range(start, end + (1 if step > 0 else -1), step))
+
+
+def _substring(x, value, start, length=None):
+    if value is None:
+        return None
+    return value[start:] if length is None else value[start : start + length]
+
+
+def _split(x, value, sep):
+    if value is None or sep is None:
+        return None
+    return value.split(sep) if sep else list(value)
+
+
+def _replace(x, value, search, replacement):
+    if value is None or search is None or replacement is None:
+        return None
+    return value.replace(search, replacement)
+
+
+def _size(x, value):
+    if value is None:
+        return None
+    return len(value)
+
+
+def _length(x, value):
+    if value is None:
+        return None
+    if isinstance(value, Path):
+        return len(value.rels)
+    return len(value)
+
+
+def _none_safe(func):
+    return lambda x, value: None if value is None else func(value)
+
+
+def _coalesce(x, *values):
+    for value in values:
+        if value is not None:
+            return value
+    return None
+
+
+def _round(x, value, precision=0):
+    if value is None:
+        return None
+    factor = 10 ** precision
+    return float(math.floor(value * factor + 0.5) / factor)
+
+
+FUNCTIONS = {
+    "id": _none_safe(lambda v: v.id),
+    "elementid": _none_safe(lambda v: v.element_id),
+    "labels": _none_safe(lambda v: list(v.labels)),
+    "type": _none_safe(lambda v: v.type),
+    "keys": _none_safe(lambda v: list(_entity_props(v))),
+    "properties": _none_safe(lambda v: dict(_entity_props(v))),
+    "startnode": _none_safe(lambda v: v.start),
+    "endnode": _none_safe(lambda v: v.end),
+    "nodes": _none_safe(lambda v: v.nodes),
+    "relationships": _none_safe(lambda v: list(v.rels)),
+    "length": _length,
+    "size": _size,
+    "head": _none_safe(lambda v: v[0] if v else None),
+    "last": _none_safe(lambda v: v[-1] if v else None),
+    "tail": _none_safe(lambda v: v[1:]),
+    "reverse": _none_safe(lambda v: v[::-1]),
+    "isempty": _none_safe(lambda v: len(_entity_props(v)) == 0),
+    "exists": lambda x, v: v is not None,
+    "coalesce": _coalesce,
+    "range": _range,
+    "tostring": lambda x, v: to_string(v),
+    "tointeger": _to_integer,
+    "tofloat": _to_float,
+    "toboolean": _to_boolean,
+    "tolower": _none_safe(str.lower),
+    "toupper": _none_safe(str.upper),
+    "trim": _none_safe(str.strip),
+    "ltrim": _none_safe(str.lstrip),
+    "rtrim": _none_safe(str.rstrip),
+    "replace": _replace,
+    "split": _split,
+    "substring": _substring,
+    "left": lambda x, v, n: None if v is None else v[:n],
+    "right": lambda x, v, n: None if v is None else (v[-n:] if n else ""),
+    "abs": _none_safe(abs),
+    "ceil": _none_safe(lambda v: float(math.ceil(v))),
+    "floor": _none_safe(lambda v: float(math.floor(v))),
+    "round": _round,
+    "sign": _none_safe(lambda v: (v > 0) - (v < 0)),
+    "sqrt": _none_safe(math.sqrt),
+    "rand": lambda x: random.random(),
+    "randomuuid": lambda x: str(uuid.uuid4()),
+    "timestamp": lambda x: int(time.time() * 1000),
+    "date": _temporal("date"),
+    "datetime": _temporal("datetime"),
+}
+
+
+def _await_indexes(x):
+    return []
+
+
+def _db_labels(x):
+    return [{"label": label} for label, nodes in x.graph.labels.items() if nodes]
+
+
+PROCEDURES = {
+    "db.awaitindexes": _await_indexes,
+    "db.labels": _db_labels,
+}
+
+
+#######
+# Executor
+#######
+class Executor:
+    """
+    Runs a parsed query against a graph. Rows are dicts of variable to value.
+    undo: list receiving the inverse of every change, see Graph
+    write: whether the transaction may write
+    implicit: whether this is an auto-commit transaction, which may use
+        CALL { } IN TRANSACTIONS
+    commit: called after every inner transaction of CALL { } IN TRANSACTIONS
+    deadline: time.monotonic() after which the query times out
+    """
+
+    def __init__(
+        self, graph, params, undo, write=True, implicit=False, commit=None, deadline=None
+    ):
+        self.graph = graph
+        self.params = params
+        self.undo = undo
+        self.write = write
+        self.implicit = implicit
+        self.commit = commit
+        self.deadline = deadline
+        self.group = None
+        self.hits = 0
+        self.stats = dict.fromkeys(
+            [
+                "nodes_created", "nodes_deleted", "relationships_created",
+                "relationships_deleted", "properties_set", "labels_added",
+                "labels_removed", "indexes_added", "indexes_removed",
+                "constraints_added", "constraints_removed",
+            ],
+            0,
+        )
+
+    def run(self, statement):
+        """Runs a parsed statement, returns (columns, rows)"""
+        if isinstance(statement, Clause):
+            return self.schema(statement)
+        columns, rows = self.run_query(statement, [{}])
+        return columns or [], rows if columns else []
+
+    def check_time(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise CypherError(
+                TIMED_OUT,
+                "The transaction has been terminated. Retry your operation in a new"
+                " transaction, and you should see a successful result. The transaction"
+                " has not completed within the specified timeout"
+                " (dbms.transaction.timeout).",
+            )
+
+    def writing(self):
+        if not self.write:
+            raise CypherError(
+                ACCESS_MODE, "Writing in read access mode not allowed."
+            )
+
+    # queries
+    def run_query(self, query, rows):
+        """Runs a (possibly UNION) query on input rows. Columns are None without RETURN"""
+        columns, result = self.run_clauses(query.parts[0], rows)
+        for union_all, part in zip(query.union_all, query.parts[1:]):
+            part_columns, part_rows = self.run_clauses(part, rows)
+            if part_columns != columns:
+                raise CypherError(
+                    SYNTAX_ERROR, "All sub queries in an UNION must have the same return column names"
+                )
+            result = result + part_rows
+            if not union_all:
+                seen = set()
+                unique = []
+                for row in result:
+                    key = tuple(hashable(row[c]) for c in columns)
+                    if key not in seen:
+                        seen.add(key)
+                        unique.append(row)
+                result = unique
+        return columns, result
+
+    def run_clauses(self, clauses, rows):
+        columns = None
+        for clause in clauses:
+            self.check_time()
+            rows = getattr(self, "clause_" + clause.kind.lower())(clause, rows)
+            if clause.kind == "RETURN":
+                columns = [item[1] for item in clause.items]
+                if clause.star:
+                    columns = sorted(rows[0]) if rows else []
+        return columns, rows
+
+    # reading clauses
+    def clause_match(self, clause, rows):
+        out = []
+        for row in rows:
+            matched = False
+            for env in self.match_parts(clause.parts, row):
+                if clause.where is None or clause.where(self, env) is True:
+                    matched = True
+                    out.append(env)
+            if not matched and clause.optional:
+                env = dict(row)
+                for part in clause.parts:
+                    for var in part.variables:
+                        env.setdefault(var, None)
+                out.append(env)
+        return out
+
+    def clause_unwind(self, clause, rows):
+        out = []
+        for row in rows:
+            value = clause.expr(self, row)
+            if value is None:
+                continue
+            for item in value if isinstance(value, (list, tuple)) else [value]:
+                env = dict(row)
+                env[clause.var] = item
+                out.append(env)
+        return out
+
+    def clause_with(self, clause, rows):
+        return self.project(clause, rows)
+
+    def clause_return(self, clause, rows):
+        return self.project(clause, rows)
+
+    def project(self, clause, rows):
+        items = clause.items
+        if clause.aggregate:
+            groups = {}
+            keys = [item for item in items if not item[2]]
+            for row in rows:
+                values = [expr(self, row) for expr, _, _ in keys]
+                group_key = tuple(hashable(v) for v in values)
+                if group_key not in groups:
+                    groups[group_key] = (values, [])
+                groups[group_key][1].append(row)
+            if not groups and not keys:
+                groups[()] = ([], [])
+            projected = []
+            saved = self.group
+            try:
+                for values, group in groups.values():
+                    new = {}
+                    key_values = iter(values)
+                    base = group[0] if group else {}
+                    for expr, alias, aggregate in items:
+                        if aggregate:
+                            self.group = group
+                            new[alias] = expr(self, base)
+                            self.group = None
+                        else:
+                            new[alias] = next(key_values)
+                    projected.append((new, new))
+            finally:
+                self.group = saved
+        else:
+            projected = []
+            for row in rows:
+                new = dict(row) if clause.star else {}
+                for expr, alias, _ in items:
+                    new[alias] = expr(self, row)
+                projected.append((new, {**row, **new}))
+
+        if clause.distinct:
+            seen = set()
+            unique = []
+            for new, env in projected:
+                key = tuple(hashable(v) for v in new.values())
+                if key not in seen:
+                    seen.add(key)
+                    unique.append((new, env))
+            projected = unique
+        if clause.order:
+            keyed = [
+                ([sort_key(expr(self, env)) for expr, _ in clause.order], new)
+                for new, env in projected
+            ]
+            for i in reversed(range(len(clause.order))):
+                keyed.sort(key=lambda item: item[0][i], reverse=clause.order[i][1])
+            result = [new for _, new in keyed]
+        else:
+            result = [new for new, _ in projected]
+        if clause.skip is not None:
+            result = result[self._count(clause.skip, "SKIP") :]
+        if clause.limit is not None:
+            result = result[: self._count(clause.limit, "LIMIT")]
+        if clause.where is not None:
+            result = [row for row in result if clause.where(self, row) is True]
+        return result
+
+    def _count(self, expr, word):
+        value = expr(self, {})
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise CypherError(
+                ARGUMENT_ERROR, f"Invalid input. '{value}' is not a valid value. Must be a non-negative integer. ({word})"
+            )
+        return value
+
+    def clause_call(self, clause, rows):
+        def run(batch):
+            out = []
+            for row in batch:
+                if clause.imports is None or clause.imports == "*":
+                    inner = dict(row)
+                else:
+                    inner = {}
+                    for name in clause.imports:
+                        if name not in row:
+                            raise CypherError(SYNTAX_ERROR, f"Variable `{name}` not defined")
+                        inner[name] = row[name]
+                columns, result = self.run_query(clause.body, [inner])
+                if columns is None:
+                    out.append(row)
+                    continue
+                for returned in result:
+                    env = dict(row)
+                    env.update(returned)
+                    out.append(env)
+            return out
+
+        if clause.batch is None:
+            return run(rows)
+        if not self.implicit:
+            raise CypherError(
+                "Neo.DatabaseError.Transaction.TransactionStartFailed",
+                "A query with 'CALL { ... } IN TRANSACTIONS' can only be executed in an"
+                " implicit transaction, but tried to execute in an explicit transaction.",
+            )
+        size = self._count(clause.batch, "IN TRANSACTIONS OF")
+        out = []
+        for start in range(0, len(rows), max(size, 1)):
+            out += run(rows[start : start + size])
+            if self.commit:
+                self.commit()
+        return out
+
+    def clause_procedure(self, clause, rows):
+        out = []
+        for row in rows:
+            for result in PROCEDURES[clause.name](self):
+                env = dict(row)
+                for name in clause.yields:
+                    env[name] = result.get(name)
+                out.append(env)
+            if not clause.yields:
+                out.append(row)
+        return out
+
+    # writing clauses
+    def clause_create(self, clause, rows):
+        self.writing()
+        out = []
+        for row in rows:
+            env = dict(row)
+            for part in clause.parts:
+                self.create_part(part, env)
+            out.append(env)
+        return out
+
+    def create_part(self, part, env):
+        elements = part.elements
+        nodes = {}
+        for i in range(0, len(elements), 2):
+            pattern = elements[i]
+            if pattern.var and env.get(pattern.var) is not None:
+                nodes[i] = env[pattern.var]
+                continue
+            if pattern.var and pattern.var in env:
+                raise CypherError(
+                    SEMANTIC_ERROR,
+                    f"Failed to create relationship, node `{pattern.var}` is null",
+                )
+            props = self._create_props(pattern.props, env)
+            node = self.graph.create_node(pattern.labels, props, self.undo)
+            self.stats["nodes_created"] += 1
+            self.stats["labels_added"] += len(pattern.labels)
+            self.stats["properties_set"] += len(props)
+            nodes[i] = node
+            if pattern.var:
+                env[pattern.var] = node
+        rels = []
+        for i in range(1, len(elements), 2):
+            pattern = elements[i]
+            if len(pattern.types) != 1 or pattern.direction == "both" or pattern.length:
+                raise CypherError(
+                    SYNTAX_ERROR,
+                    "Exactly one relationship type and a direction must be specified for CREATE",
+                )
+            start, end = nodes[i - 1], nodes[i + 1]
+            if pattern.direction == "in":
+                start, end = end, start
+            props = self._create_props(pattern.props, env)
+            rel = self.graph.create_rel(pattern.types[0], start, end, props, self.undo)
+            self.stats["relationships_created"] += 1
+            self.stats["properties_set"] += len(props)
+            rels.append(rel)
+            if pattern.var:
+                env[pattern.var] = rel
+        if part.var:
+            env[part.var] = Path(nodes[0], rels)
+
+    def _create_props(self, props, env):
+        if props is None:
+            return {}
+        values = props(self, env)
+        return {
+            key: _check_property(key, value)
+            for key, value in _entity_props(values).items()
+            if value is not None
+        }
+
+    def clause_merge(self, clause, rows):
+        self.writing()
+        out = []
+        for row in rows:
+            matches = list(self.match_parts([clause.part], row))
+            if matches:
+                for env in matches:
+                    self.apply_set(clause.on_match, env)
+                    out.append(env)
+            else:
+                env = dict(row)
+                self.create_part(clause.part, env)
+                self.apply_set(clause.on_create, env)
+                out.append(env)
+        return out
+
+    def clause_set(self, clause, rows):
+        self.writing()
+        for row in rows:
+            self.apply_set(clause.items, row)
+        return rows
+
+    def apply_set(self, items, row):
+        for item in items:
+            target = row.get(item[1])
+            if target is None:
+                continue
+            if item[0] == "labels":
+                for label in item[2]:
+                    if self.graph.add_label(target, label, self.undo):
+                        self.stats["labels_added"] += 1
+            elif item[0] == "prop":
+                value = _check_property(item[2], item[3](self, row))
+                if self.graph.set_prop(target, item[2], value, self.undo):
+                    self.stats["properties_set"] += 1
+            else:
+                values = _entity_props(item[2](self, row)) or {}
+                if item[0] == "replace":
+                    for key in list(target.props):
+                        if key not in values:
+                            self.graph.set_prop(target, key, None, self.undo)
+                            self.stats["properties_set"] += 1
+                for key, value in values.items():
+                    value = _check_property(key, value)
+                    if self.graph.set_prop(target, key, value, self.undo):
+                        self.stats["properties_set"] += 1
+
+    def clause_remove(self, clause, rows):
+        self.writing()
+        for row in rows:
+            for item in clause.items:
+                target = row.get(item[1])
+                if target is None:
+                    continue
+                if item[0] == "labels":
+                    for label in item[2]:
+                        if self.graph.remove_label(target, label, self.undo):
+                            self.stats["labels_removed"] += 1
+                elif self.graph.set_prop(target, item[2], None, self.undo):
+                    self.stats["properties_set"] += 1
+        return rows
+
+    def clause_delete(self, clause, rows):
+        self.writing()
+        nodes, rels = {}, {}
+        for row in rows:
+            for expr in clause.exprs:
+                values = expr(self, row)
+                for value in values if isinstance(values, (list, tuple)) else [values]:
+                    if isinstance(value, Path):
+                        for rel in value.rels:
+                            rels[rel] = None
+                        for node in value.nodes:
+                            nodes[node] = None
+                    elif isinstance(value, Relationship):
+                        rels[value] = None
+                    elif isinstance(value, Node):
+                        nodes[value] = None
+                    elif value is not None:
+                        raise CypherError(TYPE_ERROR, f"Expected a node or relationship but was {value!r}")
+        if clause.detach:
+            for node in nodes:
+                for rel in list(node.out) + list(node.inc):
+                    rels[rel] = None
+        for rel in rels:
+            if not rel.deleted:
+                self.graph.delete_rel(rel, self.undo)
+                self.stats["relationships_deleted"] += 1
+        for node in nodes:
+            if not node.deleted:
+                self.graph.delete_node(node, self.undo)
+                self.stats["nodes_deleted"] += 1
+        return rows
+
+    def clause_foreach(self, clause, rows):
+        for row in rows:
+            items = clause.source(self, row)
+            for item in items or []:
+                env = dict(row)
+                env[clause.var] = item
+                self.run_clauses(clause.clauses, [env])
+        return rows
+
+    # schema
+    def schema(self, statement):
+        if statement.action == "show":
+            rows = []
+            for name, spec in self.graph.schema.items():
+                is_constraint = spec["kind"] == "constraint"
+                if is_constraint != (statement.target == "constraint"):
+                    continue
+                rows.append(
+                    {
+                        "name": name,
+                        "type": ("UNIQUENESS" if spec["unique"] else "NODE_PROPERTY_EXISTENCE")
+                        if is_constraint
+                        else "RANGE",
+                        "entityType": "NODE",
+                        "labelsOrTypes": [spec["label"]],
+                        "properties": list(spec["keys"]),
+                        "state": "ONLINE",
+                    }
+                )
+            return list(rows[0]) if rows else [], rows
+        self.writing()
+        if statement.action == "create":
+            if self.graph.create_schema(
+                statement.target, statement.name, statement.label, statement.keys,
+                statement.exists, statement.unique,
+            ):
+                self.stats[_SCHEMA_COUNTERS[statement.target] + "_added"] += 1
+        elif self.graph.drop_schema(statement.target, statement.name, statement.exists):
+            self.stats[_SCHEMA_COUNTERS[statement.target] + "_removed"] += 1
+        return [], []
+
+    # pattern matching
+    def match_parts(self, parts, row):
+        """Yields the rows extending row with each match of all parts"""
+
+        def extend(i, env, used):
+            if i == len(parts):
+                yield env
+                return
+            for matched, matched_used in self.match_part(parts[i], env, used):
+                yield from extend(i + 1, matched, matched_used)
+
+        yield from extend(0, row, frozenset())
+
+    def _anchor(self, elements, env):
+        """Index of the node pattern to start matching from"""
+        best, best_score = 0, -1
+        for i in range(0, len(elements), 2):
+            pattern = elements[i]
+            if pattern.var and pattern.var in env:
+                return i
+            score = 0
+            if pattern.labels:
+                score = 1
+            if pattern.props is not None:
+                score = 2
+            if score > best_score:
+                best, best_score = i, score
+        return best
+
+    def _node_ok(self, node, pattern, props, env):
+        if node.deleted:
+            return False
+        if pattern.var and pattern.var in env and env[pattern.var] is not node:
+            return False
+        for label in pattern.labels:
+            if label not in node.labels:
+                return False
+        if props:
+            self.hits += len(props)
+            for key, value in props.items():
+                if equals(node.props.get(key), value) is not True:
+                    return False
+        return True
+
+    def _rel_ok(self, rel, pattern, props):
+        if pattern.types and rel.type not in pattern.types:
+            return False
+        if props:
+            for key, value in props.items():
+                if equals(rel.props.get(key), value) is not True:
+                    return False
+        return True
+
+    def _eval_props(self, props, env):
+        if props is None:
+            return None
+        values = props(self, env)
+        return _entity_props(values) or {}
+
+    def _expand(self, node, pattern, forward):
+        """Yields (relationship, other node) pairs leaving node along pattern"""
+        direction = pattern.direction
+        if direction == "both":
+            for rel in list(node.out):
+                self.hits += 1
+                yield rel, rel.end
+            for rel in list(node.inc):
+                if rel.start is not rel.end:
+                    self.hits += 1
+                    yield rel, rel.start
+            return
+        outgoing = (direction == "out") == forward
+        if outgoing:
+            for rel in list(node.out):
+                self.hits += 1
+                yield rel, rel.end
+        else:
+            for rel in list(node.inc):
+                self.hits += 1
+                yield rel, rel.start
+
+    def _var_length(self, node, pattern, forward, used, props):
+        """Yields (relationships, end node) for every path within the length bounds"""
+        low, high = pattern.length
+        rels, seen = [], set()
+
+        def walk(current):
+            if len(rels) >= low:
+                yield list(rels), current
+            if high is not None and len(rels) >= high:
+                return
+            for rel, other in self._expand(current, pattern, forward):
+                if rel in used or rel in seen or not self._rel_ok(rel, pattern, props):
+                    continue
+                rels.append(rel)
+                seen.add(rel)
+                yield from walk(other)
+                rels.pop()
+                seen.discard(rel)
+
+        yield from walk(node)
+
+    def match_part(self, part, env, used):
+        """Yields (row, used relationships) for each match of a pattern part"""
+        elements = part.elements
+        anchor = self._anchor(elements, env)
+        pattern = elements[anchor]
+        props = self._eval_props(pattern.props, env)
+        if pattern.var and pattern.var in env:
+            value = env[pattern.var]
+            candidates = [value] if isinstance(value, Node) else []
+        else:
+            candidates = self.graph.candidates(pattern.labels, props)
+        steps = [(i, i + 2) for i in range(anchor, len(elements) - 1, 2)]
+        steps += [(i, i - 2) for i in range(anchor, 0, -2)]
+        for node in candidates:
+            self.hits += 1
+            if not self._node_ok(node, pattern, props, env):
+                continue
+            start = env
+            if pattern.var and pattern.var not in env:
+                start = dict(env)
+                start[pattern.var] = node
+            yield from self._steps(part, steps, 0, start, used, {anchor: node})
+
+    def _steps(self, part, steps, k, env, used, picked):
+        elements = part.elements
+        if k == len(steps):
+            if part.var:
+                env = dict(env)
+                rels = []
+                for i in range(1, len(elements), 2):
+                    value = picked[i]
+                    rels += value if isinstance(value, list) else [value]
+                env[part.var] = Path(picked[0], rels)
+            yield env, used
+            return
+        here, there = steps[k]
+        rel_index = (here + there) // 2
+        rel_pattern, node_pattern = elements[rel_index], elements[there]
+        forward = there > here
+        rel_props = self._eval_props(rel_pattern.props, env)
+        node_props = self._eval_props(node_pattern.props, env)
+        current = picked[here]
+        if rel_pattern.length is None:
+            bound = env.get(rel_pattern.var, _MISSING) if rel_pattern.var else _MISSING
+            for rel, other in self._expand(current, rel_pattern, forward):
+                if rel in used or (bound is not _MISSING and bound is not rel):
+                    continue
+                if not self._rel_ok(rel, rel_pattern, rel_props):
+                    continue
+                if not self._node_ok(other, node_pattern, node_props, env):
+                    continue
+                new = self._bind(env, rel_pattern.var, rel, node_pattern.var, other)
+                new_picked = dict(picked)
+                new_picked[rel_index] = rel
+                new_picked[there] = other
+                yield from self._steps(part, steps, k + 1, new, used | {rel}, new_picked)
+        else:
+            for rels, other in self._var_length(current, rel_pattern, forward, used, rel_props):
+                if not self._node_ok(other, node_pattern, node_props, env):
+                    continue
+                ordered = rels if forward else rels[::-1]
+                new = self._bind(env, rel_pattern.var, ordered, node_pattern.var, other)
+                new_picked = dict(picked)
+                new_picked[rel_index] = ordered
+                new_picked[there] = other
+                yield from self._steps(
+                    part, steps, k + 1, new, used | frozenset(rels), new_picked
+                )
+
+    @staticmethod
+    def _bind(env, rel_var, rel, node_var, node):
+        if (not rel_var or rel_var in env) and (not node_var or node_var in env):
+            return env
+        new = dict(env)
+        if rel_var:
+            new[rel_var] = rel
+        if node_var:
+            new[node_var] = node
+        return new
@@ -0,0 +1,118 @@
+"""
+Encoding of Neo4j values for responses.
+
+Records, nodes, relationships, paths and temporal values are converted to
+plain Python values (dicts, lists and ISO strings) in a single pass:
+
+to_python(records)       # json ready Python values
+encode({"data": rows})   # json bytes
+dumps({"data": rows})    # json str
+
+encode uses orjson when it is installed, which serializes large collected
+lists many times faster; otherwise the standard library json module. Both
+give the same result.
+
+The driver's types are imported when the first value needs converting, so
+importing castnet doesn't import the driver.
+"""
+import json
+from datetime import date, datetime, time
+
+try:
+    import orjson
+except ImportError:  # orjson is optional
+    orjson = None
+
+_PRIMITIVES = {str, int, float, bool, type(None)}
+
+
+def _iso(value):
+    return value.isoformat()
+
+
+def _native_iso(value):
+    return value.to_native().isoformat()
+
+
+def _properties(value):
+    return dict(value.items())
+
+
+_CONVERTERS = None
+
+
+def _converters():
+    """Converters by exact type, checked before the isinstance fallbacks of _convert"""
+    global _CONVERTERS  # pylint: disable=global-statement
+    if _CONVERTERS is None:
+        # pylint: disable=import-outside-toplevel
+        from neo4j import Record
+        from neo4j import time as neo4j_time
+        from neo4j.graph import Node, Path, Relationship
+
+        _CONVERTERS = {
+            neo4j_time.DateTime: _native_iso,
+            neo4j_time.Date: _native_iso,
+            neo4j_time.Time: _native_iso,
+            neo4j_time.Duration: lambda value: value.iso_format(),
+            datetime: _iso,
+            date: _iso,
+            time: _iso,
+            Node: _properties,
+            # relationship classes are created per type, found by isinstance
+            Relationship: _properties,
+            Path: lambda value: [dict(node.items()) for node in value.nodes],
+            Record: lambda value: dict(zip(value.keys(), value.values())),
+            tuple: list,
+        }
+    return _CONVERTERS
+
+
+def _convert(value):
+    """Converts a single value that isn't a primitive, dict or list"""
+    converters = _converters()
+    convert = converters.get(type(value))
+    if convert is not None:
+        return convert(value)
+    for kind, convert in converters.items():
+        if isinstance(value, kind):
+            return convert(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def to_python(value):
+    """
+    Converts records, nodes, maps and temporal values, also nested inside
+    lists and dicts, to values json can serialize. Nodes and relationships
+    become dicts of their properties, paths lists of their nodes.
+    """
+    kind = type(value)
+    if kind in _PRIMITIVES:
+        return value
+    if kind is dict:
+        return {key: to_python(item) for key, item in value.items()}
+    if kind is list:
+        return [to_python(item) for item in value]
+    # subclasses, e.g. of dict or str
+    if isinstance(value, dict):
+        return to_python(dict(value))
+    if isinstance(value, list):
+        return to_python(list(value))
+    if isinstance(value, (str, int, float)):
+        return value
+    converted = _convert(value)
+    if type(converted) is str:
+        return converted
+    return to_python(converted)
+
+
+def encode(value):
+    """Serializes a response to json bytes"""
+    if orjson is not None:
+        return orjson.dumps(value, default=_convert)
+    return json.dumps(value, default=_convert, separators=(",", ":")).encode()
+
+
+def dumps(value):
+    """Serializes a response to a json string"""
+    return encode(value).decode()
@@ -0,0 +1,196 @@
+"""
+Streaming export of a CastNet managed database to NDJSON.
+
+Each label is read in pages with keyset pagination on id, so memory use on
+both the database and the client is bounded by the page size. Every line is a
+row that castnet.importer can load again: the node's attributes plus its
+ordered relationships, keyed by relationship type.
+"""
+import gzip
+import json
+import os
+
+from castnet.encoding import to_python
+
+HISTORY_LABEL = "historyRecord"
+ARCHIVED_PREFIX = "_archived_"
+MANIFEST = "manifest.json"
+
+
+def base_label(label):
+    """Strips the archive prefix from a label"""
+    if label.startswith(ARCHIVED_PREFIX):
+        return label[len(ARCHIVED_PREFIX) :]
+    return label
+
+
+def open_output(path, compress=False):
+    """Opens a text file for writing, gzipped if asked to"""
+    if compress:
+        return gzip.open(path, "wt", encoding="utf-8")
+    return open(path, "w", encoding="utf-8")
+
+
+def export_order(schema):
+    """
+    Orders the labels of a schema so that relationship targets come before the
+    labels pointing at them (e.g. House, Feeder, Scan). Cycles keep schema order.
+    """
+    remaining = list(schema)
+    ordered = []
+    while remaining:
+        for label in remaining:
+            targets = set()
+            for target in schema[label]["relationships"].values():
+                targets.add(target[0] if isinstance(target, list) else target)
+            targets.discard(label)
+            if not targets.intersection(remaining):
+                break
+        else:
+            label = remaining[0]
+        remaining.remove(label)
+        ordered.append(label)
+    return ordered
+
+
+def export_cypher(label):
+    """Builds the keyset paginated query for a page of nodes and relationships"""
+    return (
+        f"MATCH (source:{label})\n"
+        "WHERE source.id > $after\n"
+        "WITH source ORDER BY source.id LIMIT $limit\n"
+        "RETURN source, [(source)-[r]->(target) WHERE type(r) IN $rel_types"
+        " | {type: type(r), id: target.id, order_num: r.order_num}] AS rels\n"
+        "ORDER BY source.id"
+    )
+
+
+def history_cypher():
+    """Builds the keyset paginated query for a page of history records"""
+    return (
+        f"MATCH (h:{HISTORY_LABEL})\n"
+        "WHERE h.timeStamp > $after OR (h.timeStamp = $after AND elementId(h) > $after_id)\n"
+        "WITH h ORDER BY h.timeStamp, elementId(h) LIMIT $limit\n"
+        "RETURN h, elementId(h) AS element_id,"
+        " [(h)-[:RESOURCE_ID]->(s) | labels(s)[0]][0] AS resourceLabel\n"
+        "ORDER BY h.timeStamp, element_id"
+    )
+
+
+def node_to_row(schema, label, node, rels):
+    """
+    Converts a node and its relationships to an import row, native temporal
+    values as ISO strings
+    """
+    spec = schema[base_label(label)]
+    row = {
+        key: to_python(node[key])
+        for key in spec["attributes"]
+        if key in node and node[key] is not None
+    }
+    for rel in sorted(rels, key=lambda r: r["order_num"] or 0):
+        target = spec["relationships"].get(rel["type"])
+        if target is None:
+            continue
+        if isinstance(target, list):
+            row.setdefault(rel["type"], []).append(rel["id"])
+        else:
+            row.setdefault(rel["type"], rel["id"])
+    return row
+
+
+def iter_label(conn, label, page_size=1000):
+    """Yields the import rows of a label, one page at a time"""
+    query = export_cypher(label)
+    rel_types = list(conn.schema[base_label(label)]["relationships"])
+    after = ""
+    while True:
+        records = conn.read(
+            query,
+            database=conn.database_of([base_label(label)]),
+            after=after,
+            limit=page_size,
+            rel_types=rel_types,
+        )
+        for record in records:
+            yield node_to_row(conn.schema, label, record["source"], record["rels"])
+        if len(records) < page_size:
+            return
+        after = records[-1]["source"]["id"]
+
+
+def iter_history(conn, page_size=1000):
+    """Yields history records in time order, one page at a time"""
+    query = history_cypher()
+    after, after_id = "", ""
+    while True:
+        records = conn.read(query, after=after, after_id=after_id, limit=page_size)
+        for record in records:
+            row = dict(record["h"])
+            row["resourceLabel"] = record["resourceLabel"]
+            yield row
+        if len(records) < page_size:
+            return
+        after, after_id = records[-1]["h"]["timeStamp"], records[-1]["element_id"]
+
+
+def export_label(conn, label, path, page_size=1000, compress=False):
+    """
+    Streams a label (or its _archived_ label, or historyRecord) to an NDJSON file.
+    Returns the number of rows written.
+    """
+    if label == HISTORY_LABEL:
+        rows = iter_history(conn, page_size)
+    elif base_label(label) in conn.schema:
+        rows = iter_label(conn, label, page_size)
+    else:
+        raise ValueError(f"{label} label not found in schema.")
+    count = 0
+    with open_output(path, compress) as handle:
+        for row in rows:
+            handle.write(json.dumps(row) + "\n")
+            count += 1
+    return count
+
+
+def export_all(
+    conn,
+    directory,
+    labels=None,
+    include_archived=False,
+    include_history=False,
+    compress=False,
+    page_size=1000,
+    progress=None,
+):
+    """
+    Exports labels to a directory, one file per label, plus a manifest which
+    lists the files in the order they should be imported.
+    progress: called with (label, rows) after each file
+    Returns the manifest.
+    """
+    os.makedirs(directory, exist_ok=True)
+    labels = labels or list(conn.schema)
+    export_labels = []
+    for label in export_order(conn.schema):
+        if label not in labels:
+            continue
+        export_labels.append(label)
+        if include_archived:
+            export_labels.append(ARCHIVED_PREFIX + label)
+    if include_history:
+        export_labels.append(HISTORY_LABEL)
+
+    manifest = {"files": []}
+    for label in export_labels:
+        file_name = label + (".ndjson.gz" if compress else ".ndjson")
+        rows = export_label(
+            conn, label, os.path.join(directory, file_name), page_size, compress
+        )
+        manifest["files"].append({"label": label, "file": file_name, "rows": rows})
+        if progress:
+            progress(label, rows)
+
+    with open(os.path.join(directory, MANIFEST), "w", encoding="utf-8") as handle:
+        json.dump(manifest, handle, indent=2)
+    return manifest
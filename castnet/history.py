@@ -0,0 +1,381 @@
+"""
+History sinks, which record historyRecords outside of the user's transaction.
+
+By default (history="inline") CastNetConn.add_history splices the historyRecord
+into every write query. A sink instead receives the record after the write
+succeeded:
+    BatchedHistorySink queues records in process and writes them in UNWIND
+        batches on a background thread.
+    FileHistorySink appends records to a local NDJSON file.
+
+ChangeConsumer follows the historyRecords as a change feed, see
+CastNetConn.changes_since.
+"""
+import abc
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+HISTORY_MODES = ["inline", "batched", "file"]
+
+
+def history_record(label, resource_id, method, requester=None, json_request=None):
+    """Builds the properties of a historyRecord, as add_history does"""
+    record = {
+        "label": label,
+        "timeStamp": str(datetime.now().isoformat()),
+        "email": requester,
+        "method": method,
+        "resourceId": resource_id,
+        "jsonRequest": None,
+    }
+    if method in ["PATCH", "POST"]:
+        record["jsonRequest"] = json.dumps(json_request)
+    return record
+
+
+def history_flush_cypher(label):
+    """
+    Builds the query writing a batch of history records of one label. Records
+    are linked to their resource whether or not it has been archived since.
+    """
+    return (
+        "UNWIND $records AS rec\n"
+        "CREATE (n:historyRecord {timeStamp: rec.timeStamp, email: rec.email,"
+        " method: rec.method, resourceId: rec.resourceId, jsonRequest: rec.jsonRequest})\n"
+        "WITH n, rec\n"
+        f"OPTIONAL MATCH (live:{label} {{id: rec.resourceId}})\n"
+        f"OPTIONAL MATCH (archived:_archived_{label} {{id: rec.resourceId}})\n"
+        "WITH n, coalesce(live, archived) AS source\n"
+        "WHERE source IS NOT NULL\n"
+        "CREATE (n)-[:RESOURCE_ID]->(source)"
+    )
+
+
+# seconds for a write transaction to commit after its records are stamped
+COMMIT_LAG = 1.0
+
+
+class HistorySink(abc.ABC):
+    """
+    Base class of history sinks. Subclasses implement _write(records).
+    """
+
+    # seconds a record may wait between history_record and its write
+    delay = 0.0
+
+    def __init__(self):
+        self._counts = threading.Lock()
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def _add(self, **counts):
+        """Increments counters, sinks are called from every request thread"""
+        with self._counts:
+            for key, value in counts.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def submit(self, record):
+        """Accepts a record built by history_record"""
+        self._add(submitted=1)
+        self._write([record])
+
+    @abc.abstractmethod
+    def _write(self, records):
+        """Writes records"""
+
+    def flush(self):
+        """Writes out anything buffered"""
+
+    def close(self):
+        """Flushes and releases the sink"""
+        self.flush()
+
+    def metrics(self):
+        """Counters for monitoring"""
+        return {
+            "queue_depth": 0,
+            "submitted": self.submitted,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+
+class FileHistorySink(HistorySink):
+    """
+    Appends history records to a local NDJSON file
+    """
+
+    def __init__(self, path, flush_every=1):
+        super().__init__()
+        self.path = path
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._handle = open(path, "a", encoding="utf-8")  # pylint: disable=consider-using-with
+        self._unflushed = 0
+
+    def _write(self, records):
+        with self._lock:
+            if self._handle.closed:
+                self._add(dropped=len(records))
+                return
+            for record in records:
+                self._handle.write(json.dumps(record) + "\n")
+            self._add(written=len(records))
+            self._unflushed += len(records)
+            if self._unflushed >= self.flush_every:
+                self._handle.flush()
+                self._unflushed = 0
+
+    def flush(self):
+        with self._lock:
+            if not self._handle.closed:
+                self._handle.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._handle.closed:
+                self._handle.close()
+
+
+class BatchedHistorySink(HistorySink):
+    """
+    Queues history records and writes them in UNWIND batches on a background
+    thread. The queue is bounded: when it is full, submit waits up to
+    put_timeout seconds and then drops the record (or hands it to fallback),
+    as it does with records submitted after close. Records which fail to
+    write are also handed to fallback, if given.
+
+    Records keep the timeStamp of the change and are written up to delay
+    seconds later, longer if the writer falls behind (see queue_depth).
+    """
+
+    def __init__(
+        self,
+        conn,
+        batch_size=500,
+        flush_interval=1.0,
+        max_queue=10000,
+        put_timeout=1.0,
+        fallback=None,
+    ):
+        super().__init__()
+        self.conn = conn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.put_timeout = put_timeout
+        self.fallback = fallback
+        self.batches = 0
+        self.last_flush_seconds = None
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closed = threading.Event()
+        self._flushing = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, name="castnet-history", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def delay(self):
+        return self.flush_interval + self.put_timeout
+
+    def submit(self, record):
+        self._add(submitted=1)
+        if self._closed.is_set():
+            self._drop(record)
+            return
+        try:
+            self._queue.put(record, timeout=self.put_timeout)
+        except queue.Full:
+            self._drop(record)
+            return
+        # closed while queueing, close may have flushed already
+        if self._closed.is_set():
+            self.flush()
+
+    def _drop(self, record):
+        self._add(dropped=1)
+        if self.fallback:
+            self.fallback.submit(record)
+
+    def _take(self, timeout, limit=None):
+        """Takes up to limit records, waiting up to timeout for the first"""
+        limit = limit or self.batch_size
+        records = []
+        try:
+            records.append(self._queue.get(timeout=timeout))
+            while len(records) < limit:
+                records.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return records
+
+    def _run(self):
+        while not self._closed.is_set():
+            deadline = time.monotonic() + self.flush_interval
+            records = []
+            while len(records) < self.batch_size and not self._closed.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                records += self._take(
+                    min(remaining, 0.1), self.batch_size - len(records)
+                )
+            if records:
+                self._write(records)
+
+    def _write(self, records):
+        with self._flushing:
+            started = time.monotonic()
+            by_label = {}
+            for record in records:
+                by_label.setdefault(record["label"], []).append(record)
+            for label, label_records in by_label.items():
+                try:
+                    self.conn.write(
+                        history_flush_cypher(label),
+                        database=self.conn.database_of([label]),
+                        records=label_records,
+                    )
+                    self._add(written=len(label_records))
+                except Exception:  # pylint: disable=broad-except
+                    self._add(failed=len(label_records))
+                    if self.fallback:
+                        for record in label_records:
+                            self.fallback.submit(record)
+            self._add(batches=1)
+            self.last_flush_seconds = time.monotonic() - started
+
+    def flush(self):
+        """Writes everything queued so far from the calling thread"""
+        while True:
+            records = self._take(0)
+            if not records:
+                return
+            self._write(records)
+
+    def close(self, timeout=None):
+        """
+        Stops the background thread and writes what is left in the queue. The
+        fallback is flushed but left open, records submitted later go to it.
+        """
+        self._closed.set()
+        self._thread.join(timeout)
+        self.flush()
+        if self.fallback:
+            self.fallback.flush()
+
+    def metrics(self):
+        metrics = super().metrics()
+        metrics.update(
+            {
+                "queue_depth": self._queue.qsize(),
+                "max_queue": self.max_queue,
+                "batches": self.batches,
+                "last_flush_seconds": self.last_flush_seconds,
+            }
+        )
+        return metrics
+
+
+def make_history_sink(conn, history="inline", options=None):
+    """
+    Creates the sink for CastNetConn's history mode. Returns None for inline.
+    history: "inline", "batched", "file" or a HistorySink instance
+    options: keyword arguments of the sink, e.g. {"path": "history.ndjson"}
+    """
+    options = options or {}
+    if isinstance(history, HistorySink):
+        return history
+    if history == "inline":
+        return None
+    if history == "batched":
+        return BatchedHistorySink(conn, **options)
+    if history == "file":
+        return FileHistorySink(**options)
+    raise ValueError(f"history must be one of {HISTORY_MODES} or a HistorySink.")
+
+
+class ChangeConsumer:
+    """
+    Polls CastNetConn.changes_since and hands each page of changes to a handler.
+    The cursor is saved after the handler returns, so an interrupted consumer
+    picks up where it stopped (a page may be delivered twice, never skipped).
+
+    def index(changes):
+        for change in changes:
+            search.update(change["label"], change["resourceId"])
+
+    ChangeConsumer(CONN, index, cursor_path="indexer.cursor", labels=["Bird"]).run_forever()
+
+    lag: seconds, records younger than this are left for the next poll. It
+        must cover the time between stamping a record and committing it, so
+        None is COMMIT_LAG plus the delay of the connection's history sink.
+    """
+
+    def __init__(
+        self,
+        conn,
+        handler,
+        cursor_path=None,
+        labels=None,
+        page_size=1000,
+        poll_interval=5.0,
+        lag=None,
+    ):
+        self.conn = conn
+        self.handler = handler
+        self.cursor_path = cursor_path
+        self.labels = labels
+        self.page_size = page_size
+        self.poll_interval = poll_interval
+        if lag is None:
+            lag = COMMIT_LAG + getattr(getattr(conn, "history", None), "delay", 0.0)
+        self.lag = lag
+        self.cursor = self._load_cursor()
+        self._stopped = threading.Event()
+
+    def _load_cursor(self):
+        if self.cursor_path and os.path.exists(self.cursor_path):
+            with open(self.cursor_path, "r", encoding="utf-8") as handle:
+                return handle.read().strip() or None
+        return None
+
+    def _save_cursor(self):
+        if not self.cursor_path:
+            return
+        temp_path = self.cursor_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as handle:
+            handle.write(self.cursor or "")
+        os.replace(temp_path, self.cursor_path)
+
+    def run_once(self):
+        """Handles every change available now, returns how many were handled"""
+        handled = 0
+        for page in self.conn.iter_changes(
+            self.cursor, self.labels, self.page_size, self.lag
+        ):
+            self.handler(page["changes"])
+            handled += len(page["changes"])
+            self.cursor = page["cursor"]
+            self._save_cursor()
+            if self._stopped.is_set():
+                break
+        return handled
+
+    def run_forever(self):
+        """Polls until stop() is called"""
+        while not self._stopped.is_set():
+            self.run_once()
+            self._stopped.wait(self.poll_interval)
+
+    def stop(self):
+        """Stops run_forever after the current page"""
+        self._stopped.set()
@@ -0,0 +1,606 @@
+"""
+Bulk import of NDJSON/CSV files into a CastNet managed database.
+
+Rows are validated against the CastNetConn schema, given ids with the same
+generator as generic_post, and written with UNWIND batches. Batches are
+partitioned by their IS_IN parent (or by name for top level labels) so that
+two workers never create children under the same parent at the same time.
+"""
+import csv
+import gzip
+import json
+import os
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+from castnet import MEMORY_SCHEME, CastNetConn, gen_id
+from castnet.casting import ColumnCaster
+from castnet.exporter import HISTORY_LABEL, MANIFEST, base_label
+
+# number of batches a single partition may have queued before we wait on it
+MAX_IN_FLIGHT = 2
+# number of rejected rows kept on the report for inspection
+MAX_REJECT_SAMPLES = 100
+
+_WORKER_CONN = None
+
+
+class ImportReport:
+    """
+    Counters for a single import run of one label
+    """
+
+    def __init__(self, label, path):
+        self.label = label
+        self.path = path
+        self.rows_read = 0
+        self.rows_written = 0
+        self.rows_rejected = 0
+        self.rows_skipped = 0
+        self.rejected = []
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        """Seconds since the import started"""
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rows_per_sec(self):
+        """Rows written per second"""
+        if not self.elapsed:
+            return 0.0
+        return self.rows_written / self.elapsed
+
+    def reject(self, line, error, row=None):
+        """Records a rejected row"""
+        self.rows_rejected += 1
+        if len(self.rejected) < MAX_REJECT_SAMPLES:
+            self.rejected.append({"line": line, "error": str(error), "row": row})
+
+    def as_dict(self):
+        """Summary of the report, suitable for json"""
+        return {
+            "label": self.label,
+            "path": self.path,
+            "rowsRead": self.rows_read,
+            "rowsWritten": self.rows_written,
+            "rowsRejected": self.rows_rejected,
+            "rowsSkipped": self.rows_skipped,
+            "elapsed": round(self.elapsed, 3),
+            "rowsPerSec": round(self.rows_per_sec, 1),
+        }
+
+    def __str__(self):
+        return (
+            f"{self.label}: {self.rows_written} written, {self.rows_rejected} rejected,"
+            f" {self.rows_skipped} skipped, {self.rows_per_sec:.1f} rows/sec"
+        )
+
+
+def detect_format(path):
+    """Guesses the file format from the extension"""
+    path = path.lower()
+    if path.endswith(".gz"):
+        path = path[:-3]
+    if path.endswith(".csv"):
+        return "csv"
+    return "ndjson"
+
+
+def open_input(path):
+    """Opens a text file for reading, gunzipping .gz files"""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, "r", encoding="utf-8", newline="")
+
+
+def read_rows(path, fmt=None):
+    """
+    Yields (line_number, row, error) for an NDJSON or CSV file.
+    Rows which can't be decoded are returned with row=None and the error.
+    """
+    fmt = fmt or detect_format(path)
+    with open_input(path) as handle:
+        if fmt == "csv":
+            # line 1 is the header
+            for line_number, row in enumerate(csv.DictReader(handle), 2):
+                yield line_number, {
+                    key: _csv_value(value) for key, value in row.items()
+                }, None
+            return
+        for line_number, line in enumerate(handle, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as err:
+                yield line_number, None, err
+                continue
+            if not isinstance(row, dict):
+                yield line_number, None, ValueError("Each line must be a JSON object.")
+                continue
+            yield line_number, row, None
+
+
+def _chunks(iterable, size):
+    """Yields lists of up to size items"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _csv_value(value):
+    """CSV cells are strings, lists of ids are written as JSON arrays"""
+    if value and value.startswith("["):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+
+def prepare_row(conn, label, row):
+    """
+    Validates a row against the schema and converts it to the parameters used
+    by the import query. Raises ValueError if the row can't be imported.
+    _archived_ labels are validated against the schema of their live label.
+
+    Return:
+    {
+        "id": "Feeder__20220429__gardenfeeder__abcd1234",
+        "parent": {"id": "House__...", "order_num": 0},
+        "props": {"name": "GardenFeeder", "feederHeight": 1.5},
+        "rels": {"BIRDS_OBSERVED": [{"id": "Bird__...", "order_num": 1}]},
+        "json": '{"name": "GardenFeeder", ...}'
+    }
+    """
+    archived = base_label(label) != label
+    label = base_label(label)
+    row = dict(row)
+    node_id = row.pop("id", None)
+    if not row.get("name"):
+        raise ValueError("You must specify a name.")
+    try:
+        target_ids, props = conn.parse_params(label, row)
+    except ValueError:
+        raise
+    except Exception as err:  # pylint: disable=broad-except
+        raise ValueError(str(err)) from err
+
+    parent = None
+    rels = {}
+    for i, (conn_name, target_id) in enumerate(target_ids):
+        if target_id in ["", None, []]:
+            continue
+        # archived nodes are restored as they were, their parent may be archived too
+        if conn_name == "IS_IN" and not archived:
+            parent = {"id": target_id, "order_num": i}
+            continue
+        rels.setdefault(conn_name, []).append({"id": target_id, "order_num": i})
+
+    if "IS_IN" in conn.schema[label]["relationships"] and not (parent or archived):
+        raise ValueError(
+            "You are missing the parent node. Please specify with the 'IS_IN' relation."
+        )
+    return {
+        "id": node_id or gen_id(label, props["name"]),
+        "parent": parent,
+        "props": props,
+        "rels": rels,
+        "json": json.dumps(row),
+    }
+
+
+def import_cypher(schema, label, history=True, archived_targets=False):
+    """
+    Builds the UNWIND query which creates a batch of prepared rows.
+    Rows whose parent or one of whose targets doesn't exist, or whose name is
+    already taken, are not created; the query returns the ids that were written.
+    archived_targets: also link to _archived_ targets, used to restore exports.
+    _archived_ labels are restored without parent, target or name checks.
+    """
+    archived = base_label(label) != label
+    relationships = schema[base_label(label)]["relationships"]
+    lines = ["UNWIND $rows AS row"]
+    if "IS_IN" in relationships and not archived:
+        lines += [
+            f"MATCH (parent:{relationships['IS_IN']} {{id: row.parent.id}})",
+            "WITH row, parent",
+            f"WHERE NOT EXISTS {{ MATCH (parent)<-[:IS_IN]-(:{label} {{name: row.props.name}}) }}",
+        ]
+    elif not archived:
+        lines += [
+            "WITH row",
+            f"WHERE NOT EXISTS {{ MATCH (:{label} {{name: row.props.name}}) }}",
+        ]
+    if not archived:
+        # like generic_post, a row is rejected if any of its targets is missing
+        for conn_name, tlabel in relationships.items():
+            if conn_name == "IS_IN":
+                continue
+            if isinstance(tlabel, list):
+                tlabel = tlabel[0]
+            exists = f"EXISTS {{ MATCH (:{tlabel} {{id: rel.id}}) }}"
+            if archived_targets:
+                exists += f" OR EXISTS {{ MATCH (:_archived_{tlabel} {{id: rel.id}}) }}"
+            lines.append(
+                f"AND all(rel IN coalesce(row.rels.{conn_name}, []) WHERE {exists})"
+            )
+    lines += [f"CREATE (source:{label} {{id: row.id}})", "SET source += row.props"]
+    if "IS_IN" in relationships and not archived:
+        lines.append(
+            "CREATE (source)-[:IS_IN {order_num: row.parent.order_num}]->(parent)"
+        )
+    for conn_name, tlabel in relationships.items():
+        if conn_name == "IS_IN" and not archived:
+            continue
+        if isinstance(tlabel, list):
+            tlabel = tlabel[0]
+        lines += [
+            "CALL (source, row) {",
+            f"UNWIND coalesce(row.rels.{conn_name}, []) AS rel",
+        ]
+        if archived or archived_targets:
+            lines += [
+                f"OPTIONAL MATCH (live:{tlabel} {{id: rel.id}})",
+                f"OPTIONAL MATCH (archived:_archived_{tlabel} {{id: rel.id}})",
+                "WITH source, rel, coalesce(live, archived) AS target",
+                "WHERE target IS NOT NULL",
+            ]
+        else:
+            lines.append(f"MATCH (target:{tlabel} {{id: rel.id}})")
+        lines += [
+            f"CREATE (source)-[:{conn_name} {{order_num: rel.order_num}}]->(target)",
+            "}",
+        ]
+    if history:
+        lines.append(
+            "CREATE (n:historyRecord {timeStamp: $timeStamp, email: $requester,"
+            ' method: "POST", resourceId: row.id, jsonRequest: row.json})'
+            "-[:RESOURCE_ID]->(source)"
+        )
+    lines.append("RETURN source.id AS id")
+    return "\n".join(lines)
+
+
+def history_import_cypher(label=None):
+    """
+    Builds the UNWIND query which restores exported history records and links
+    them to their resource, which has the given (possibly archived) label.
+    """
+    query = (
+        "UNWIND $rows AS row\n"
+        f"CREATE (n:{HISTORY_LABEL})\n"
+        "SET n += row"
+    )
+    if label:
+        query += (
+            f"\nWITH n, row\nMATCH (source:{label} {{id: row.resourceId}})"
+            "\nCREATE (n)-[:RESOURCE_ID]->(source)"
+        )
+    return query
+
+
+def partition(row, workers):
+    """
+    Chooses the worker for a prepared row. Rows sharing a parent (or a name for
+    top level labels) always go to the same worker, so they are written in order
+    and never contend for the same locks.
+    """
+    key = row["parent"]["id"] if row["parent"] else row["props"]["name"]
+    return zlib.crc32(str(key).encode("utf-8")) % workers
+
+
+def load_checkpoint(path, label, source, workers):
+    """Loads a checkpoint, or starts a new one"""
+    state = {
+        "label": label,
+        "source": os.path.abspath(source),
+        "workers": workers,
+        "committed": [0] * workers,
+        # lines of failed batches at or before committed, retried on resume
+        "failed": [],
+        "written": 0,
+        "complete": False,
+    }
+    if not path or not os.path.exists(path):
+        return state
+    with open(path, "r", encoding="utf-8") as handle:
+        saved = json.load(handle)
+    if saved["label"] != label or saved["source"] != state["source"]:
+        raise ValueError(f"Checkpoint {path} belongs to a different import.")
+    if saved["workers"] != workers:
+        raise ValueError(
+            f"Checkpoint {path} was written with {saved['workers']} workers, "
+            f"resume with the same number."
+        )
+    saved.setdefault("failed", [])
+    return saved
+
+
+def save_checkpoint(path, state):
+    """Atomically writes a checkpoint"""
+    if not path:
+        return
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as handle:
+        json.dump(state, handle)
+    os.replace(temp_path, path)
+
+
+def _init_worker(uri, user, password, schema):
+    """Creates the connection used by a worker process"""
+    global _WORKER_CONN  # pylint: disable=global-statement
+    _WORKER_CONN = CastNetConn(uri, user, password, schema, {})
+
+
+def _write_batch(query, params, database=None):
+    """Writes a batch from a worker process, returns the ids created"""
+    return [r["id"] for r in _WORKER_CONN.write(query, database=database, **params)]
+
+
+def import_file(
+    conn,
+    label,
+    path,
+    fmt=None,
+    batch_size=1000,
+    workers=4,
+    checkpoint=None,
+    rejects=None,
+    processes=True,
+    history=True,
+    requester=None,
+    progress=None,
+    archived_targets=False,
+):
+    """
+    Imports an NDJSON or CSV file of a single label.
+    conn: CastNetConn, used for validation (and writing if processes=False)
+    checkpoint: path of a checkpoint file. An interrupted import with the same
+        checkpoint resumes after the last committed batch of every worker, and
+        retries the rows of batches which failed to write.
+    rejects: path of an NDJSON file where rejected rows are appended
+    processes: write with a pool of processes, otherwise threads. memory:// graphs
+        live in this process, so they are always written with threads.
+    progress: called with the ImportReport after every batch
+    Returns an ImportReport.
+    """
+    if base_label(label) not in conn.schema:
+        raise ValueError(f"{label} label not found in schema.")
+    query = import_cypher(
+        conn.schema, label, history and base_label(label) == label, archived_targets
+    )
+    database = conn.database_of([base_label(label)])
+    state = load_checkpoint(checkpoint, label, path, workers)
+    report = ImportReport(label, path)
+    if state["complete"]:
+        report.finished = time.time()
+        return report
+
+    # a worker process would write to its own copy of an in-memory graph
+    processes = processes and not conn.uri.startswith(MEMORY_SCHEME)
+    # one single worker executor per partition, so a partition is written in order
+    if processes:
+        schema = {
+            key: dict(value, callbacks=[]) for key, value in conn.schema.items()
+        }
+        executors = [
+            ProcessPoolExecutor(
+                max_workers=1,
+                initializer=_init_worker,
+                initargs=(conn.uri, conn.user, conn.password, schema),
+            )
+            for _ in range(workers)
+        ]
+    else:
+        executors = [ThreadPoolExecutor(max_workers=1) for _ in range(workers)]
+
+    reject_handle = open(rejects, "a", encoding="utf-8") if rejects else None
+    buffers = [[] for _ in range(workers)]
+    batch_names = [set() for _ in range(workers)]
+    in_flight = [deque() for _ in range(workers)]
+    failed = set(state["failed"])
+
+    def reject(line, error, row=None):
+        report.reject(line, error, row)
+        if reject_handle:
+            reject_handle.write(
+                json.dumps({"line": line, "error": str(error), "row": row}) + "\n"
+            )
+
+    def finish(worker):
+        future, batch = in_flight[worker].popleft()
+        try:
+            written = set(future.result())
+        except Exception as err:  # pylint: disable=broad-except
+            written = set()
+            for line, prepared, row in batch:
+                reject(line, f"There was an error: {err}", row)
+                failed.add(line)
+        else:
+            for line, prepared, row in batch:
+                failed.discard(line)
+                if prepared["id"] not in written:
+                    reject(
+                        line,
+                        "Parent or target not found, or name already exists.",
+                        row,
+                    )
+        report.rows_written += len(written)
+        state["written"] += len(written)
+        state["committed"][worker] = max(state["committed"][worker], batch[-1][0])
+        state["failed"] = sorted(failed)
+        save_checkpoint(checkpoint, state)
+        if progress:
+            progress(report)
+
+    def submit(worker):
+        batch = buffers[worker]
+        buffers[worker] = []
+        batch_names[worker] = set()
+        params = {
+            "rows": [prepared for _, prepared, _ in batch],
+            "timeStamp": str(datetime.now().isoformat()),
+            "requester": requester,
+        }
+        if processes:
+            future = executors[worker].submit(_write_batch, query, params, database)
+        else:
+            future = executors[worker].submit(
+                lambda: [r["id"] for r in conn.write(query, database=database, **params)]
+            )
+        in_flight[worker].append((future, batch))
+        while len(in_flight[worker]) > MAX_IN_FLIGHT:
+            finish(worker)
+
+    caster = ColumnCaster(conn.schema[base_label(label)]["attributes"])
+    try:
+        for chunk in _chunks(read_rows(path, fmt), batch_size):
+            # cast whole columns at once, detecting date formats once per column
+            cast_rows = [dict(row) for _, row, error in chunk if error is None]
+            cast_errors = caster.cast_rows(cast_rows)
+            position = -1
+            for line, row, error in chunk:
+                report.rows_read += 1
+                if error is not None:
+                    reject(line, error)
+                    continue
+                position += 1
+                if position in cast_errors:
+                    reject(line, cast_errors[position], row)
+                    continue
+                try:
+                    prepared = prepare_row(conn, label, cast_rows[position])
+                except ValueError as err:
+                    reject(line, err, row)
+                    continue
+                worker = partition(prepared, workers)
+                if line <= state["committed"][worker] and line not in failed:
+                    report.rows_skipped += 1
+                    continue
+                name_key = (
+                    (prepared["parent"] or {}).get("id"),
+                    prepared["props"]["name"],
+                )
+                if name_key in batch_names[worker]:
+                    reject(line, f"The name {name_key[1]} already exists.", row)
+                    continue
+                batch_names[worker].add(name_key)
+                buffers[worker].append((line, prepared, row))
+                if len(buffers[worker]) >= batch_size:
+                    submit(worker)
+
+        for worker in range(workers):
+            if buffers[worker]:
+                submit(worker)
+        for worker in range(workers):
+            while in_flight[worker]:
+                finish(worker)
+        state["complete"] = not failed
+        save_checkpoint(checkpoint, state)
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=True)
+        if reject_handle:
+            reject_handle.close()
+        report.finished = time.time()
+    return report
+
+
+def import_files(conn, files, checkpoint_dir=None, rejects_dir=None, **kwargs):
+    """
+    Imports several files in order, e.g. parents before children.
+    files: list of (label, path) tuples
+    Returns a list of ImportReports.
+    """
+    reports = []
+    for label, path in files:
+        checkpoint = (
+            os.path.join(checkpoint_dir, f"{label}.checkpoint.json")
+            if checkpoint_dir
+            else None
+        )
+        rejects = (
+            os.path.join(rejects_dir, f"{label}.rejected.ndjson")
+            if rejects_dir
+            else None
+        )
+        reports.append(
+            import_file(
+                conn, label, path, checkpoint=checkpoint, rejects=rejects, **kwargs
+            )
+        )
+    return reports
+
+
+def import_history(conn, path, batch_size=1000):
+    """
+    Restores a historyRecord export. Returns the number of records written.
+    """
+    labels = set(conn.schema).union(f"_archived_{label}" for label in conn.schema)
+    count = 0
+
+    def flush(batch):
+        by_label = {}
+        for row in batch:
+            label = row.pop("resourceLabel", None)
+            by_label.setdefault(label if label in labels else None, []).append(row)
+        for label, rows in by_label.items():
+            database = conn.database_of([base_label(label)]) if label else None
+            conn.write(history_import_cypher(label), database=database, rows=rows)
+        return len(batch)
+
+    batch = []
+    for _, row, error in read_rows(path, "ndjson"):
+        if error is not None:
+            continue
+        batch.append(row)
+        if len(batch) >= batch_size:
+            count += flush(batch)
+            batch = []
+    if batch:
+        count += flush(batch)
+    return count
+
+
+def import_export(conn, directory, checkpoint_dir=None, rejects_dir=None, **kwargs):
+    """
+    Restores a directory written by castnet.exporter.export_all, in the order of
+    its manifest. Returns a list of ImportReports (history records are counted
+    as written rows).
+    """
+    with open(os.path.join(directory, MANIFEST), "r", encoding="utf-8") as handle:
+        manifest = json.load(handle)
+    kwargs.setdefault("history", False)
+    reports = []
+    for entry in manifest["files"]:
+        path = os.path.join(directory, entry["file"])
+        if entry["label"] == HISTORY_LABEL:
+            report = ImportReport(HISTORY_LABEL, path)
+            report.rows_written = import_history(
+                conn, path, kwargs.get("batch_size", 1000)
+            )
+            report.finished = time.time()
+            reports.append(report)
+            continue
+        reports += import_files(
+            conn,
+            [(entry["label"], path)],
+            checkpoint_dir=checkpoint_dir,
+            rejects_dir=rejects_dir,
+            archived_targets=True,
+            **kwargs,
+        )
+    return reports
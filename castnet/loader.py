@@ -0,0 +1,159 @@
+"""
+Coalescing of node lookups by id, in the manner of DataLoader.
+
+CastNetConn.load_node and load_nodes hand their ids to a NodeLoader, which
+collects the ids asked for within a short window, across threads and asyncio
+tasks, and fetches each label's ids with a single query:
+
+UNWIND $ids AS id MATCH (n:Feeder {id: id}) RETURN n
+
+Every id is fetched once per batch, however many callers asked for it, and
+every caller receives its own copy of the node's properties.
+"""
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+
+
+def load_cypher(label):
+    """Builds the query fetching a batch of nodes of a label by id"""
+    return f"UNWIND $ids AS id MATCH (n:{label} {{id: id}}) RETURN n"
+
+
+def _resolve(future, result=None, error=None):
+    """
+    Sets a future's result or exception, unless it was cancelled: a cancelled
+    asyncio caller no longer wants it, and may cancel at any moment
+    """
+    try:
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+    except InvalidStateError:
+        pass
+
+
+class NodeLoader:
+    """
+    Batches lookups by id on a background thread.
+    window: seconds a batch stays open after its first id arrives
+    max_batch: ids per query, a full batch is fetched without waiting
+    workers: batches fetched at once
+    """
+
+    def __init__(self, conn, window=0.002, max_batch=1000, workers=4):
+        self.conn = conn
+        self.window = window
+        self.max_batch = max_batch
+        self.workers = workers
+        self.requests = 0
+        self.ids_requested = 0
+        self.ids_fetched = 0
+        self.batches = 0
+        self.failed = 0
+        self._pending = {}
+        self._deadlines = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pool = None
+        self._closed = False
+
+    def submit(self, label, ids):
+        """Queues ids, returns a future per id resolving to a dict or None"""
+        futures = []
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("The node loader is closed.")
+            if self._thread is None:
+                self._pool = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix="castnet-loader"
+                )
+                self._thread = threading.Thread(
+                    target=self._run, name="castnet-loader", daemon=True
+                )
+                self._thread.start()
+            pending = self._pending.setdefault(label, {})
+            self._deadlines.setdefault(label, time.monotonic() + self.window)
+            for resource_id in ids:
+                future = Future()
+                pending.setdefault(resource_id, []).append(future)
+                futures.append(future)
+            self.requests += 1
+            self.ids_requested += len(ids)
+            self._cond.notify()
+        return futures
+
+    def _due(self):
+        """Labels whose batch should be fetched now"""
+        now = time.monotonic()
+        return [
+            label
+            for label, deadline in self._deadlines.items()
+            if self._closed or deadline <= now or len(self._pending[label]) >= self.max_batch
+        ]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = self._due()
+                while not due:
+                    if self._closed:
+                        return
+                    timeout = None
+                    if self._deadlines:
+                        timeout = max(0, min(self._deadlines.values()) - time.monotonic())
+                    self._cond.wait(timeout)
+                    due = self._due()
+                batches = []
+                for label in due:
+                    del self._deadlines[label]
+                    waiting = list(self._pending.pop(label).items())
+                    for start in range(0, len(waiting), self.max_batch):
+                        batches.append((label, dict(waiting[start : start + self.max_batch])))
+            for label, waiting in batches:
+                self._pool.submit(self._fetch, label, waiting)
+
+    def _fetch(self, label, waiting):
+        """Fetches a batch and resolves its futures"""
+        with self._cond:
+            self.batches += 1
+            self.ids_fetched += len(waiting)
+        try:
+            records = self.conn.read(
+                load_cypher(label), database=self.conn.database_of([label]), ids=list(waiting)
+            )
+        except Exception as err:  # pylint: disable=broad-except
+            with self._cond:
+                self.failed += 1
+            for futures in waiting.values():
+                for future in futures:
+                    _resolve(future, error=err)
+            return
+        found = {record["n"]["id"]: dict(record["n"]) for record in records}
+        for resource_id, futures in waiting.items():
+            node = found.get(resource_id)
+            for future in futures:
+                _resolve(future, None if node is None else dict(node))
+
+    def metrics(self):
+        """Counters, suitable for json"""
+        with self._cond:
+            queued = sum(len(pending) for pending in self._pending.values())
+        return {
+            "requests": self.requests,
+            "idsRequested": self.ids_requested,
+            "idsFetched": self.ids_fetched,
+            "batches": self.batches,
+            "failed": self.failed,
+            "queued": queued,
+        }
+
+    def close(self):
+        """Fetches what is queued, then stops the background thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+            self._pool.shutdown(wait=True)
@@ -0,0 +1,416 @@
+"""
+Concurrent load test of the generic endpoints, e.g.
+
+castnet loadtest --schema birds.schema:SCHEMA --uri memory://load --workers 16 \
+  --duration 10 --mix post=4,patch=4,delete=1,graphql=1
+
+Workers (threads or asyncio tasks) call generic_post, generic_patch,
+generic_delete and generic_graphql with Flask-Request like objects, the way
+a backend does. Before the run every label gets a few seeded nodes. Posts are
+created under the seeded parents, so workers contend on shared parents, and
+only nodes created during the run are deleted.
+
+Without a uri the test runs against the in-memory stand-in (castnet.memory),
+where --fault-rate injects retryable failures.
+"""
+import asyncio
+import copy
+import itertools
+import math
+import random
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+OPERATIONS = ["post", "patch", "delete", "graphql"]
+DEFAULT_MIX = {"post": 4, "patch": 4, "delete": 1, "graphql": 1}
+LOADTEST_MODES = ["threads", "asyncio"]
+BASE_ATTRIBUTES = ["id", "name", "description"]
+
+
+class FakeRequest:
+    """
+    Flask-Request like object, with the attributes the generic endpoints use
+    """
+
+    def __init__(self, method, path, json=None, headers=None):
+        self.method = method
+        self.path = path
+        self.json = json
+        self.headers = headers or {}
+
+
+def parse_mix(value):
+    """Parses 'post=4,patch=4,delete=1,graphql=1' into weights"""
+    mix = {}
+    for part in value.split(","):
+        operation, _, weight = part.partition("=")
+        operation = operation.strip().lower()
+        if operation not in OPERATIONS:
+            raise ValueError(f"Operations must be among {OPERATIONS}, not '{operation}'.")
+        mix[operation] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("The mix needs a positive weight.")
+    return mix
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, math.ceil(fraction * len(values)) - 1))
+    return values[index]
+
+
+def routed_copy(conn, url_key):
+    """
+    A shallow copy of conn which also routes url_key, the caller's url_key is
+    left alone. Routing only reads url_key, so the copy shares everything else
+    with conn: the driver and its lock, the graphql pool, history sink,
+    callbacks, loader and compiled schema caches. They're started before
+    copying so the copy never starts its own, and conn.close() closes them all.
+    """
+    # pylint: disable=protected-access
+    conn._get_graphql_pool()
+    routed = copy.copy(conn)
+    routed.url_key = dict(conn.url_key, **url_key)
+    return routed
+
+
+class OperationStats:
+    """
+    Latencies and outcomes of one operation
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.last_error = None
+
+    def record(self, seconds, status=None, error=None):
+        """Records a call, from any worker thread"""
+        with self._lock:
+            self.latencies.append(seconds)
+            if error is not None:
+                self.errors += 1
+                self.last_error = repr(error)
+            else:
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def as_dict(self, elapsed):
+        """Summary, latencies in milliseconds"""
+        with self._lock:
+            latencies = sorted(self.latencies)
+            statuses = dict(self.statuses)
+        return {
+            "calls": len(latencies),
+            "perSec": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            "p50": _ms(percentile(latencies, 0.50)),
+            "p95": _ms(percentile(latencies, 0.95)),
+            "p99": _ms(percentile(latencies, 0.99)),
+            "max": _ms(latencies[-1] if latencies else None),
+            "statuses": {str(k): v for k, v in sorted(statuses.items())},
+            "errors": self.errors,
+            "lastError": self.last_error,
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+class LoadTestReport:
+    """
+    Outcome of a load test run
+    """
+
+    def __init__(self, workers, mode):
+        self.workers = workers
+        self.mode = mode
+        self.operations = {operation: OperationStats() for operation in OPERATIONS}
+        self.started = time.time()
+        self.finished = None
+        self.server = None
+
+    @property
+    def elapsed(self):
+        """Seconds since the run started"""
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def calls(self):
+        """Calls made, whatever their outcome"""
+        return sum(len(stats.latencies) for stats in self.operations.values())
+
+    @property
+    def calls_per_sec(self):
+        """Throughput of the whole run"""
+        if not self.elapsed:
+            return 0.0
+        return self.calls / self.elapsed
+
+    def as_dict(self):
+        """Summary of the report, suitable for json"""
+        return {
+            "workers": self.workers,
+            "mode": self.mode,
+            "elapsed": round(self.elapsed, 3),
+            "calls": self.calls,
+            "callsPerSec": round(self.calls_per_sec, 1),
+            "operations": {
+                operation: stats.as_dict(self.elapsed)
+                for operation, stats in self.operations.items()
+                if stats.latencies
+            },
+            "server": self.server,
+        }
+
+    def __str__(self):
+        lines = [
+            f"{self.calls} calls in {self.elapsed:.1f}s with {self.workers}"
+            f" {'threads' if self.mode == 'threads' else 'asyncio tasks'},"
+            f" {self.calls_per_sec:.1f} calls/sec",
+            f"{'operation':<10} {'calls':>7} {'/sec':>8} {'p50 ms':>9} {'p95 ms':>9}"
+            f" {'p99 ms':>9}  statuses",
+        ]
+        for operation, summary in self.as_dict()["operations"].items():
+            statuses = dict(summary["statuses"])
+            if summary["errors"]:
+                statuses["raised"] = summary["errors"]
+            lines.append(
+                f"{operation:<10} {summary['calls']:>7} {summary['perSec']:>8.1f}"
+                f" {summary['p50']:>9.2f} {summary['p95']:>9.2f} {summary['p99']:>9.2f}"
+                f"  {statuses}"
+            )
+        return "\n".join(lines)
+
+
+def _value(param_type, rng):
+    """A random value for an attribute, as a client would send it"""
+    if param_type is str:
+        return f"value {rng.randrange(1_000_000)}"
+    if param_type is int:
+        return rng.randrange(1_000_000)
+    if param_type is float:
+        return rng.random() * 1000
+    if param_type is bool:
+        return rng.random() < 0.5
+    if param_type is datetime:
+        return datetime(2022, 1, 1, rng.randrange(24), rng.randrange(60)).isoformat()
+    if param_type is date:
+        return date(2022, 1, 1 + rng.randrange(28)).isoformat()
+    return None
+
+
+class Workload:
+    """
+    Builds the requests of a load test and tracks the nodes they create.
+    labels: labels to exercise, default every label of the schema. Labels
+        without a url key get one named after the label.
+    seed: nodes created per label (and per parent label) before the run
+    """
+
+    def __init__(self, conn, labels=None, seed=4, random_seed=None):
+        self.conn = conn
+        self.labels = labels or [
+            label for label in conn.schema if not label.startswith("historyRecord")
+        ]
+        # labels are seeded parents first, including parents of labels not tested
+        self.seeded = []
+        for label in self.labels:
+            chain = []
+            while label and label not in self.seeded and label not in chain:
+                chain.insert(0, label)
+                label = self._parent_label(label)
+            self.seeded += chain
+        self.paths = {label: path for path, label in conn.url_key.items()}
+        missing = [label for label in self.seeded if label not in self.paths]
+        if missing:
+            self.conn = routed_copy(conn, {label: label for label in missing})
+            self.paths.update({label: label for label in missing})
+        self.seed = seed
+        self.rng = random.Random(random_seed)
+        # names are unique per parent, runs against the same database must not collide
+        self.prefix = f"loadtest-{secrets.token_hex(4)}"
+        self.names = itertools.count()
+        self.parents = {}
+        self.created = {label: [] for label in self.labels}
+        self._lock = threading.Lock()
+
+    def _parent_label(self, label):
+        return self.conn.schema[label]["relationships"].get("IS_IN")
+
+    def _attributes(self, label):
+        return {
+            key: value
+            for key, value in self.conn.schema[label]["attributes"].items()
+            if key not in BASE_ATTRIBUTES
+        }
+
+    def post_request(self, label, rng):
+        """A POST creating a node under a seeded parent"""
+        body = {"name": f"{self.prefix}-{next(self.names)}"}
+        parent_label = self._parent_label(label)
+        if parent_label:
+            body["IS_IN"] = rng.choice(self.parents[parent_label])
+        for key, param_type in self._attributes(label).items():
+            value = _value(param_type, rng)
+            if value is not None:
+                body[key] = value
+        return FakeRequest("POST", f"/{self.paths[label]}", body)
+
+    def setup(self):
+        """Seeds every label, parents first"""
+        for label in self.seeded:
+            self.parents[label] = []
+            for _ in range(self.seed):
+                data, status = self.conn.generic_post(self.post_request(label, self.rng))
+                if status != 200:
+                    raise RuntimeError(f"Seeding {label} failed: {data}")
+                self.parents[label].append(data[0]["id"])
+
+    def _pick(self, label, rng, pop=False):
+        with self._lock:
+            created = self.created[label]
+            if pop:
+                if not created:
+                    return None
+                return created.pop(rng.randrange(len(created)))
+            pool = created + self.parents[label]
+            return rng.choice(pool) if pool else None
+
+    def call(self, operation, rng):
+        """
+        Calls an endpoint, returns the operation it ran and its status. A
+        delete with nothing left to delete posts instead.
+        """
+        label = rng.choice(self.labels)
+        path = self.paths[label]
+        if operation == "post":
+            data, status = self.conn.generic_post(self.post_request(label, rng))
+            if status == 200:
+                with self._lock:
+                    self.created[label].append(data[0]["id"])
+            return operation, status
+        if operation == "delete":
+            resource_id = self._pick(label, rng, pop=True)
+            if resource_id is None:
+                return self.call("post", rng)
+            request = FakeRequest("DELETE", f"/{path}/{resource_id}")
+            return operation, self.conn.generic_delete(request)[1]
+        resource_id = self._pick(label, rng)
+        if operation == "patch":
+            body = {}
+            for key, param_type in self._attributes(label).items():
+                value = _value(param_type, rng)
+                if value is not None:
+                    body[key] = value
+            body = body or {"description": f"patched {rng.randrange(1_000_000)}"}
+            request = FakeRequest("PATCH", f"/{path}/{resource_id}", body)
+            return operation, self.conn.generic_patch(request)[1]
+        attributes = " ".join(["id", "name"] + list(self._attributes(label))[:4])
+        request = FakeRequest(
+            "POST",
+            "/graphql",
+            {"query": f"{{ {label}(id: $id) {{ {attributes} }} }}", "variables": {"id": resource_id}},
+        )
+        return operation, self.conn.generic_graphql(request)[1]
+
+
+def _schedule(mix, duration, operations):
+    """A function telling a worker what to do next, None to stop"""
+    names = [operation for operation in OPERATIONS if mix.get(operation)]
+    weights = [mix[operation] for operation in names]
+    deadline = time.monotonic() + duration if duration else None
+    counter = itertools.count()
+
+    def next_operation(rng):
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        if operations is not None and next(counter) >= operations:
+            return None
+        return rng.choices(names, weights)[0]
+
+    return next_operation
+
+
+def _step(workload, report, next_operation, rng):
+    """Runs one operation, returns False when the worker should stop"""
+    operation = next_operation(rng)
+    if operation is None:
+        return False
+    started = time.perf_counter()
+    try:
+        operation, status = workload.call(operation, rng)
+    except Exception as err:  # pylint: disable=broad-except
+        report.operations[operation].record(time.perf_counter() - started, error=err)
+    else:
+        report.operations[operation].record(time.perf_counter() - started, status)
+    return True
+
+
+def run_loadtest(
+    conn,
+    workers=8,
+    duration=10.0,
+    operations=None,
+    mix=None,
+    mode="threads",
+    labels=None,
+    seed=4,
+    random_seed=None,
+):
+    """
+    Drives a mix of generic endpoint calls from concurrent workers
+    duration: seconds to run for, None to run until operations calls were made
+    operations: total number of calls, None to run for duration
+    mix: weights by operation, see DEFAULT_MIX and parse_mix
+    mode: "threads" or "asyncio". Asyncio tasks hand the (blocking) endpoint
+        calls to a pool of workers threads, like an async web framework would.
+    Returns a LoadTestReport.
+    """
+    if mode not in LOADTEST_MODES:
+        raise ValueError(f"mode must be one of {LOADTEST_MODES}.")
+    if not duration and operations is None:
+        raise ValueError("Specify a duration or a number of operations.")
+    workload = Workload(conn, labels, seed, random_seed)
+    workload.setup()
+    next_operation = _schedule(mix or DEFAULT_MIX, duration, operations)
+    report = LoadTestReport(workers, mode)
+    base_seed = workload.rng.random()
+
+    if mode == "threads":
+
+        def worker(index):
+            rng = random.Random(f"{base_seed}-{index}")
+            while _step(workload, report, next_operation, rng):
+                pass
+
+        with ThreadPoolExecutor(workers, thread_name_prefix="castnet-loadtest") as pool:
+            for future in [pool.submit(worker, i) for i in range(workers)]:
+                future.result()
+    else:
+
+        async def task(index, loop, pool):
+            rng = random.Random(f"{base_seed}-{index}")
+            while await loop.run_in_executor(
+                pool, _step, workload, report, next_operation, rng
+            ):
+                pass
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            with ThreadPoolExecutor(workers, thread_name_prefix="castnet-loadtest") as pool:
+                await asyncio.gather(*[task(i, loop, pool) for i in range(workers)])
+
+        asyncio.run(main())
+
+    report.finished = time.time()
+    server = getattr(workload.conn.driver, "server", None)
+    if server is not None:
+        report.server = server.metrics()
+    return report
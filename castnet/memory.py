@@ -0,0 +1,530 @@
+"""
+An in-memory stand-in for a Neo4j server, for tests and benchmarks.
+
+CastNetConn connects to it when its uri starts with memory://, so the same code
+paths (read, write, auto_commit, stream) run without a database:
+
+conn = CastNetConn("memory://tests", None, None, SCHEMA, URL_KEY)
+conn.generic_post(request)
+
+Servers are named, connecting twice to memory://tests shares the data.
+Options can be given as a query string, e.g. memory://tests?latency=0.002.
+
+Faults and latency can be injected to exercise error handling and retries:
+
+server = get_server("tests")
+server.inject_fault(ServiceUnavailable("gone"), times=2)
+server.inject_fault(TransientError("deadlock"), match="MERGE")
+server.latency = 0.005  # seconds added to every query
+
+Queries are interpreted by castnet.cypher, which supports the Cypher castnet
+generates. Write transactions are serialized, read transactions see committed
+data only between statements.
+"""
+import random
+import threading
+import time
+from datetime import date, datetime
+from urllib.parse import parse_qs, urlparse
+
+from neo4j import WRITE_ACCESS, Record, SummaryCounters
+from neo4j import graph as neo4j_graph
+from neo4j import time as neo4j_time
+from neo4j.exceptions import Neo4jError, ServiceUnavailable
+
+from castnet import MEMORY_SCHEME, cypher
+
+FAULT_STAGES = ["connect", "run", "commit", "after_commit"]
+
+_SERVERS = {}
+_SERVERS_LOCK = threading.Lock()
+
+
+def get_server(name="default", **options):
+    """Returns the named server, creating it with options if it doesn't exist"""
+    with _SERVERS_LOCK:
+        if name not in _SERVERS:
+            _SERVERS[name] = MemoryServer(name, **options)
+        server = _SERVERS[name]
+    for key, value in options.items():
+        setattr(server, key, value)
+    return server
+
+
+def drop_server(name="default"):
+    """Forgets a server and its data"""
+    with _SERVERS_LOCK:
+        _SERVERS.pop(name, None)
+
+
+def memory_driver(uri, auth=None, **config):  # pylint: disable=unused-argument
+    """Creates a driver for a memory:// uri, the counterpart of GraphDatabase.driver"""
+    parsed = urlparse(uri)
+    if parsed.scheme + "://" != MEMORY_SCHEME:
+        raise ValueError(f"Memory uris start with {MEMORY_SCHEME}")
+    options = {}
+    for key, values in parse_qs(parsed.query).items():
+        if key in ["latency", "max_transaction_retry_time"]:
+            options[key] = float(values[-1])
+        else:
+            raise ValueError(f"Unknown memory driver option {key}")
+    return MemoryDriver(get_server(parsed.netloc or "default", **options))
+
+
+class _Fault:
+    def __init__(self, error, times, when, match, probability):
+        self.error = error
+        self.times = times
+        self.when = when
+        self.match = match
+        self.probability = probability
+
+    def applies(self, when, query):
+        if self.when != when or self.times == 0:
+            return False
+        if self.match is not None and (query is None or self.match not in query):
+            return False
+        return random.random() < self.probability
+
+
+class MemoryServer:
+    """
+    Holds the graphs of every database and the injected faults
+    latency: seconds added to every query
+    max_transaction_retry_time: seconds execute_read/execute_write keep retrying
+    """
+
+    def __init__(self, name="default", latency=0.0, max_transaction_retry_time=30.0):
+        self.name = name
+        self.latency = latency
+        self.max_transaction_retry_time = max_transaction_retry_time
+        self.graphs = {}
+        self.faults = []
+        self.queries = 0
+        self.transactions = 0
+        self.commits = 0
+        self.rollbacks = 0
+        self.retries = 0
+        self.faults_raised = 0
+        self._lock = threading.Lock()
+
+    def graph(self, database=None):
+        """The graph of a database, created on first use"""
+        database = database or "neo4j"
+        with self._lock:
+            if database not in self.graphs:
+                self.graphs[database] = cypher.Graph(database)
+            return self.graphs[database]
+
+    def inject_fault(self, error=None, times=1, when="run", match=None, probability=1.0):
+        """
+        Makes the next matching operations raise error
+        error: the exception, ServiceUnavailable by default. A retryable error
+            (ServiceUnavailable, TransientError) is retried by execute_read/write.
+        times: how many operations fail, -1 for all of them
+        when: "connect" (opening a session), "run" (before a query runs),
+            "commit" (the transaction is rolled back) or "after_commit" (the
+            transaction is committed, then the error is raised)
+        match: only queries (for commits, transactions) containing this text fail
+        probability: chance of each matching operation failing
+        """
+        if when not in FAULT_STAGES:
+            raise ValueError(f"when must be one of {FAULT_STAGES}")
+        if error is None:
+            error = ServiceUnavailable("Injected fault")
+        with self._lock:
+            self.faults.append(_Fault(error, times, when, match, probability))
+
+    def clear_faults(self):
+        """Removes every injected fault"""
+        with self._lock:
+            self.faults = []
+
+    def check_fault(self, when, query=None):
+        """Raises the first injected fault applying to an operation"""
+        with self._lock:
+            for fault in self.faults:
+                if fault.applies(when, query):
+                    if fault.times > 0:
+                        fault.times -= 1
+                    self.faults_raised += 1
+                    error = fault.error
+                    break
+            else:
+                return
+        raise error
+
+    def delay(self):
+        """Waits for the configured latency"""
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset(self):
+        """Drops all data and faults, keeping the configuration"""
+        with self._lock:
+            self.graphs = {}
+            self.faults = []
+
+    def metrics(self):
+        """Counters, suitable for json"""
+        return {
+            "queries": self.queries,
+            "transactions": self.transactions,
+            "commits": self.commits,
+            "rollbacks": self.rollbacks,
+            "retries": self.retries,
+            "faultsRaised": self.faults_raised,
+            "nodes": {name: len(g.nodes) for name, g in self.graphs.items()},
+        }
+
+    def count(self, key):
+        with self._lock:
+            setattr(self, key, getattr(self, key) + 1)
+
+
+class MemoryDriver:
+    """
+    The driver of a MemoryServer, with the parts of neo4j.Driver castnet uses
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.closed = False
+
+    def session(self, database=None, default_access_mode=WRITE_ACCESS, **config):  # pylint: disable=unused-argument
+        """Opens a session"""
+        if self.closed:
+            raise ServiceUnavailable("The driver is closed.")
+        self.server.check_fault("connect")
+        return MemorySession(self.server, database, default_access_mode)
+
+    def execute_query(self, query, parameters=None, database_=None, **kwargs):
+        """Runs a query in a write transaction, returns (records, summary, keys)"""
+
+        def work(tx):
+            result = tx.run(query, parameters, **kwargs)
+            records = list(result)
+            return records, result.consume(), result.keys()
+
+        with self.session(database=database_) as session:
+            return session.execute_write(work)
+
+    def verify_connectivity(self, **config):  # pylint: disable=unused-argument
+        """Raises like a failed connection when a connect fault is injected"""
+        if self.closed:
+            raise ServiceUnavailable("The driver is closed.")
+        self.server.check_fault("connect")
+
+    def close(self):
+        """Closes the driver, the server keeps its data"""
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MemorySession:
+    """
+    A session of a MemoryDriver, with the parts of neo4j.Session castnet uses
+    """
+
+    def __init__(self, server, database=None, default_access_mode=WRITE_ACCESS):
+        self.server = server
+        self.database = database
+        self.default_access_mode = default_access_mode
+        self.closed = False
+        self._transaction = None
+
+    def run(self, query, parameters=None, **kwargs):
+        """Runs a query in an auto-commit transaction"""
+        tx = MemoryTransaction(
+            self.server, self.database, self.default_access_mode == WRITE_ACCESS, implicit=True
+        )
+        try:
+            result = tx.run(query, parameters, **kwargs)
+            tx.commit()
+        finally:
+            tx.close()
+        return result
+
+    def begin_transaction(self, metadata=None, timeout=None):  # pylint: disable=unused-argument
+        """Begins an explicit transaction"""
+        if self._transaction and not self._transaction.closed:
+            raise cypher_error(
+                cypher.CypherError(
+                    "Neo.ClientError.Transaction.TransactionStartFailed",
+                    "Explicit transaction already open in this session.",
+                )
+            )
+        self._transaction = MemoryTransaction(
+            self.server,
+            self.database,
+            self.default_access_mode == WRITE_ACCESS,
+            timeout=timeout,
+        )
+        return self._transaction
+
+    def _execute(self, write, work, args, kwargs):
+        """Runs work(tx, ...) in a transaction, retrying retryable errors"""
+        timeout = getattr(work, "timeout", None)
+        deadline = time.monotonic() + self.server.max_transaction_retry_time
+        delay = 0.001
+        while True:
+            tx = MemoryTransaction(self.server, self.database, write, timeout=timeout)
+            try:
+                result = work(tx, *args, **kwargs)
+                tx.commit()
+                return result
+            except Neo4jError as err:
+                if not err.is_retryable() or time.monotonic() > deadline:
+                    raise
+            except ServiceUnavailable:
+                if time.monotonic() > deadline:
+                    raise
+            finally:
+                tx.close()
+            self.server.count("retries")
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+    def execute_read(self, work, *args, **kwargs):
+        """Runs work(tx, *args, **kwargs) in a read transaction with retries"""
+        return self._execute(False, work, args, kwargs)
+
+    def execute_write(self, work, *args, **kwargs):
+        """Runs work(tx, *args, **kwargs) in a write transaction with retries"""
+        return self._execute(True, work, args, kwargs)
+
+    read_transaction = execute_read
+    write_transaction = execute_write
+
+    def last_bookmarks(self):
+        """Bookmarks are meaningless in memory"""
+        return None
+
+    def close(self):
+        """Closes the session, rolling back an open explicit transaction"""
+        if self._transaction:
+            self._transaction.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def cypher_error(error):
+    """Converts a CypherError to the driver's exception for its code"""
+    return Neo4jError._hydrate_neo4j(  # pylint: disable=protected-access
+        code=error.code, message=error.message
+    )
+
+
+def _to_cypher(value):
+    """Converts Python parameters to the values the database would store"""
+    if isinstance(value, datetime):
+        return neo4j_time.DateTime.from_native(value)
+    if isinstance(value, date):
+        return neo4j_time.Date.from_native(value)
+    if isinstance(value, (list, tuple)):
+        return [_to_cypher(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _to_cypher(v) for k, v in value.items()}
+    return value
+
+
+class MemoryTransaction:
+    """
+    A transaction of a MemorySession. Write transactions hold the graph's lock
+    until they commit or roll back, read transactions only while a query runs.
+    """
+
+    def __init__(self, server, database, write, implicit=False, timeout=None):
+        self.server = server
+        self.graph = server.graph(database)
+        self.write = write
+        self.implicit = implicit
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.undo = []
+        self.queries = []
+        self.closed = False
+        if write:
+            self.graph.lock.acquire()  # pylint: disable=consider-using-with
+        server.count("transactions")
+
+    def run(self, query, parameters=None, **kwargs):
+        """Runs a query, a failure rolls back the whole transaction"""
+        if self.closed:
+            raise cypher_error(
+                cypher.CypherError(
+                    "Neo.ClientError.Transaction.TransactionNotFound",
+                    "The transaction has been closed.",
+                )
+            )
+        params = _to_cypher({**(parameters or {}), **kwargs})
+        self.queries.append(query)
+        self.server.count("queries")
+        self.server.delay()
+        try:
+            self.server.check_fault("run", query)
+            statement = cypher.parse(query)
+            executor = cypher.Executor(
+                self.graph,
+                params,
+                self.undo,
+                write=self.write,
+                implicit=self.implicit,
+                commit=self._checkpoint,
+                deadline=self.deadline,
+            )
+            if self.write:
+                columns, rows = executor.run(statement)
+            else:
+                with self.graph.lock:
+                    columns, rows = executor.run(statement)
+        except cypher.CypherError as err:
+            self.rollback()
+            raise cypher_error(err) from None
+        except Exception:
+            self.rollback()
+            raise
+        return MemoryResult(columns, rows, executor)
+
+    def _checkpoint(self):
+        """Commits the inner transactions of CALL { } IN TRANSACTIONS"""
+        self.undo.clear()
+
+    def commit(self):
+        """Commits, unless an injected fault rolls the transaction back"""
+        if self.closed:
+            return
+        try:
+            self.server.check_fault("commit", "\n".join(self.queries))
+        except Exception:
+            self.rollback()
+            raise
+        self.undo = []
+        self._release()
+        self.server.count("commits")
+        self.server.check_fault("after_commit", "\n".join(self.queries))
+
+    def rollback(self):
+        """Reverts every change of the transaction"""
+        if self.closed:
+            return
+        cypher.rollback(self.undo)
+        self._release()
+        self.server.count("rollbacks")
+
+    def _release(self):
+        self.closed = True
+        if self.write:
+            self.graph.lock.release()
+
+    def close(self):
+        """Rolls back if neither committed nor rolled back"""
+        self.rollback()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+
+class _Summary:
+    """The parts of neo4j.ResultSummary the memory server fills in"""
+
+    def __init__(self, stats, db_hits):
+        self.counters = SummaryCounters(
+            {key.replace("_", "-"): value for key, value in stats.items()}
+        )
+        self.db_hits = db_hits
+
+
+class MemoryResult:
+    """
+    Records of a query, converted to the driver's Record, Node, Relationship and
+    Path types
+    """
+
+    def __init__(self, columns, rows, executor):
+        self._columns = columns
+        self._rows = rows
+        self._executor = executor
+        self._graph = neo4j_graph.Graph()
+        self._entities = {}
+        self._records = None
+
+    def _convert(self, value):
+        if isinstance(value, cypher.Node):
+            if value not in self._entities:
+                self._entities[value] = neo4j_graph.Node(
+                    self._graph, value.element_id, value.id, list(value.labels), dict(value.props)
+                )
+            return self._entities[value]
+        if isinstance(value, cypher.Relationship):
+            if value not in self._entities:
+                rel_class = self._graph.relationship_type(value.type)
+                rel = rel_class(self._graph, value.element_id, value.id, dict(value.props))
+                rel._start_node = self._convert(value.start)  # pylint: disable=protected-access
+                rel._end_node = self._convert(value.end)  # pylint: disable=protected-access
+                self._entities[value] = rel
+            return self._entities[value]
+        if isinstance(value, cypher.Path):
+            return neo4j_graph.Path(
+                self._convert(value.start), *[self._convert(rel) for rel in value.rels]
+            )
+        if isinstance(value, list):
+            return [self._convert(v) for v in value]
+        if isinstance(value, dict):
+            return {k: self._convert(v) for k, v in value.items()}
+        return value
+
+    def records(self):
+        """The records as a list"""
+        if self._records is None:
+            self._records = [
+                Record({column: self._convert(row[column]) for column in self._columns})
+                for row in self._rows
+            ]
+        return self._records
+
+    def __iter__(self):
+        return iter(self.records())
+
+    def keys(self):
+        """The column names"""
+        return list(self._columns)
+
+    def data(self, *keys):
+        """The records as dicts"""
+        return [record.data(*keys) for record in self.records()]
+
+    def single(self, strict=False):
+        """The only record, None if there are none"""
+        records = self.records()
+        if len(records) != 1 and (strict or len(records) > 1):
+            raise ValueError(f"Expected a single record, found {len(records)}.")
+        return records[0] if records else None
+
+    def value(self, key=0, default=None):
+        """A value of the first record"""
+        records = self.records()
+        return records[0].value(key, default) if records else default
+
+    def values(self, *keys):
+        """The values of every record"""
+        return [record.values(*keys) for record in self.records()]
+
+    def consume(self):
+        """The summary, with counters and db hits"""
+        return _Summary(self._executor.stats, self._executor.hits)
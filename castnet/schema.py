@@ -0,0 +1,119 @@
+"""
+Compiled schemas, so a new worker doesn't parse the schema or generate Cypher
+again.
+
+compile_schema parses a schema once into compact LabelSpecs. A connection
+built from the compiled schema caches the Cypher it generates on it (GraphQL
+queries and write templates), and the compiled schema can be saved, warm
+caches included, and loaded by the next worker:
+
+COMPILED = compile_schema(SCHEMA)
+CONN = CastNetConn(uri, user, password, COMPILED, URL_KEY)
+CONN.warm(graphql=[QUERY], writes=[("Feeder", "POST", SAMPLE_BODY)])
+COMPILED.save("schema.pickle")
+
+# in a fresh worker
+CONN = CastNetConn(uri, user, password, load_schema("schema.pickle"), URL_KEY)
+
+Saving uses pickle, attribute types and callbacks are saved by reference: they
+must be importable (e.g. module level functions, not lambdas). Only load
+snapshots you made.
+"""
+import pickle
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+
+# entries per cache, queries with inline arguments would otherwise grow it forever
+CACHE_SIZE = 1024
+# reordering the caches isn't thread safe, and a lock can't be pickled with them
+_CACHE_LOCK = threading.Lock()
+
+
+class LabelSpec(Mapping):
+    """
+    The parsed schema of a label, read like a dict, e.g. spec["relationships"]
+    """
+
+    __slots__ = ("attributes", "relationships", "callbacks", "limits", "graphql", "database")
+
+    def __init__(self, attributes, relationships, callbacks, limits, graphql, database=None):
+        self.attributes = attributes
+        self.relationships = relationships
+        self.callbacks = callbacks
+        self.limits = limits
+        self.graphql = graphql
+        self.database = database
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __repr__(self):
+        return f"LabelSpec({dict(self)!r})"
+
+
+class CompiledSchema(Mapping):
+    """
+    LabelSpecs by label, and caches of the Cypher generated from them
+    version: the castnet version which compiled it
+    """
+
+    __slots__ = ("labels", "caches", "version")
+
+    def __init__(self, labels, version=None):
+        self.labels = labels
+        self.caches = {}
+        self.version = version
+
+    def __getitem__(self, label):
+        return self.labels[label]
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def cached(self, kind, key, build):
+        """
+        The cached value of a key, built if missing. Each cache keeps the
+        CACHE_SIZE most recently used values.
+        """
+        with _CACHE_LOCK:
+            cache = self.caches.setdefault(kind, OrderedDict())
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+                return value
+        value = build()
+        with _CACHE_LOCK:
+            cache[key] = value
+            if len(cache) > CACHE_SIZE:
+                cache.popitem(last=False)
+        return value
+
+    def cache_metrics(self):
+        """Entries per cache, suitable for json"""
+        return {kind: len(cache) for kind, cache in self.caches.items()}
+
+    def save(self, path):
+        """Saves the compiled schema and its caches"""
+        with open(path, "wb") as handle:
+            pickle.dump(self, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        """Loads a compiled schema saved with save"""
+        with open(path, "rb") as handle:
+            compiled = pickle.load(handle)
+        if not isinstance(compiled, CompiledSchema):
+            raise ValueError(f"{path} is not a compiled schema.")
+        return compiled
@@ -0,0 +1,184 @@
+"""
+Materialized views, precomputed GraphQL results per root node.
+
+A view is a GraphQL selection on a root label. Its result for each root is
+stored as json, so reading it is a single key lookup instead of a nested
+traversal:
+
+CONN.register_view("feederTree", "House", "{ name descendantFeeder { name height } }")
+CONN.read_view("feederTree", house_id)
+
+generic_post, generic_patch and generic_delete refresh the roots a write
+affects: the written node if it is a root, else its IS_IN ancestors of the
+root label. Changes the IS_IN hierarchy can't trace (e.g. to a Bird linked to
+a feeder) are not picked up; call refresh_view for those.
+
+Stores:
+    LocalViewStore keeps the json in process (the default).
+    NodeViewStore keeps it on (:_View {view, rootId, json}) companion nodes,
+        shared by every process using the database.
+"""
+import abc
+import threading
+from datetime import datetime
+
+from castnet.encoding import dumps
+
+VIEW_STORES = ["local", "node"]
+
+
+class ViewStore(abc.ABC):
+    """
+    Base class of view stores, keyed by view name and root id. Values are json
+    strings.
+    """
+
+    @abc.abstractmethod
+    def get(self, view, root_id):
+        """The stored json, or None"""
+
+    @abc.abstractmethod
+    def put(self, view, rows):
+        """Stores rows, a dict of root id to json"""
+
+    @abc.abstractmethod
+    def delete(self, view, root_ids):
+        """Forgets roots"""
+
+    @abc.abstractmethod
+    def clear(self, view):
+        """Forgets every root of a view"""
+
+
+class LocalViewStore(ViewStore):
+    """
+    Keeps views in a dict of this process
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, view, root_id):
+        return self._data.get((view, root_id))
+
+    def put(self, view, rows):
+        with self._lock:
+            for root_id, value in rows.items():
+                self._data[(view, root_id)] = value
+
+    def delete(self, view, root_ids):
+        with self._lock:
+            for root_id in root_ids:
+                self._data.pop((view, root_id), None)
+
+    def clear(self, view):
+        with self._lock:
+            for key in [key for key in self._data if key[0] == view]:
+                del self._data[key]
+
+
+class NodeViewStore(ViewStore):
+    """
+    Keeps views on (:_View {view, rootId, json}) nodes in the database
+    """
+
+    label = "_View"
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get(self, view, root_id):
+        records = self.conn.read(
+            f"MATCH (v:{self.label} {{view: $view, rootId: $root_id}}) RETURN v.json AS json",
+            view=view,
+            root_id=root_id,
+        )
+        return records[0]["json"] if records else None
+
+    def put(self, view, rows):
+        self.conn.write(
+            "UNWIND $rows AS row\n"
+            f"MERGE (v:{self.label} {{view: $view, rootId: row.rootId}})\n"
+            "SET v.json = row.json, v.refreshed = $refreshed",
+            view=view,
+            rows=[{"rootId": root_id, "json": value} for root_id, value in rows.items()],
+            refreshed=datetime.now().isoformat(),
+        )
+
+    def delete(self, view, root_ids):
+        self.conn.write(
+            f"MATCH (v:{self.label} {{view: $view}}) WHERE v.rootId IN $root_ids DELETE v",
+            view=view,
+            root_ids=list(root_ids),
+        )
+
+    def clear(self, view):
+        self.conn.write(f"MATCH (v:{self.label} {{view: $view}}) DELETE v", view=view)
+
+    @classmethod
+    def index_cypher(cls):
+        """The index the store's lookups use"""
+        return (
+            f"CREATE RANGE INDEX castnet_{cls.label}_view_rootId IF NOT EXISTS "
+            f"FOR (n:{cls.label}) ON (n.view, n.rootId)"
+        )
+
+
+def make_view_store(conn, store="local"):
+    """
+    Creates the store of a view
+    store: "local", "node" or a ViewStore instance
+    """
+    if isinstance(store, ViewStore):
+        return store
+    if store == "local":
+        return LocalViewStore()
+    if store == "node":
+        return NodeViewStore(conn)
+    raise ValueError(f"store must be one of {VIEW_STORES} or a ViewStore.")
+
+
+class View:
+    """
+    A registered view: a GraphQL selection on a root label, and its store
+    """
+
+    def __init__(self, name, root, selection, store):
+        self.name = name
+        self.root = root
+        selection = selection.strip("\t\n ")
+        if selection.startswith("{"):
+            selection = selection[1 : selection.rfind("}")]
+        # results carry the root's id, so a full rebuild can key them
+        self.selection = "id " + selection.strip("\t\n ")
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    @property
+    def query(self):
+        """The GraphQL query of a single root, by $id"""
+        return f"query {{ {self.root}(id: $id) {{ {self.selection} }} }}"
+
+    @property
+    def all_query(self):
+        """The GraphQL query of every root"""
+        return f"query {{ {self.root} {{ {self.selection} }} }}"
+
+    def metrics(self):
+        """Counters, suitable for json"""
+        return {
+            "root": self.root,
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+        }
+
+
+def encode(result):
+    """Serializes a view result, temporal values as ISO strings"""
+    return dumps(result)
@@ -26,7 +26,8 @@ with open(os.path.join(HERE, 'README.md'), encoding='utf-8') as f:
 setup(
     name="castnet",
     install_requires=['neo4j', 'shortuuid'],
-    packages=find_packages('.'),
+    packages=find_packages('.', exclude=['benchmarks', 'benchmarks.*']),
+    entry_points={"console_scripts": ["castnet=castnet.cli:main"]},
     version=get_version("castnet/__init__.py"),
     license='MIT',
     description='CastNet is a schema based low level Neo4j connection interaction library your Python back end,'
@@ -0,0 +1,112 @@
+"""
+Test callback execution
+"""
+import threading
+import time
+
+import pytest
+
+from castnet import CastNetConn
+from castnet.callbacks import CallbackDispatcher
+
+
+def test_background_callbacks_retry_and_drain():
+    """Failures are retried and close() waits for queued calls"""
+    calls = []
+
+    def flaky(params):
+        calls.append(params["source_id"])
+        if len(calls) == 1:
+            raise IOError("bucket unavailable")
+        time.sleep(0.05)
+
+    dispatcher = CallbackDispatcher()
+    callback = {"callback": flaky, "mode": "thread", "retries": 2, "retry_delay": 0}
+    assert dispatcher.dispatch(callback, {"source_id": "a"}) is not None
+    dispatcher.close()
+    stats = dispatcher.metrics()[callback_key(flaky)]
+    assert calls == ["a", "a"]
+    assert stats["succeeded"] == 1
+    assert stats["errors"] == 1
+    assert stats["retries"] == 1
+    assert stats["inFlight"] == 0
+    assert "bucket unavailable" in stats["lastError"]
+    with pytest.raises(RuntimeError):
+        dispatcher.dispatch(callback, {})
+
+
+def test_background_callbacks_timeout_and_backpressure():
+    """Slow calls time out, calls beyond the queue limit are rejected"""
+    release = threading.Event()
+    dispatcher = CallbackDispatcher()
+    callback = {
+        "callback": lambda params: release.wait(),
+        "name": "slow",
+        "mode": "thread",
+        "timeout": 0.05,
+        "queue_limit": 1,
+        "block": 0,
+    }
+    first = dispatcher.dispatch(callback, {})
+    assert dispatcher.dispatch(callback, {}) is None
+    assert first.result() is False
+    # the abandoned attempt still runs, and keeps its slot
+    assert dispatcher.metrics()["slow"]["inFlight"] == 1
+    assert dispatcher.dispatch(callback, {}) is None
+    release.set()
+    assert dispatcher.dispatch(dict(callback, block=1.0), {}).result() is True
+    dispatcher.close()
+    stats = dispatcher.metrics()["slow"]
+    assert stats["timeouts"] == 1
+    assert stats["failed"] == 1
+    assert stats["succeeded"] == 1
+    assert stats["rejected"] == 2
+    assert stats["inFlight"] == 0
+
+
+def test_process_callbacks():
+    """Picklable callbacks can run in a process pool"""
+    dispatcher = CallbackDispatcher(process_workers=1)
+    future = dispatcher.dispatch({"callback": len, "mode": "process"}, {"a": 1})
+    assert future.result() is True
+    dispatcher.close()
+
+
+def test_run_callbacks_filters_and_isolates():
+    """Only matching callbacks run, background errors don't reach the request"""
+    seen = []
+
+    def broken(params):
+        seen.append(params["num"])
+        raise ValueError("boom")
+
+    schema = {
+        "House": {
+            "attributes": {"num": int},
+            "callbacks": [
+                {
+                    "callback": broken,
+                    "methods": ["PATCH"],
+                    "attributes": ["num"],
+                    "mode": "thread",
+                },
+                {"callback": seen.append, "methods": ["DELETE"]},
+            ],
+        }
+    }
+    conn = CastNetConn(None, None, None, schema, {})
+    conn._run_callbacks("House", "PATCH", {"num": 3})
+    conn._run_callbacks("House", "PATCH", {"name": "x"})
+    conn._run_callbacks("House", "POST", {"num": 4})
+    conn.close()
+    assert seen == [3]
+    assert conn.callback_metrics()[callback_key(broken)]["failed"] == 1
+
+    schema["House"]["callbacks"][0]["mode"] = "fork"
+    with pytest.raises(Exception):
+        CastNetConn(None, None, None, schema, {})
+
+
+def callback_key(func):
+    """Name the dispatcher uses for a function"""
+    return f"{func.__module__}.{func.__qualname__}"
@@ -0,0 +1,80 @@
+"""
+Test column casting
+"""
+from datetime import date, datetime
+
+import pytest
+
+from castnet import convert_datetime
+from castnet import casting
+from castnet.casting import ColumnCaster, cast_column, detect_format
+
+
+def test_detect_format():
+    """The format is detected once from the sample"""
+    assert detect_format(["", "01/02/2021", "12/31/2021"], date) == "%m/%d/%Y"
+    assert detect_format(["1/2/21 10:00", None], datetime) == "%m/%d/%y %H:%M"
+    assert detect_format(["2021-01-02T10:00:00", "bad"], datetime) == "iso"
+    assert detect_format([], date) == "iso"
+
+
+def test_cast_column_matches_single_value_casting():
+    """Columns cast to the same values as convert_datetime and parse_params"""
+    values = ["01/02/2021 10:30", "12/31/1999 23:59", "", "02/30/2021 10:00", None]
+    cast, failed = cast_column(values, datetime)
+    assert cast[:2] == [convert_datetime(v) for v in values[:2]]
+    assert cast[2:] == [None, None, None]
+    assert failed == [3]
+
+    values = ["1/2/69 10:00", "1/2/68 10:00"]
+    assert cast_column(values, datetime)[0] == [convert_datetime(v) for v in values]
+
+    cast, failed = cast_column(["2021-01-02", "2021-13-01", "2020-02-29"], date)
+    assert cast == ["2021-01-02", None, "2020-02-29"]
+    assert failed == [1]
+
+    assert cast_column(["1", 2, "", "x"], int) == ([1, 2, None, None], [3])
+    assert cast_column(["1.5", "2"], float) == ([1.5, 2.0], [])
+
+
+def test_cast_without_numpy(monkeypatch):
+    """The numpy fast path is optional"""
+    monkeypatch.setattr(casting, "numpy", None)
+    assert cast_column(["2021-01-02", "x"], date) == (["2021-01-02", None], [1])
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_invalid_dates(monkeypatch, fast):
+    """With or without numpy, only what date.fromisoformat takes is a date"""
+    if fast and casting.numpy is None:
+        pytest.skip("numpy is not installed")
+    if not fast:
+        monkeypatch.setattr(casting, "numpy", None)
+    invalid = ["2021", "2021-03", "today", "2021-01-03T00:00", "2021-02-30"]
+    for value in invalid:
+        assert cast_column(["2021-01-02", value], date, "iso") == (["2021-01-02", None], [1])
+
+
+def test_column_caster():
+    """Rows are cast in place and failures are reported per row"""
+    caster = ColumnCaster({"name": str, "seen": date, "count": int})
+    rows = [
+        {"name": "a", "seen": "01/02/2021", "count": "3", "IS_IN": "x"},
+        {"name": "b", "seen": "13/02/2021"},
+        {"name": "c", "count": "many"},
+    ]
+    errors = caster.cast_rows(rows)
+    assert rows[0] == {"name": "a", "seen": "2021-01-02", "count": 3, "IS_IN": "x"}
+    assert sorted(errors) == [1, 2]
+    assert caster.formats == {"seen": "%m/%d/%Y"}
+
+
+def test_column_caster_blank_first_chunk():
+    """A blank first chunk doesn't lock the column to ISO"""
+    caster = ColumnCaster({"seen": date})
+    assert caster.cast_rows([{"seen": ""}, {"seen": None}]) == {}
+    assert caster.formats == {}
+    rows = [{"seen": "01/02/2021"}, {"seen": "12/31/2021"}]
+    assert caster.cast_rows(rows) == {}
+    assert rows == [{"seen": "2021-01-02"}, {"seen": "2021-12-31"}]
+    assert caster.formats == {"seen": "%m/%d/%Y"}
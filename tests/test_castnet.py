@@ -1,7 +1,9 @@
 """
 Test castnet
 """
-from castnet import CastNetConn
+import re
+
+from castnet import CastNetConn, IdGenerator, gen_id
 
 SCHEMA = {
     "Project": {
@@ -351,3 +353,165 @@ RETURN COLLECT({name: a_1.name}) as AllProjects
 }
 RETURN Project,Instrument,AllProjects"""
     )
+
+
+def test_gen_ids():
+    """Batch ids have the same format as gen_id"""
+    id_format = re.compile(
+        r"Feeder__\d{8}__(\S*)__[23456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz]{8}"
+    )
+    names = ["Back yard #1", "a/b_c.d:e&f+g", 3]
+    single = [gen_id("Feeder", name) for name in names]
+    batch = IdGenerator().gen_ids("Feeder", names)
+    assert [id_format.fullmatch(i).group(1) for i in single] == ["Backyard1", "abcdefg", "3"]
+    assert [id_format.fullmatch(i).group(1) for i in batch] == ["Backyard1", "abcdefg", "3"]
+    assert [i.split("__")[1] for i in batch] == [i.split("__")[1] for i in single]
+    assert len(set(IdGenerator().gen_ids("Feeder", ["same"] * 10000))) == 10000
+
+
+def test_purge_archived():
+    """Archived nodes are purged in rounds of batched transactions"""
+    query = CONN.purge_cypher("Sample", older_than=True, history="summarize", batch_size=500)
+    assert (
+        query
+        == """MATCH (n:_archived_Sample)
+WHERE EXISTS { MATCH (n)<-[:RESOURCE_ID]-(d:historyRecord {method: "DELETE"}) WHERE d.timeStamp < $older_than }
+WITH n LIMIT $round_size
+CALL (n) {
+OPTIONAL MATCH (n)<-[:RESOURCE_ID]-(h:historyRecord)
+WITH n, h ORDER BY h.timeStamp
+WITH n, COLLECT(h) AS records
+CREATE (:historyRecord {timeStamp: $timeStamp, email: $requester, method: "PURGE", resourceId: n.id, summary: [h IN records | h.timeStamp + " " + h.method]})
+FOREACH (h IN records | DETACH DELETE h)
+DETACH DELETE n
+} IN TRANSACTIONS OF 500 ROWS
+RETURN count(n) AS purged"""
+    )
+    assert (
+        CONN.purge_cypher("Sample", relationships_only=True)
+        == """MATCH (n:_archived_Sample)-[r]-()
+WHERE type(r) <> "RESOURCE_ID"
+WITH DISTINCT r LIMIT $round_size
+CALL (r) {
+DELETE r
+} IN TRANSACTIONS OF 1000 ROWS
+RETURN count(r) AS purged"""
+    )
+
+    class PurgeConn(CastNetConn):
+        """Pretends 25 archived samples exist"""
+
+        remaining = 25
+
+        def auto_commit(self, query, **kwargs):
+            purged = min(self.remaining, kwargs["round_size"])
+            self.remaining -= purged
+            return [{"purged": purged}]
+
+    conn = PurgeConn(None, None, None, SCHEMA, URL_KEY)
+    rounds = []
+    summary = conn.purge_archived("Sample", batch_size=2, round_size=10, progress=rounds.append)
+    assert summary == {"label": "Sample", "nodes": 25, "relationships": 0, "history": "keep"}
+    assert [r["nodes"] for r in rounds] == [10, 20, 25]
+
+
+def test_archive_subtree():
+    """Subtrees are archived leaves first, in batches"""
+    assert CONN.subtree_labels("Project") == [
+        ("Injection", 3),
+        ("InjectionSet", 2),
+        ("Sample", 2),
+        ("SampleSet", 1),
+    ]
+    assert CONN.subtree_labels("Sample") == []
+    assert (
+        CONN.subtree_cypher("Project", "Sample", 2)
+        == """MATCH (:Project {id: $source_id})<-[:IS_IN*2]-(source:Sample)
+WITH source LIMIT $batch_size
+REMOVE source:Sample
+SET source:_archived_Sample
+CREATE (:historyRecord {timeStamp: $timeStamp, email: $requester, method: "DELETE", resourceId: source.id})-[:RESOURCE_ID]->(source)
+RETURN source.id AS id"""
+    )
+
+    class TreeConn(CastNetConn):
+        """Pretends a sample set holds 5 samples and nothing else"""
+
+        samples = [f"sample_{i}" for i in range(5)]
+        writes = []
+
+        def read(self, query, max_retries=3, **kwargs):
+            if "count(source)" in query:
+                return [{"count": len(self.samples) if "source:Sample)" in query else 0}]
+            return [{"id": kwargs["source_id"]}]
+
+        def write(self, query, max_retries=3, **kwargs):
+            self.writes.append(query)
+            if "REMOVE source:SampleSet" in query:
+                return [{"source": {"id": kwargs["source_id"]}}]
+            if "REMOVE source:Sample\n" not in query:
+                return []
+            batch = self.samples[: kwargs["batch_size"]]
+            self.samples = self.samples[kwargs["batch_size"] :]
+            return [{"id": sample_id} for sample_id in batch]
+
+    deleted = []
+    schema = dict(SCHEMA)
+    schema["Sample"] = {
+        "IS_IN": "SampleSet",
+        "callbacks": [{"callback": deleted.append, "methods": ["DELETE"]}],
+    }
+    conn = TreeConn(None, None, None, schema, URL_KEY)
+    assert conn.archive_subtree("SampleSet", "set_1", dry_run=True) == {
+        "Injection": 0,
+        "InjectionSet": 0,
+        "Sample": 5,
+        "SampleSet": 1,
+    }
+    rounds = []
+    summary = conn.archive_subtree(
+        "SampleSet", "set_1", batch_size=2, progress=rounds.append
+    )
+    assert summary == {"Injection": 0, "InjectionSet": 0, "Sample": 5, "SampleSet": 1}
+    assert [r["Sample"] for r in rounds if "Sample" in r] == [2, 4, 5, 5]
+    assert [d["source_id"] for d in deleted] == [f"sample_{i}" for i in range(5)]
+    assert "REMOVE source:SampleSet" in conn.writes[-1]
+    assert conn.generic_delete(
+        type("Request", (), {"path": "/samplesets/set_1"}), cascade=True
+    ) == ({"Injection": 0, "InjectionSet": 0, "Sample": 0, "SampleSet": 1}, 200)
+
+
+def test_hierarchy_queries():
+    """Ancestors and subtrees take a single IS_IN traversal"""
+    assert CONN.schema["Injection"]["graphql"]["ancestorProject"] == {
+        "rel": "IS_IN",
+        "dir": "OUT",
+        "lab": "Project",
+        "hops": "3",
+    }
+    cypher = CONN.gql_to_cypher("{Project{name descendantSample{name}}}")
+    assert "MATCH (a_1_1:Sample)-[r:IS_IN*2]->(a_1_s)" in cypher
+    assert (
+        CONN.descendants_cypher("Project", max_depth=2)
+        == """MATCH path = (:Project {id: $source_id})<-[:IS_IN*1..2]-(n)
+WHERE any(l IN labels(n) WHERE l IN $labels)
+RETURN n, [l IN labels(n) WHERE l IN $labels][0] AS label, length(path) AS depth, [x IN nodes(path)[..-1] | x.id] AS path"""
+    )
+
+    class SubtreeConn(CastNetConn):
+        """Streams a project with one sample set holding two samples"""
+
+        def stream(self, query, **kwargs):
+            self.labels = kwargs["labels"]
+            yield {"n": {"id": "sample_2"}, "label": "Sample", "depth": 2, "path": ["p", "set"]}
+            yield {"n": {"id": "set"}, "label": "SampleSet", "depth": 1, "path": ["p"]}
+            yield {"n": {"id": "sample_1"}, "label": "Sample", "depth": 2, "path": ["p", "set"]}
+
+    conn = SubtreeConn(None, None, None, SCHEMA, URL_KEY)
+    flat = conn.get_subtree("Project__20220101__p__abcdefgh")
+    assert [node["id"] for node in flat] == ["set", "sample_1", "sample_2"]
+    assert set(conn.labels) == {"SampleSet", "Sample", "InjectionSet", "Injection"}
+    nested = conn.get_subtree("p", label="Project", nested=True)
+    assert [node["id"] for node in nested] == ["set"]
+    assert [node["id"] for node in nested[0]["__children"]] == ["sample_1", "sample_2"]
+    assert nested[0]["__children"][0]["__parent"] == "set"
@@ -0,0 +1,71 @@
+"""
+Test routing labels to databases
+"""
+import pytest
+
+from castnet import CastNetConn
+from castnet.loadtest import FakeRequest
+from castnet.memory import drop_server, get_server
+
+URI = "memory://test_databases"
+SCHEMA = {
+    "House": {"attributes": {"owner": str}},
+    "Feeder": {"IS_IN": "House", "attributes": {"height": int}},
+    "Bird": {"database": "birds", "attributes": {"species": str}},
+    "Nest": {"database": "birds", "IS_IN": "Bird"},
+}
+URL_KEY = {"houses": "House", "feeders": "Feeder", "birds": "Bird", "nests": "Nest"}
+
+
+def count(conn, label, database=None):
+    return conn.read(f"MATCH (n:{label}) RETURN count(n) AS n", database=database)[0]["n"]
+
+
+def test_schema():
+    """Relationships can't cross databases"""
+    conn = CastNetConn(None, None, None, SCHEMA, URL_KEY)
+    assert conn.databases() == [None, "birds"]
+    assert conn.database_of(["Bird", "Nest"]) == "birds"
+    assert conn.database_of(["House"]) is None
+    with pytest.raises(ValueError):
+        conn.database_of(["House", "Bird"])
+    with pytest.raises(Exception, match="another database"):
+        CastNetConn(None, None, None, dict(SCHEMA, Feeder={"IS_IN": "Bird"}), URL_KEY)
+    with pytest.raises(Exception, match="another database"):
+        CastNetConn(
+            None, None, None, dict(SCHEMA, House={"relationships": {"VISITED_BY": ["Bird"]}}), URL_KEY
+        )
+
+
+def test_routing():
+    """Requests go to the database of their label"""
+    drop_server("test_databases")
+    conn = CastNetConn(URI, None, None, SCHEMA, URL_KEY)
+    statements = conn.ensure_indexes()
+    assert "castnet_Bird_id" in get_server("test_databases").graph("birds").schema
+    assert "castnet_Bird_id" not in get_server("test_databases").graph().schema
+    assert len(statements) > len(conn.index_cypher())
+
+    house = conn.generic_post(FakeRequest("POST", "/houses", {"name": "house"}))[0][0]
+    bird = conn.generic_post(FakeRequest("POST", "/birds", {"name": "robin", "species": "sp"}))[0][0]
+    nest = conn.generic_post(FakeRequest("POST", "/nests", {"name": "nest", "IS_IN": bird["id"]}))
+    assert nest[1] == 200
+    assert (count(conn, "House"), count(conn, "Bird")) == (1, 0)
+    assert (count(conn, "House", "birds"), count(conn, "Bird", "birds")) == (0, 1)
+    assert conn.generic_patch(FakeRequest("PATCH", f"/birds/{bird['id']}", {"species": "other"}))[1] == 200
+    assert conn.load_node("Bird", bird["id"])["species"] == "other"
+    assert [a["id"] for a in conn.get_ancestors(nest[0][0]["id"])] == [bird["id"]]
+
+    # each top level field is read from its own database
+    data = conn.read_graphql("{ House { name } Bird { name descendantNest { name } } }")
+    assert data == {
+        "House": [{"name": "house"}],
+        "Bird": [{"name": "robin", "descendantNest": [{"name": "nest"}]}],
+    }
+    stream = b"".join(conn.stream_graphql("{ House { name } Bird { name } }"))
+    assert stream == b'{"House":[{"name":"house"}],"Bird":[{"name":"robin"}]}'
+
+    assert conn.generic_delete(FakeRequest("DELETE", f"/houses/{house['id']}"))[1] == 200
+    assert count(conn, "_archived_House") == 1
+    conn.close()
+    drop_server("test_databases")
@@ -0,0 +1,57 @@
+"""
+Test response encoding
+"""
+import json
+from datetime import date
+
+import pytest
+from neo4j import Record
+from neo4j import time as neo4j_time
+from neo4j.graph import Graph, Node, Path
+
+from castnet import encoding
+from castnet.encoding import dumps, encode, to_python
+
+
+def make_values():
+    """A node, a relationship and a path as the driver returns them"""
+    graph = Graph()
+    house = Node(graph, "4:x:1", 1, ["House"], {"id": "h", "built": neo4j_time.Date(2021, 1, 2)})
+    feeder = Node(graph, "4:x:2", 2, ["Feeder"], {"id": "f"})
+    rel = graph.relationship_type("IS_IN")(graph, "5:x:1", 1, {"order_num": 0})
+    rel._start_node = feeder  # pylint: disable=protected-access
+    rel._end_node = house  # pylint: disable=protected-access
+    return house, rel, Path(feeder, rel)
+
+
+def test_to_python():
+    """Driver values become dicts, lists and ISO strings in one pass"""
+    house, rel, path = make_values()
+    record = Record({"h": house, "r": rel, "p": path, "n": [1, None]})
+    assert to_python(record) == {
+        "h": {"id": "h", "built": "2021-01-02"},
+        "r": {"order_num": 0},
+        "p": [{"id": "f"}, {"id": "h", "built": "2021-01-02"}],
+        "n": [1, None],
+    }
+    stamp = neo4j_time.DateTime(2021, 1, 2, 10, 30, 0)
+    assert to_python({"t": (stamp, date(2021, 1, 2))}) == {
+        "t": ["2021-01-02T10:30:00", "2021-01-02"]
+    }
+    with pytest.raises(TypeError):
+        to_python({"x": object()})
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_encode(fast, monkeypatch):
+    """orjson is optional, both paths encode the same"""
+    if not fast:
+        monkeypatch.setattr(encoding, "orjson", None)
+    elif encoding.orjson is None:
+        pytest.skip("orjson is not installed")
+    house, _, _ = make_values()
+    data = {"data": {"House": [house, {"seen": neo4j_time.DateTime(2021, 1, 2, 10, 30, 0)}]}}
+    assert json.loads(encode(data)) == {
+        "data": {"House": [{"id": "h", "built": "2021-01-02"}, {"seen": "2021-01-02T10:30:00"}]}
+    }
+    assert json.loads(dumps(data)) == to_python(data)
@@ -0,0 +1,85 @@
+"""
+Test streaming export
+"""
+import gzip
+import json
+
+from castnet import CastNetConn
+from castnet.exporter import export_label, export_order, node_to_row
+from castnet.importer import prepare_row, read_rows
+
+SCHEMA = {
+    "Scan": {
+        "attributes": {"numBirds": int},
+        "relationships": {"BIRDS_OBSERVED": ["Bird"]},
+        "IS_IN": "Feeder",
+    },
+    "Feeder": {"IS_IN": "House"},
+    "House": {},
+    "Bird": {},
+}
+
+
+class PagedConn(CastNetConn):
+    """Serves export pages from a list of nodes instead of a database"""
+
+    def __init__(self, nodes):
+        super().__init__(None, None, None, SCHEMA, {})
+        self.nodes = sorted(nodes, key=lambda n: n[0]["id"])
+        self.queries = 0
+
+    def read(self, query, max_retries=3, **kwargs):
+        self.queries += 1
+        page = [n for n in self.nodes if n[0]["id"] > kwargs["after"]]
+        return [{"source": n, "rels": r} for n, r in page[: kwargs["limit"]]]
+
+
+def test_export_order():
+    """Relationship targets are exported (and imported) first"""
+    assert export_order(CastNetConn(None, None, None, SCHEMA, {}).schema) == [
+        "House",
+        "Feeder",
+        "Bird",
+        "Scan",
+    ]
+
+
+def test_export_round_trip(tmp_path):
+    """Exported rows are ordered, paginated and can be imported again"""
+    nodes = [
+        (
+            {"id": f"scan_{i}", "name": f"Day {i}", "numBirds": i, "description": None},
+            [
+                {"type": "BIRDS_OBSERVED", "id": "robin", "order_num": 2},
+                {"type": "IS_IN", "id": "feeder", "order_num": 0},
+                {"type": "BIRDS_OBSERVED", "id": "jay", "order_num": 1},
+            ],
+        )
+        for i in range(5)
+    ]
+    conn = PagedConn(nodes)
+    path = str(tmp_path / "Scan.ndjson.gz")
+    assert export_label(conn, "Scan", path, page_size=2, compress=True) == 5
+    assert conn.queries == 3
+
+    with gzip.open(path, "rt") as handle:
+        first = json.loads(handle.readline())
+    assert first == {
+        "id": "scan_0",
+        "name": "Day 0",
+        "numBirds": 0,
+        "IS_IN": "feeder",
+        "BIRDS_OBSERVED": ["jay", "robin"],
+    }
+    rows = [row for _, row, _ in read_rows(path)]
+    assert len(rows) == 5
+    prepared = prepare_row(conn, "Scan", rows[0])
+    assert prepared["id"] == "scan_0"
+    assert prepared["parent"] == {"id": "feeder", "order_num": 0}
+    assert [r["id"] for r in prepared["rels"]["BIRDS_OBSERVED"]] == ["jay", "robin"]
+
+    # archived rows keep their parent as a plain relationship
+    archived = node_to_row(conn.schema, "_archived_Scan", nodes[0][0], nodes[0][1])
+    assert prepare_row(conn, "_archived_Scan", archived)["rels"]["IS_IN"] == [
+        {"id": "feeder", "order_num": 0}
+    ]
@@ -0,0 +1,233 @@
+"""
+Test history sinks
+"""
+import json
+import threading
+
+import pytest
+
+from castnet import CastNetConn
+from castnet.history import (
+    COMMIT_LAG,
+    BatchedHistorySink,
+    ChangeConsumer,
+    FileHistorySink,
+    HistorySink,
+    history_flush_cypher,
+    history_record,
+)
+from castnet.loadtest import FakeRequest
+from castnet.memory import drop_server
+
+SCHEMA = {"House": {}, "Feeder": {"IS_IN": "House"}}
+
+
+class RecordingConn:
+    """Records writes instead of sending them to a database"""
+
+    def __init__(self, block=None):
+        self.writes = []
+        self.block = block
+
+    def write(self, query, max_retries=3, **kwargs):
+        if self.block:
+            self.block.wait()
+        self.writes.append((query, kwargs))
+        return []
+
+    def database_of(self, labels):
+        return None
+
+
+def test_history_flush_cypher():
+    """Batches link records to live or archived resources"""
+    assert (
+        history_flush_cypher("Feeder")
+        == """UNWIND $records AS rec
+CREATE (n:historyRecord {timeStamp: rec.timeStamp, email: rec.email, method: rec.method, resourceId: rec.resourceId, jsonRequest: rec.jsonRequest})
+WITH n, rec
+OPTIONAL MATCH (live:Feeder {id: rec.resourceId})
+OPTIONAL MATCH (archived:_archived_Feeder {id: rec.resourceId})
+WITH n, coalesce(live, archived) AS source
+WHERE source IS NOT NULL
+CREATE (n)-[:RESOURCE_ID]->(source)"""
+    )
+
+
+def test_batched_sink_flushes_on_close():
+    """Records are grouped by label and written when the sink closes"""
+    conn = RecordingConn()
+    sink = BatchedHistorySink(conn, batch_size=100, flush_interval=60)
+    for i in range(3):
+        sink.submit(history_record("Feeder", f"f{i}", "PATCH", "a@b.c", {"x": i}))
+    sink.submit(history_record("House", "h1", "DELETE", "a@b.c"))
+    sink.close()
+    assert sink.metrics()["queue_depth"] == 0
+    assert sink.metrics()["written"] == 4
+    written = {query: kwargs["records"] for query, kwargs in conn.writes}
+    assert [r["resourceId"] for r in written[history_flush_cypher("Feeder")]] == [
+        "f0",
+        "f1",
+        "f2",
+    ]
+    assert written[history_flush_cypher("House")][0]["jsonRequest"] is None
+
+
+def test_batched_sink_is_bounded(tmp_path):
+    """A full queue drops records to the fallback sink"""
+    block = threading.Event()
+    fallback = FileHistorySink(str(tmp_path / "history.ndjson"))
+    sink = BatchedHistorySink(
+        RecordingConn(block),
+        batch_size=1,
+        flush_interval=0.01,
+        max_queue=2,
+        put_timeout=0.01,
+        fallback=fallback,
+    )
+    for i in range(10):
+        sink.submit(history_record("House", f"h{i}", "DELETE"))
+    assert sink.metrics()["dropped"] >= 7
+    block.set()
+    sink.close()
+    metrics = sink.metrics()
+    assert metrics["written"] + metrics["dropped"] == 10
+    lines = (tmp_path / "history.ndjson").read_text().splitlines()
+    assert len(lines) == metrics["dropped"]
+    assert json.loads(lines[0])["method"] == "DELETE"
+
+    # records of requests finishing after close are dropped to the fallback too
+    sink.submit(history_record("House", "late", "DELETE"))
+    assert sink.metrics()["dropped"] == metrics["dropped"] + 1
+    fallback.close()
+    fallback.submit(history_record("House", "later", "DELETE"))
+    assert fallback.metrics()["dropped"] == 1
+    lines = (tmp_path / "history.ndjson").read_text().splitlines()
+    assert json.loads(lines[-1])["resourceId"] == "late"
+
+
+def test_sink_counters():
+    """Sinks implement _write, their counters add up across threads"""
+    with pytest.raises(TypeError):
+        HistorySink()  # pylint: disable=abstract-class-instantiated
+    sink = BatchedHistorySink(RecordingConn(), batch_size=1000, flush_interval=0.01)
+
+    def submit():
+        for i in range(500):
+            sink.submit(history_record("House", f"h{i}", "DELETE"))
+
+    threads = [threading.Thread(target=submit) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sink.close()
+    assert sink.metrics()["submitted"] == sink.metrics()["written"] == 2000
+
+
+def test_file_history_mode(tmp_path):
+    """With a sink, write queries no longer create historyRecords"""
+    path = str(tmp_path / "history.ndjson")
+    conn = CastNetConn(
+        None, None, None, SCHEMA, {}, history="file", history_options={"path": path}
+    )
+    query, params = conn.delete_cypher("House", "h1")
+    assert conn._add_history(query, params, "h1", "DELETE", None) == query
+    assert params == {"source_id": "h1"}
+    conn._record_history("House", "h1", "DELETE", "a@b.c")
+    conn.close()
+    record = json.loads(open(path, encoding="utf-8").read())
+    assert record["resourceId"] == "h1"
+    assert record["email"] == "a@b.c"
+
+
+class HistoryConn(CastNetConn):
+    """Serves change feed pages from a list of history records"""
+
+    def __init__(self, records):
+        super().__init__(None, None, None, SCHEMA, {})
+        self.records = records
+
+    def read(self, query, max_retries=3, **kwargs):
+        rows = []
+        for i, (props, labels) in enumerate(self.records):
+            key = (props["timeStamp"], f"4:db:{i:04d}")
+            if key <= (kwargs["after"], kwargs["after_id"]):
+                continue
+            if "labels" in kwargs and not set(labels).intersection(kwargs["labels"]):
+                continue
+            rows.append({"h": props, "element_id": key[1], "labels": labels})
+        return sorted(rows, key=lambda r: (r["h"]["timeStamp"], r["element_id"]))[
+            : kwargs["limit"]
+        ]
+
+
+def test_changes_since(tmp_path):
+    """The change feed pages with exact cursors and filters labels"""
+    records = [
+        (
+            {"timeStamp": f"2022-01-01T00:00:0{i // 2}", "resourceId": f"r{i}"},
+            ["_archived_Feeder"] if i == 3 else ["House"],
+        )
+        for i in range(5)
+    ]
+    conn = HistoryConn(records)
+    page = conn.changes_since(limit=2)
+    assert [c["resourceId"] for c in page["changes"]] == ["r0", "r1"]
+    page = conn.changes_since(page["cursor"], limit=2)
+    assert [c["resourceId"] for c in page["changes"]] == ["r2", "r3"]
+    assert page["changes"][1]["label"] == "Feeder"
+    last = conn.changes_since(page["cursor"], limit=2)
+    assert [c["resourceId"] for c in last["changes"]] == ["r4"]
+    assert conn.changes_since(last["cursor"]) == {"changes": [], "cursor": last["cursor"]}
+    feeders = conn.changes_since(labels=["Feeder"])
+    assert [c["resourceId"] for c in feeders["changes"]] == ["r3"]
+    assert "WHERE any(l IN labels(s) WHERE l IN $labels)" in conn.changes_cypher(True)
+
+    handled = []
+    cursor_path = str(tmp_path / "consumer.cursor")
+    consumer = ChangeConsumer(conn, handled.extend, cursor_path, page_size=2, lag=0)
+    assert consumer.run_once() == 5
+    conn.records.append(({"timeStamp": "2022-01-01T00:00:05", "resourceId": "r5"}, []))
+    assert ChangeConsumer(conn, handled.extend, cursor_path, lag=0).run_once() == 1
+    assert [c["resourceId"] for c in handled] == [f"r{i}" for i in range(6)]
+
+
+def test_consumer_lag_covers_sink():
+    """The default lag waits out records still queued in a batched sink"""
+    inline = CastNetConn(None, None, None, SCHEMA, {})
+    assert ChangeConsumer(inline, print).lag == COMMIT_LAG
+    batched = CastNetConn(
+        None,
+        None,
+        None,
+        SCHEMA,
+        {},
+        history="batched",
+        history_options={"flush_interval": 2.0, "put_timeout": 0.5},
+    )
+    assert ChangeConsumer(batched, print).lag == COMMIT_LAG + 2.5
+    assert ChangeConsumer(batched, print, lag=0).lag == 0
+    batched.close()
+
+
+def test_changes_by_label():
+    """Filtering by label runs against a database"""
+    drop_server("test_changes_by_label")
+    url_key = {"houses": "House", "feeders": "Feeder"}
+    conn = CastNetConn("memory://test_changes_by_label", None, None, SCHEMA, url_key)
+    house = conn.generic_post(FakeRequest("POST", "/houses", {"name": "house"}))[0][0]
+    feeder = conn.generic_post(
+        FakeRequest("POST", "/feeders", {"name": "feeder", "IS_IN": house["id"]})
+    )[0][0]
+    conn.generic_delete(FakeRequest("DELETE", f"/feeders/{feeder['id']}"))
+    page = conn.changes_since(labels=["Feeder"], limit=1)
+    assert [(c["method"], c["label"]) for c in page["changes"]] == [("POST", "Feeder")]
+    page = conn.changes_since(page["cursor"], labels=["Feeder"])
+    assert [(c["method"], c["label"]) for c in page["changes"]] == [("DELETE", "Feeder")]
+
+    handled = []
+    assert ChangeConsumer(conn, handled.extend, labels=["House"], lag=0).run_once() == 1
+    assert handled[0]["resourceId"] == house["id"]
+    conn.close()
+    drop_server("test_changes_by_label")
@@ -0,0 +1,57 @@
+"""
+Test idempotency keys on generic_post
+"""
+from datetime import datetime, timedelta
+
+from castnet import CastNetConn
+from castnet.loadtest import FakeRequest
+from castnet.memory import drop_server, get_server
+
+URI = "memory://test_idempotency"
+SCHEMA = {
+    "House": {"attributes": {"owner": str}},
+    "Feeder": {"IS_IN": "House", "attributes": {"height": int}},
+}
+URL_KEY = {"houses": "House", "feeders": "Feeder"}
+
+
+def count(conn, label):
+    return conn.read(f"MATCH (n:{label}) RETURN count(n) AS n")[0]["n"]
+
+
+def test_idempotency():
+    """Retried posts return the first result instead of writing again"""
+    drop_server("test_idempotency")
+    conn = CastNetConn(URI, None, None, SCHEMA, URL_KEY)
+    conn.ensure_indexes()
+    house = FakeRequest("POST", "/houses", {"name": "house", "owner": "me"})
+    first = conn.generic_post(house, idempotency_key="abc")
+    assert first[1] == 200
+    # a retry doesn't fail on the name the first request took
+    assert conn.generic_post(house, idempotency_key="abc") == first
+    # the header works too
+    headers = {"Idempotency-Key": "abc"}
+    assert conn.generic_post(FakeRequest("POST", "/houses", house.json, headers)) == first
+    assert count(conn, "House") == 1
+    # reusing a key for another request is refused
+    other = FakeRequest("POST", "/houses", {"name": "other", "owner": "me"})
+    assert conn.generic_post(other, idempotency_key="abc")[1] == 422
+
+    # the commit succeeds but the acknowledgement is lost, the driver retries
+    house_id = first[0][0]["id"]
+    feeder = FakeRequest("POST", "/feeders", {"name": "feeder", "IS_IN": house_id, "height": 3})
+    server = get_server("test_idempotency")
+    server.inject_fault(when="after_commit", match="CREATE")
+    response = conn.generic_post(feeder, idempotency_key="def")
+    assert server.faults_raised == 1
+    assert response[1] == 200
+    assert response[0][0]["height"] == 3
+    assert count(conn, "Feeder") == 1
+    assert conn.generic_post(feeder, idempotency_key="def") == response
+
+    # expired keys are forgotten
+    assert conn.purge_idempotency_keys(older_than=datetime.now() + timedelta(seconds=1)) == 2
+    assert count(conn, "_Idempotency") == 0
+    assert conn.generic_post(house, idempotency_key="abc")[1] == 400
+    conn.close()
+    drop_server("test_idempotency")
@@ -0,0 +1,178 @@
+"""
+Test bulk import
+"""
+import json
+
+import pytest
+
+from castnet import CastNetConn
+from castnet.importer import (
+    import_cypher,
+    import_file,
+    load_checkpoint,
+    partition,
+    prepare_row,
+    read_rows,
+    save_checkpoint,
+)
+from castnet.memory import drop_server, get_server
+
+SCHEMA = {
+    "House": {},
+    "Feeder": {"attributes": {"feederHeight": float}, "IS_IN": "House"},
+    "Scan": {
+        "attributes": {"numBirds": int},
+        "relationships": {"BIRDS_OBSERVED": ["Bird"]},
+        "IS_IN": "Feeder",
+    },
+    "Bird": {},
+}
+CONN = CastNetConn(None, None, None, SCHEMA, {})
+
+
+def test_import_cypher():
+    """The UNWIND query matches the parent and creates ordered relationships"""
+    assert (
+        import_cypher(CONN.schema, "Scan")
+        == """UNWIND $rows AS row
+MATCH (parent:Feeder {id: row.parent.id})
+WITH row, parent
+WHERE NOT EXISTS { MATCH (parent)<-[:IS_IN]-(:Scan {name: row.props.name}) }
+AND all(rel IN coalesce(row.rels.BIRDS_OBSERVED, []) WHERE EXISTS { MATCH (:Bird {id: rel.id}) })
+CREATE (source:Scan {id: row.id})
+SET source += row.props
+CREATE (source)-[:IS_IN {order_num: row.parent.order_num}]->(parent)
+CALL (source, row) {
+UNWIND coalesce(row.rels.BIRDS_OBSERVED, []) AS rel
+MATCH (target:Bird {id: rel.id})
+CREATE (source)-[:BIRDS_OBSERVED {order_num: rel.order_num}]->(target)
+}
+CREATE (n:historyRecord {timeStamp: $timeStamp, email: $requester, method: "POST", resourceId: row.id, jsonRequest: row.json})-[:RESOURCE_ID]->(source)
+RETURN source.id AS id"""
+    )
+    assert (
+        import_cypher(CONN.schema, "House", history=False)
+        == """UNWIND $rows AS row
+WITH row
+WHERE NOT EXISTS { MATCH (:House {name: row.props.name}) }
+CREATE (source:House {id: row.id})
+SET source += row.props
+RETURN source.id AS id"""
+    )
+
+
+def test_prepare_row():
+    """Rows are cast with the schema and get generated ids"""
+    prepared = prepare_row(
+        CONN,
+        "Scan",
+        {"name": "Day 1", "IS_IN": "feeder_id", "numBirds": "3",
+         "BIRDS_OBSERVED": ["jay_id", "robin_id"]},
+    )
+    assert prepared["id"].startswith("Scan__")
+    assert prepared["props"] == {"name": "Day 1", "numBirds": 3}
+    assert prepared["parent"] == {"id": "feeder_id", "order_num": 0}
+    assert prepared["rels"] == {
+        "BIRDS_OBSERVED": [
+            {"id": "jay_id", "order_num": 1},
+            {"id": "robin_id", "order_num": 2},
+        ]
+    }
+    # exported rows keep their ids
+    assert prepare_row(CONN, "House", {"id": "h1", "name": "Mine"})["id"] == "h1"
+
+    with pytest.raises(ValueError):
+        prepare_row(CONN, "Scan", {"name": "Day 2"})
+    with pytest.raises(ValueError):
+        prepare_row(CONN, "Scan", {"name": "Day 2", "IS_IN": "f", "numBirds": "x"})
+    with pytest.raises(ValueError):
+        prepare_row(CONN, "House", {"name": "Mine", "color": "red"})
+
+    # siblings are always written by the same worker
+    first = prepare_row(CONN, "Feeder", {"name": "a", "IS_IN": "house_1"})
+    second = prepare_row(CONN, "Feeder", {"name": "b", "IS_IN": "house_1"})
+    assert partition(first, 8) == partition(second, 8)
+
+
+def test_read_rows_and_checkpoints(tmp_path):
+    """NDJSON and CSV files are read per line, checkpoints resume"""
+    ndjson = tmp_path / "houses.ndjson"
+    ndjson.write_text('{"name": "a"}\n\nnot json\n{"name": "b"}\n')
+    rows = list(read_rows(str(ndjson)))
+    assert [(line, row) for line, row, _ in rows] == [
+        (1, {"name": "a"}),
+        (3, None),
+        (4, {"name": "b"}),
+    ]
+    assert rows[1][2] is not None
+
+    csv_file = tmp_path / "scans.csv"
+    csv_file.write_text('name,BIRDS_OBSERVED\nDay 1,"[""a"", ""b""]"\n')
+    assert list(read_rows(str(csv_file))) == [
+        (2, {"name": "Day 1", "BIRDS_OBSERVED": ["a", "b"]}, None)
+    ]
+
+    checkpoint = str(tmp_path / "House.checkpoint.json")
+    state = load_checkpoint(checkpoint, "House", str(ndjson), 2)
+    state["committed"] = [4, 1]
+    save_checkpoint(checkpoint, state)
+    assert load_checkpoint(checkpoint, "House", str(ndjson), 2)["committed"] == [4, 1]
+    with pytest.raises(ValueError):
+        load_checkpoint(checkpoint, "House", str(ndjson), 3)
+    assert json.loads(open(checkpoint, encoding="utf-8").read())["label"] == "House"
+
+
+def test_missing_targets(tmp_path):
+    """Rows linking to a missing target are rejected, like generic_post does"""
+    drop_server("test_missing_targets")
+    conn = CastNetConn("memory://test_missing_targets", None, None, SCHEMA, {})
+    birds = tmp_path / "birds.ndjson"
+    birds.write_text('{"id": "jay", "name": "jay"}\n')
+    # the memory graph lives in this process, so it is written with threads
+    assert import_file(conn, "Bird", str(birds)).rows_written == 1
+    assert conn.read("MATCH (b:Bird) RETURN b.id AS id") == [{"id": "jay"}]
+    houses = tmp_path / "houses.ndjson"
+    houses.write_text('{"id": "house", "name": "house"}\n')
+    import_file(conn, "House", str(houses), processes=False)
+    feeders = tmp_path / "feeders.ndjson"
+    feeders.write_text('{"id": "feeder", "name": "feeder", "IS_IN": "house"}\n')
+    import_file(conn, "Feeder", str(feeders), processes=False)
+    scans = tmp_path / "scans.ndjson"
+    scans.write_text(
+        '{"name": "day1", "IS_IN": "feeder", "BIRDS_OBSERVED": ["jay"]}\n'
+        '{"name": "day2", "IS_IN": "feeder", "BIRDS_OBSERVED": ["jay", "Bird__nope"]}\n'
+    )
+    report = import_file(conn, "Scan", str(scans), processes=False)
+    assert (report.rows_written, report.rows_rejected) == (1, 1)
+    assert report.rejected[0]["line"] == 2
+    assert conn.read("MATCH (s:Scan)-[:BIRDS_OBSERVED]->(b) RETURN s.name, b.id") == [
+        {"s.name": "day1", "b.id": "jay"}
+    ]
+    conn.close()
+    drop_server("test_missing_targets")
+
+
+def test_failed_batches_are_retried(tmp_path):
+    """A batch which failed to write is retried on resume, later ones aren't"""
+    drop_server("test_failed_batches")
+    conn = CastNetConn("memory://test_failed_batches", None, None, SCHEMA, {})
+    houses = tmp_path / "houses.ndjson"
+    houses.write_text('{"name": "a"}\n{"name": "b"}\n')
+    checkpoint = str(tmp_path / "House.checkpoint.json")
+    # fails the first batch and the retries of conn.write
+    get_server("test_failed_batches").inject_fault(RuntimeError("unavailable"), times=4)
+    options = {"batch_size": 1, "workers": 1, "checkpoint": checkpoint, "processes": False}
+    report = import_file(conn, "House", str(houses), **options)
+    assert (report.rows_written, report.rows_rejected) == (1, 1)
+    state = load_checkpoint(checkpoint, "House", str(houses), 1)
+    assert (state["committed"], state["failed"], state["complete"]) == ([2], [1], False)
+
+    report = import_file(conn, "House", str(houses), **options)
+    assert (report.rows_written, report.rows_skipped) == (1, 1)
+    assert load_checkpoint(checkpoint, "House", str(houses), 1)["complete"]
+    assert sorted(conn.read("MATCH (h:House) RETURN h.name AS name"), key=str) == [
+        {"name": "a"},
+        {"name": "b"},
+    ]
+    conn.close()
+    drop_server("test_failed_batches")
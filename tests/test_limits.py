@@ -0,0 +1,85 @@
+"""
+Test transaction timeouts and row limits
+"""
+import pytest
+
+from castnet import CastNetConn, ResultTooLarge
+from castnet.loadtest import FakeRequest
+from castnet.memory import drop_server, get_server
+
+SCHEMA = {
+    "House": {"limits": {"max_rows": 100}},
+    "Feeder": {"IS_IN": "House", "attributes": {"height": int}},
+}
+URL_KEY = {"houses": "House", "feeders": "Feeder"}
+LIMITS = {"timeout": 0.1, "max_rows": 2, "endpoints": {"patch": {"timeout": 5}}}
+
+
+def test_query_limits():
+    """Endpoints override the connection, labels override both"""
+    conn = CastNetConn(None, None, None, SCHEMA, URL_KEY, limits=LIMITS)
+    assert conn.query_limits("graphql", ["Feeder"]) == {"tx_timeout": 0.1, "max_rows": 2}
+    assert conn.query_limits("patch", ["House"]) == {"tx_timeout": 5, "max_rows": 100}
+    # the most permissive label wins
+    assert conn.query_limits("graphql", ["House", "Feeder"])["max_rows"] == 100
+    assert CastNetConn(None, None, None, SCHEMA, URL_KEY).query_limits("post", ["House"]) == {
+        "tx_timeout": None,
+        "max_rows": 100,
+    }
+    with pytest.raises(ValueError):
+        CastNetConn(None, None, None, SCHEMA, URL_KEY, limits={"rows": 1})
+    with pytest.raises(ValueError):
+        CastNetConn(None, None, None, SCHEMA, URL_KEY, limits={"endpoints": {"put": {}}})
+
+
+def test_limits_enforced():
+    """Oversized results return 413, timeouts 504, neither is retried"""
+    conn = CastNetConn("memory://test_limits", None, None, SCHEMA, URL_KEY, limits=LIMITS)
+    for i in range(3):
+        house = conn.generic_post(FakeRequest("POST", "/houses", {"name": f"house{i}"}))[0][0]
+        feeder = {"name": "feeder", "IS_IN": house["id"], "height": i}
+        conn.generic_post(FakeRequest("POST", "/feeders", feeder))
+    feeders = FakeRequest("POST", "/graphql", {"query": "{ Feeder { height } }"})
+    assert conn.generic_graphql(feeders) == ("The result has more than 2 rows.", 413)
+    assert conn.generic_graphql_stream(feeders)[1] == 413
+    assert conn.generic_graphql(FakeRequest("POST", "/graphql", {"query": "{ House { name } }"}))[1] == 200
+    with pytest.raises(ResultTooLarge):
+        conn.read("MATCH (n) RETURN n", max_rows=5)
+    assert len(conn.read("MATCH (n) RETURN n")) > 5
+
+    server = get_server("test_limits")
+    server.latency = 0.2
+    queries = server.queries
+    data, status = conn.generic_graphql(FakeRequest("POST", "/graphql", {"query": "{ House { name } }"}))
+    assert status == 504
+    assert data.startswith("The query timed out")
+    assert server.queries - queries == 1
+    # patch has a longer timeout
+    feeder_id = conn.read("MATCH (f:Feeder) RETURN f.id AS id LIMIT 1")[0]["id"]
+    assert conn.generic_patch(FakeRequest("PATCH", f"/feeders/{feeder_id}", {"height": 9}))[1] == 200
+    conn.close()
+    drop_server("test_limits")
+
+
+@pytest.mark.parametrize("compiler", ["subquery", "projection"])
+def test_graphql_max_rows(compiler):
+    """The database reads one more top level node than max_rows, nested lists aren't limited"""
+    drop_server("test_graphql_max_rows")
+    conn = CastNetConn(
+        "memory://test_graphql_max_rows", None, None, SCHEMA, URL_KEY, graphql_compiler=compiler
+    )
+    house = conn.generic_post(FakeRequest("POST", "/houses", {"name": "house"}))[0][0]
+    for i in range(4):
+        feeder = {"name": f"feeder{i}", "IS_IN": house["id"], "height": i}
+        conn.generic_post(FakeRequest("POST", "/feeders", feeder))
+    cypher = conn.gql_to_cypher("{ Feeder { height } }", limit=True)
+    assert "LIMIT $castnet_max_rows" in cypher
+    assert len(conn.read(cypher, castnet_max_rows=3)[0]["Feeder"]) == 3
+    for parallel in [False, True]:
+        with pytest.raises(ResultTooLarge):
+            conn.read_graphql("{ Feeder { height } }", parallel=parallel, max_rows=3)
+        assert len(conn.read_graphql("{ Feeder { height } }", max_rows=4)["Feeder"]) == 4
+    data = conn.read_graphql("{ House { descendantFeeder { height } } }", "rows", max_rows=1)
+    assert len(data["House"]["rows"][0][0]["rows"]) == 4
+    conn.close()
+    drop_server("test_graphql_max_rows")
@@ -0,0 +1,90 @@
+"""
+Test coalescing of node lookups
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+from castnet import CastNetConn
+from castnet.loader import load_cypher
+from castnet.memory import drop_server, get_server
+
+SCHEMA = {"House": {"attributes": {"owner": str}}}
+
+
+def test_load_nodes():
+    """Concurrent lookups from threads and tasks share a query per window"""
+    name = "test_load_nodes"
+    conn = CastNetConn(f"memory://{name}", None, None, SCHEMA, {}, loader_options={"window": 0.05})
+    conn.write("UNWIND range(0, 9) AS i CREATE (:House {id: 'h' + toString(i), owner: 'ann'})")
+    assert load_cypher("House") == "UNWIND $ids AS id MATCH (n:House {id: id}) RETURN n"
+    queries = get_server(name).queries
+
+    results = {}
+    barrier = threading.Barrier(20)
+
+    def lookup(i):
+        barrier.wait()
+        results[i] = conn.load_nodes("House", [f"h{i % 5}", "missing", f"h{i % 5}"])
+
+    threads = [threading.Thread(target=lookup, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert get_server(name).queries == queries + 1
+    assert results[7] == [{"id": "h2", "owner": "ann"}, None, {"id": "h2", "owner": "ann"}]
+    # every caller gets its own copy
+    results[7][0]["owner"] = "bob"
+    assert results[12][0]["owner"] == "ann"
+    assert conn.loader_metrics()["idsFetched"] == 6
+
+    async def tasks():
+        return await asyncio.gather(*[conn.load_node_async("House", f"h{i}") for i in range(10)])
+
+    assert [node["id"] for node in asyncio.run(tasks())] == [f"h{i}" for i in range(10)]
+    assert get_server(name).queries == queries + 2
+
+    # failures reach every caller of the batch, after conn.read's retries
+    get_server(name).inject_fault(ValueError("broken"), times=-1)
+    with pytest.raises(ValueError):
+        conn.load_node("House", "h1")
+    get_server(name).clear_faults()
+    assert conn.loader_metrics()["failed"] == 1
+    with pytest.raises(ValueError):
+        conn.load_node("Feeder", "f1")
+    conn.close()
+    drop_server(name)
+
+
+class CancelledWhileResolving(Future):
+    """A future its caller cancels just before the loader resolves it"""
+
+    def set_result(self, result):
+        self.cancel()
+        super().set_result(result)
+
+    def set_exception(self, exception):
+        self.cancel()
+        super().set_exception(exception)
+
+
+def test_cancelled_mid_batch():
+    """A caller cancelling while its batch resolves doesn't stop the rest"""
+    name = "test_cancelled_mid_batch"
+    conn = CastNetConn(f"memory://{name}", None, None, SCHEMA, {})
+    conn.write("CREATE (:House {id: 'h0', owner: 'ann'})")
+    cancelled, waiting = CancelledWhileResolving(), Future()
+    conn.loader._fetch("House", {"h0": [cancelled, waiting]})  # pylint: disable=protected-access
+    assert cancelled.cancelled()
+    assert waiting.result(0) == {"id": "h0", "owner": "ann"}
+
+    get_server(name).inject_fault(ValueError("broken"), times=-1)
+    cancelled, waiting = CancelledWhileResolving(), Future()
+    conn.loader._fetch("House", {"h0": [cancelled, waiting]})  # pylint: disable=protected-access
+    with pytest.raises(ValueError):
+        waiting.result(0)
+    conn.close()
+    drop_server(name)
@@ -0,0 +1,80 @@
+"""
+Test the load test harness
+"""
+import pytest
+from neo4j.exceptions import TransientError
+
+from castnet import CastNetConn
+from castnet.loadtest import parse_mix, percentile, routed_copy, run_loadtest
+from castnet.memory import drop_server, get_server
+
+SCHEMA = {
+    "House": {"attributes": {"owner": str}},
+    "Feeder": {"IS_IN": "House", "attributes": {"height": int}},
+    "Scan": {"IS_IN": "Feeder"},
+}
+
+
+def test_parse_mix():
+    """Mixes are weights by operation"""
+    assert parse_mix("post=3, graphql") == {"post": 3.0, "graphql": 1.0}
+    with pytest.raises(ValueError):
+        parse_mix("put=1")
+    assert percentile([1, 2, 3, 4], 0.5) == 2
+    assert percentile([1, 2, 3, 4], 0.99) == 4
+
+
+def test_percentile():
+    """Nearest rank: the smallest value with at least fraction of values at or below it"""
+    values = list(range(1, 101))
+    assert [percentile(values, f) for f in (0.5, 0.95, 0.99, 1.0)] == [50, 95, 99, 100]
+    assert percentile(values, 0) == 1
+    assert percentile([7], 0.99) == 7
+    assert percentile([], 0.5) is None
+
+
+def test_routed_copy():
+    """The copy routes more labels and shares the connection's resources"""
+    conn = CastNetConn("memory://test_routed_copy", None, None, SCHEMA, {"houses": "House"})
+    routed = routed_copy(conn, {"Scan": "Scan"})
+    assert routed.url_key == {"houses": "House", "Scan": "Scan"}
+    assert conn.url_key == {"houses": "House"}
+    assert routed.driver is conn.driver
+    # pylint: disable-next=protected-access
+    assert routed._get_graphql_pool() is conn._get_graphql_pool()
+    conn.close()
+    drop_server("test_routed_copy")
+
+
+def test_run_loadtest():
+    """Runs a mix of calls under retryable faults and reports every call"""
+    conn = CastNetConn("memory://test_run_loadtest", None, None, SCHEMA, {"houses": "House"})
+    get_server("test_run_loadtest").inject_fault(
+        TransientError("deadlock"), times=-1, probability=0.05
+    )
+    report = run_loadtest(
+        conn, workers=4, duration=None, operations=200, mode="asyncio", labels=["Scan"], seed=2
+    )
+    summary = report.as_dict()
+    assert summary["calls"] == 200
+    assert sum(op["calls"] for op in summary["operations"].values()) == 200
+    assert summary["operations"]["post"]["statuses"] == {"200": summary["operations"]["post"]["calls"]}
+    assert summary["operations"]["graphql"]["p50"] <= summary["operations"]["graphql"]["p99"]
+    # every injected fault was retried by the driver
+    assert summary["server"]["retries"] == summary["server"]["faultsRaised"]
+    assert conn.url_key == {"houses": "House"}
+    conn.close()
+    drop_server("test_run_loadtest")
+
+
+def test_delete_without_nodes():
+    """A delete with nothing to delete posts, and is reported as a post"""
+    conn = CastNetConn("memory://test_delete_without_nodes", None, None, SCHEMA, {})
+    report = run_loadtest(
+        conn, workers=1, duration=None, operations=6, mix={"delete": 1}, labels=["House"]
+    )
+    operations = report.as_dict()["operations"]
+    assert operations["post"]["statuses"] == {"200": 3}
+    assert operations["delete"]["statuses"] == {"200": 3}
+    conn.close()
+    drop_server("test_delete_without_nodes")
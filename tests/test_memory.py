@@ -0,0 +1,221 @@
+"""
+Test the in-memory stand-in driver
+"""
+import pytest
+from neo4j.exceptions import (
+    ClientError,
+    ConstraintError,
+    DatabaseError,
+    ServiceUnavailable,
+    TransientError,
+)
+from neo4j.graph import Node, Relationship
+
+from castnet import CastNetConn
+from castnet.loadtest import FakeRequest
+from castnet.memory import drop_server, get_server, memory_driver
+
+SCHEMA = {
+    "House": {"attributes": {"owner": str}},
+    "Feeder": {"IS_IN": "House", "attributes": {"height": int}},
+    "Bird": {
+        "relationships": {"SEEN_AT": ["Feeder"]},
+        "graphql": {"seenAt": {"rel": "SEEN_AT", "dir": "OUT", "lab": "Feeder"}},
+    },
+}
+URL_KEY = {"houses": "House", "feeders": "Feeder", "birds": "Bird"}
+
+
+@pytest.fixture(name="server")
+def fixture_server(request):
+    name = request.node.name
+    yield get_server(name)
+    drop_server(name)
+
+
+def test_queries(server):
+    """Queries return the driver's types and failed transactions roll back"""
+    driver = memory_driver(f"memory://{server.name}")
+    with driver.session() as session:
+        record = session.run(
+            "CREATE (h:House {id: $id})<-[r:IS_IN {order_num: 0}]-(f:Feeder {id: 'f1'})"
+            " RETURN h, r, f",
+            id="h1",
+        ).single()
+        assert isinstance(record["h"], Node)
+        assert isinstance(record["r"], Relationship)
+        assert record["r"].start_node["id"] == "f1"
+        assert record["r"].end_node is record["h"]
+        rows = session.execute_read(
+            lambda tx: tx.run(
+                "MATCH (h:House)<-[:IS_IN]-(f) RETURN h.id AS house, collect(f.id) AS feeders"
+            ).data()
+        )
+        assert rows == [{"house": "h1", "feeders": ["f1"]}]
+
+        def fail(tx):
+            tx.run("MATCH (h:House) SET h.owner = 'ann'")
+            tx.run("RETURN 1 / 0")
+
+        with pytest.raises(ClientError):
+            session.execute_write(fail)
+        assert session.run("MATCH (h:House) RETURN h.owner AS owner").value() is None
+        with pytest.raises(ClientError):
+            session.execute_read(lambda tx: tx.run("CREATE (:House)"))
+
+
+def test_faults_and_retries(server):
+    """Retryable faults are retried by managed transactions, others raised"""
+    driver = memory_driver(f"memory://{server.name}")
+    server.inject_fault(times=2)
+    with driver.session() as session:
+        session.execute_write(lambda tx: tx.run("CREATE (:House {id: 'h1'})"))
+        assert server.retries == 2
+        server.inject_fault(TransientError("deadlock"), when="commit", match="SET")
+        session.execute_write(lambda tx: tx.run("MATCH (h:House) SET h.n = coalesce(h.n, 0) + 1"))
+        assert (server.faults_raised, server.rollbacks) == (3, 3)
+        assert session.run("MATCH (h:House) RETURN h.n").value() == 1
+        # committed, but the client never hears back
+        server.inject_fault(ServiceUnavailable("gone"), when="after_commit")
+        with pytest.raises(ServiceUnavailable):
+            session.run("CREATE (:House {id: 'h2'})")
+        assert session.run("MATCH (h:House) RETURN count(h)").value() == 2
+
+        session.run("CREATE CONSTRAINT house_id IF NOT EXISTS FOR (n:House) REQUIRE n.id IS UNIQUE")
+        with pytest.raises(ConstraintError):
+            session.run("CREATE (:House {id: 'h1'})")
+        with pytest.raises(DatabaseError):
+            with session.begin_transaction() as tx:
+                tx.run("UNWIND [1] AS i CALL { CREATE (:House) } IN TRANSACTIONS")
+        session.run("UNWIND range(1, 5) AS i CALL { WITH i CREATE (:Feeder {n: i}) } IN TRANSACTIONS OF 2 ROWS")
+        assert session.run("MATCH (f:Feeder) RETURN sum(f.n)").value() == 15
+
+
+def test_generated_constructs(server):
+    """The constructs castnet generates: scoped CALL, comprehensions, projections and more"""
+    driver = memory_driver(f"memory://{server.name}")
+    with driver.session() as session:
+        session.run(
+            "CREATE (h:House {id: 'h1', owner: 'ann'})<-[:IS_IN {order_num: 0}]-(f1:Feeder"
+            " {id: 'f1', height: 1})<-[:IS_IN {order_num: 0}]-(:Scan {id: 's1'}),"
+            " (h)<-[:IS_IN {order_num: 1}]-(:Feeder {id: 'f2', height: 2})"
+        )
+
+        def column(query, **params):
+            return [record[0] for record in session.run(query, **params)]
+
+        # variable length IS_IN, as get_subtree and the GraphQL hops use it
+        def descendants_of(hops):
+            return column(
+                f"MATCH (n)-[:IS_IN{hops}]->(:House {{id: 'h1'}}) RETURN n.id ORDER BY n.id"
+            )
+
+        assert descendants_of("*1..") == ["f1", "f2", "s1"]
+        assert descendants_of("*2") == ["s1"]
+        assert descendants_of("*..1") == descendants_of("") == ["f1", "f2"]
+
+        # map projections and (nested) pattern comprehensions, see the projection compiler
+        house = session.run(
+            "MATCH (a_1:House)\n"
+            "RETURN a_1 {.id, .missing, feeders: [(a_1_1:Feeder)-[r_a_1_1:IS_IN]->(a_1) |"
+            " a_1_1 {.id, __order: r_a_1_1.order_num,"
+            " scans: [(a_1_1_1:Scan)-[r_a_1_1_1:IS_IN*1..]->(a_1_1) | a_1_1_1.id]}],"
+            " tall: [(a_1_1:Feeder {height: $height})-[:IS_IN]->(a_1) | a_1_1.id]} AS house",
+            height=2,
+        ).single()["house"]
+        assert house["id"] == "h1" and house["missing"] is None
+        assert sorted(house["feeders"], key=lambda f: f["__order"]) == [
+            {"id": "f1", "__order": 0, "scans": ["s1"]},
+            {"id": "f2", "__order": 1, "scans": []},
+        ]
+        assert house["tall"] == ["f2"]
+
+        # OPTIONAL MATCH and a WITH ... WHERE filter, as idempotency keys use them
+        guarded = (
+            "OPTIONAL MATCH (used:_Idempotency {key: $key})\n"
+            "WITH used WHERE used IS NULL\n"
+            "CREATE (:_Idempotency {key: $key})\n"
+            "RETURN count(*) AS created"
+        )
+        assert column(guarded, key="k") == [1]
+        assert column(guarded, key="k") == [0]
+        rows = session.run(
+            "MATCH (n) WHERE n.id IN ['s1', 'f2']\n"
+            "OPTIONAL MATCH (n)<-[:IS_IN]-(child)\n"
+            "WITH n, child WHERE child IS NULL OR child.id = 's1'\n"
+            "RETURN n.id AS id, child.id AS child ORDER BY id"
+        ).data()
+        assert rows == [{"id": "f2", "child": None}, {"id": "s1", "child": None}]
+
+        # elementId is a stable, unique string, the change feed's tie breaker
+        ids = column("MATCH (n) RETURN elementId(n) AS id ORDER BY id")
+        assert len(set(ids)) == len(ids) == 5
+        assert all(isinstance(element_id, str) for element_id in ids)
+        after = column(
+            "MATCH (n) WHERE elementId(n) > $after RETURN elementId(n) ORDER BY elementId(n)",
+            after=ids[1],
+        )
+        assert after == ids[2:]
+
+        # CALL () {} and CALL (n) {} IN TRANSACTIONS, as GraphQL fields and purges use them
+        assert session.run(
+            "CALL () {\nMATCH (f:Feeder) RETURN COLLECT(f.id) AS feeders\n}\n"
+            "CALL () {\nMATCH (h:House) RETURN COLLECT(h.id) AS houses\n}\n"
+            "RETURN houses, feeders"
+        ).data() == [{"houses": ["h1"], "feeders": ["f1", "f2"]}]
+        purged = session.run(
+            "MATCH (n:Feeder)\nWITH n LIMIT $round_size\nCALL (n) {\nDETACH DELETE n\n}"
+            " IN TRANSACTIONS OF 1 ROWS\nRETURN count(n) AS purged",
+            round_size=2,
+        ).value()
+        assert purged == 2
+        assert session.run("MATCH (n:Feeder) RETURN count(n)").value() == 0
+        # each batch commits on its own, a failing batch keeps the earlier ones
+        with pytest.raises(ClientError):
+            session.run(
+                "UNWIND [1, 2, 0] AS i\nCALL (i) {\nCREATE (:Batch {n: 1 / i})\n}"
+                " IN TRANSACTIONS OF 1 ROWS"
+            )
+        assert session.run("MATCH (b:Batch) RETURN count(b)").value() == 2
+
+
+def test_castnet_conn(server):
+    """CastNetConn runs against a memory:// uri"""
+    conn = CastNetConn(f"memory://{server.name}", None, None, SCHEMA, URL_KEY, eager=True)
+    house, status = conn.generic_post(FakeRequest("POST", "/houses", {"name": "home"}))
+    assert status == 200
+    house_id = house[0]["id"]
+    feeder_ids = []
+    for i in range(2):
+        feeder, status = conn.generic_post(
+            FakeRequest("POST", "/feeders", {"name": f"f{i}", "IS_IN": house_id, "height": i})
+        )
+        assert status == 200
+        feeder_ids.append(feeder[0]["id"])
+    assert conn.generic_post(
+        FakeRequest("POST", "/feeders", {"name": "f0", "IS_IN": house_id})
+    ) == ("The name f0 already exists.", 400)
+    bird, _ = conn.generic_post(FakeRequest("POST", "/birds", {"name": "jay", "SEEN_AT": feeder_ids}))
+    patched, status = conn.generic_patch(FakeRequest("PATCH", f"/feeders/{feeder_ids[0]}", {"height": 5}))
+    assert (patched["height"], status) == (5, 200)
+
+    result, status = conn.generic_graphql(
+        FakeRequest(
+            "POST",
+            "/graphql",
+            {"query": "query{ Bird(name: $name){ name seenAt{ height } } }", "variables": {"name": "jay"}},
+        )
+    )
+    assert status == 200
+    assert sorted(f["height"] for f in result[1]["data"]["Bird"][0]["seenAt"]) == [1, 5]
+    assert [n["id"] for n in conn.get_subtree(house_id)] == sorted(feeder_ids)
+
+    assert conn.generic_delete(FakeRequest("DELETE", f"/birds/{bird[0]['id']}")) == ("Deleted", 200)
+    assert conn.generic_delete(FakeRequest("DELETE", f"/houses/{house_id}"), cascade=True) == (
+        {"Feeder": 2, "House": 1},
+        200,
+    )
+    methods = [c["method"] for c in conn.changes_since()["changes"]]
+    assert methods == ["POST"] * 4 + ["PATCH"] + ["DELETE"] * 4
+    assert conn.purge_archived("Feeder")["nodes"] == 2
+    conn.close()
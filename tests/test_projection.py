@@ -0,0 +1,88 @@
+"""
+Test the map projection GraphQL compiler
+"""
+import json
+
+import pytest
+
+from castnet import CastNetConn
+from castnet.loadtest import FakeRequest
+from castnet.memory import drop_server
+
+SCHEMA = {
+    "Bird": {},
+    "House": {"attributes": {"owner": str}},
+    "Feeder": {
+        "IS_IN": "House",
+        "attributes": {"height": int},
+        "relationships": {"BIRDS_OBSERVED": ["Bird"]},
+        "graphql": {"birds": {"rel": "BIRDS_OBSERVED", "dir": "OUT", "lab": "Bird"}},
+    },
+    "Scan": {"IS_IN": "Feeder"},
+}
+URL_KEY = {"birds": "Bird", "houses": "House", "feeders": "Feeder", "scans": "Scan"}
+QUERIES = [
+    "{ House { name owner descendantFeeder { height birds { name __order } } } }",
+    "{ House(name: $name) { descendantScan { name isIn { height isIn { owner } } } } }",
+    "{ Feeder(height: 1) { name } Bird { name } }",
+]
+
+
+@pytest.fixture(name="conns")
+def fixture_conns():
+    """A subquery and a projection connection to the same graph"""
+    conns = [
+        CastNetConn("memory://test_projection", None, None, SCHEMA, URL_KEY, graphql_compiler=compiler)
+        for compiler in ["subquery", "projection"]
+    ]
+    conn = conns[0]
+    birds = [
+        conn.generic_post(FakeRequest("POST", "/birds", {"name": f"bird{i}"}))[0][0]["id"]
+        for i in range(3)
+    ]
+    for i in range(3):
+        house = conn.generic_post(FakeRequest("POST", "/houses", {"name": f"house{i}", "owner": "me"}))
+        for j in range(2):
+            feeder = {"name": f"feeder{j}", "IS_IN": house[0][0]["id"], "height": j}
+            feeder["BIRDS_OBSERVED"] = birds[j:] if j else list(reversed(birds))
+            feeder_id = conn.generic_post(FakeRequest("POST", "/feeders", feeder))[0][0]["id"]
+            conn.generic_post(FakeRequest("POST", "/scans", {"name": f"scan{j}", "IS_IN": feeder_id}))
+    yield conns
+    for conn in conns:
+        conn.close()
+    drop_server("test_projection")
+
+
+def canonical(value):
+    """Results with lists in a fixed order, nodes come back in no particular order"""
+    if isinstance(value, list):
+        return sorted((canonical(v) for v in value), key=json.dumps)
+    if isinstance(value, dict):
+        return {k: canonical(v) for k, v in value.items()}
+    return value
+
+
+@pytest.mark.parametrize("query", QUERIES)
+@pytest.mark.parametrize("layout", ["objects", "rows"])
+def test_same_results(conns, query, layout):
+    """Both compilers return the same results"""
+    subquery, projection = conns
+    expected = subquery.read_graphql(query, layout, name="house1")
+    assert canonical(projection.read_graphql(query, layout, name="house1")) == canonical(expected)
+    assert "UNWIND" not in projection.gql_to_cypher(query)
+
+
+def test_projection_cypher(conns):
+    """Relationship fields are pattern comprehensions, nested ones with their own variables"""
+    cypher = conns[1].gql_to_cypher("{ Feeder { birds { name __order } isIn { name } } }")
+    assert cypher == (
+        "CALL (){\n"
+        "MATCH (a_1:Feeder)\n"
+        "RETURN COLLECT(a_1 {"
+        "birds: [(a_1_1:Bird)<-[r_a_1_1:BIRDS_OBSERVED]-(a_1) | a_1_1 {.name, __order: r_a_1_1.order_num}], "
+        "isIn: [(a_1_1:House)<-[r_a_1_1:IS_IN]-(a_1) | a_1_1 {.name}]}) as Feeder\n"
+        "}\n"
+        "RETURN Feeder"
+    )
+    with pytest.raises(ValueError):
+        CastNetConn(None, None, None, SCHEMA, URL_KEY, graphql_compiler="apoc")
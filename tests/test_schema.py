@@ -0,0 +1,111 @@
+"""
+Test compiled schema snapshots
+"""
+import subprocess
+import sys
+from datetime import date
+
+import pytest
+
+from castnet import CastNetConn, compile_schema, load_schema
+from castnet.loadtest import FakeRequest
+from castnet.memory import drop_server
+
+URI = "memory://test_schema"
+SCHEMA = {
+    "House": {"attributes": {"owner": str}},
+    "Feeder": {"IS_IN": "House", "attributes": {"height": int}},
+}
+URL_KEY = {"houses": "House", "feeders": "Feeder"}
+QUERY = "{ House { name owner descendantFeeder { name height } } }"
+
+
+def test_label_spec():
+    """Label specs are compact and read like the parsed dicts"""
+    compiled = compile_schema(SCHEMA)
+    spec = compiled["Feeder"]
+    assert not hasattr(spec, "__dict__")
+    assert spec["relationships"] == {"IS_IN": "House"}
+    assert dict(spec) == CastNetConn._parse_schema(SCHEMA)["Feeder"]
+    assert list(compiled) == ["House", "Feeder"]
+    with pytest.raises(KeyError):
+        spec["unknown"]
+
+
+def test_snapshot(tmp_path):
+    """A loaded snapshot serves from the caches warmed before saving it"""
+    drop_server("test_schema")
+    compiled = compile_schema(SCHEMA)
+    conn = CastNetConn(URI, None, None, compiled, URL_KEY)
+    house = conn.generic_post(FakeRequest("POST", "/houses", {"name": "house", "owner": "me"}))
+    conn.generic_post(
+        FakeRequest("POST", "/feeders", {"name": "f", "IS_IN": house[0][0]["id"], "height": 2})
+    )
+    expected = conn.read_graphql(QUERY)
+    metrics = conn.warm(graphql=[QUERY], writes=[("Feeder", "PATCH", {"height": 3})])
+    assert metrics["graphql"] >= 4 and metrics["writes"] >= 3
+    path = tmp_path / "schema.pickle"
+    compiled.save(path)
+    conn.close()
+
+    loaded = load_schema(path)
+    assert loaded.cache_metrics() == metrics
+    conn = CastNetConn(URI, None, None, loaded, URL_KEY)
+    assert conn.read_graphql(QUERY) == expected
+    assert conn.read_graphql(QUERY, layout="rows", parallel=True)["House"]["rows"]
+    assert loaded.cache_metrics() == metrics
+    conn.close()
+
+    loaded.version = "0.0.0"
+    loaded.save(path)
+    with pytest.raises(ValueError):
+        load_schema(path)
+    drop_server("test_schema")
+
+
+def test_shared_across_temporal_modes():
+    """Connections in string and native mode don't share compiled conditions"""
+    compiled = compile_schema({"House": {"attributes": {"built": date}}})
+    query = '{ House(built: "2020-01-01") { name } }'
+    results = {}
+    for temporal in ["string", "native"]:
+        drop_server(f"test_schema_{temporal}")
+        conn = CastNetConn(
+            f"memory://test_schema_{temporal}", None, None, compiled, URL_KEY, temporal=temporal
+        )
+        conn.generic_post(FakeRequest("POST", "/houses", {"name": "house", "built": "2020-01-01"}))
+        results[temporal] = [
+            conn.read_graphql(query),
+            conn.read_graphql(query, parallel=True),
+            b"".join(conn.stream_graphql(query)),
+        ]
+        conn.close()
+        drop_server(f"test_schema_{temporal}")
+    assert results["native"] == results["string"]
+    assert results["native"][0] == {"House": [{"name": "house"}]}
+
+
+def test_cache_eviction(monkeypatch):
+    """Caches keep their most recently used entries"""
+    monkeypatch.setattr("castnet.schema.CACHE_SIZE", 2)
+    compiled = compile_schema(SCHEMA)
+    builds = []
+
+    def build(key):
+        builds.append(key)
+        return key
+
+    for key in ["a", "b", "a", "c", "a", "b"]:
+        assert compiled.cached("graphql", key, lambda k=key: build(k)) == key
+    # c evicted b, the least recently used, while a stayed
+    assert builds == ["a", "b", "c", "b"]
+    assert list(compiled.caches["graphql"]) == ["a", "b"]
+
+
+def test_lazy_imports():
+    """Importing castnet doesn't import the driver"""
+    code = "import sys, castnet; print('neo4j' in sys.modules, 'pytz' in sys.modules)"
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    assert output.split() == ["False", "False"]
@@ -0,0 +1,131 @@
+"""
+Test GraphQL reads: streaming, columnar layouts and parallel top level fields
+"""
+import asyncio
+import json
+import time
+
+from castnet import CastNetConn
+from castnet.loadtest import FakeRequest
+from castnet.memory import drop_server, get_server
+
+SCHEMA = {"House": {}, "Feeder": {"IS_IN": "House", "attributes": {"height": int}}}
+URL_KEY = {"houses": "House", "feeders": "Feeder"}
+
+
+def test_generic_graphql_stream():
+    """Streams the same document generic_graphql returns, in bounded chunks"""
+    conn = CastNetConn("memory://test_graphql_stream", None, None, SCHEMA, URL_KEY)
+    for i in range(50):
+        house = conn.generic_post(FakeRequest("POST", "/houses", {"name": f"house{i}"}))[0][0]
+        feeder = {"name": "feeder", "IS_IN": house["id"], "height": i}
+        conn.generic_post(FakeRequest("POST", "/feeders", feeder))
+    query = "{ House { name descendantFeeder { height } } Feeder(height: $height) { height } }"
+    request = FakeRequest("POST", "/graphql", {"query": query, "variables": {"height": 3}})
+
+    chunks, status = conn.generic_graphql_stream(request, chunk_size=256)
+    assert status == 200
+    chunks = list(chunks)
+    assert len(chunks) > 10
+    assert max(len(chunk) for chunk in chunks) < 256 + 100
+    streamed = json.loads(b"".join(chunks))
+    expected = json.loads(json.dumps(conn.generic_graphql(request)[0]))
+    assert streamed[1]["data"]["Feeder"] == [{"height": 3}]
+
+    def key(house):
+        return house["name"]
+
+    assert sorted(streamed[1]["data"]["House"], key=key) == sorted(
+        expected[1]["data"]["House"], key=key
+    )
+
+    assert json.loads(b"".join(conn.stream_graphql("{ Feeder(height: 99) { name } }"))) == {
+        "Feeder": []
+    }
+    assert conn.generic_graphql_stream(FakeRequest("POST", "/graphql", {"query": "{ Nope { name } }"}))[1] == 400
+    conn.close()
+    drop_server("test_graphql_stream")
+
+
+def test_variables_named_like_options():
+    """Variables named like an option are variables, not options"""
+    conn = CastNetConn("memory://test_variables_named_like_options", None, None, SCHEMA, URL_KEY)
+    house = conn.generic_post(FakeRequest("POST", "/houses", {"name": "house"}))[0][0]
+    conn.generic_post(FakeRequest("POST", "/feeders", {"name": "f", "IS_IN": house["id"], "height": 2}))
+    query = "{ House(name: $layout) { name } Feeder(height: $max_rows, name: $database) { height } }"
+    variables = {"layout": "house", "max_rows": 2, "database": "f"}
+    expected = {"House": [{"name": "house"}], "Feeder": [{"height": 2}]}
+    request = FakeRequest("POST", "/graphql", {"query": query, "variables": variables})
+    assert conn.generic_graphql(request) == ([True, {"data": expected}], 200)
+    assert json.loads(b"".join(conn.generic_graphql_stream(request)[0]))[1]["data"] == expected
+    assert conn.read_graphql(query, parallel=True, variables=variables) == expected
+    assert conn.read("RETURN $database AS db", params={"database": "x"})[0]["db"] == "x"
+    conn.close()
+    drop_server("test_variables_named_like_options")
+
+
+def test_graphql_layouts():
+    """Rows and columns carry the field names once per list, nested lists too"""
+    conn = CastNetConn("memory://test_graphql_layouts", None, None, SCHEMA, URL_KEY)
+    for i in range(2):
+        house = conn.generic_post(FakeRequest("POST", "/houses", {"name": f"house{i}"}))[0][0]
+        feeder = {"name": f"feeder{i}", "IS_IN": house["id"], "height": i}
+        conn.generic_post(FakeRequest("POST", "/feeders", feeder))
+    query = "{ House(name: $name) { name descendantFeeder { name height } } }"
+
+    assert "COLLECT({" not in conn.gql_to_cypher(query, rows=True)
+    assert conn.read_graphql(query, "rows", name="house1") == {
+        "House": {
+            "fields": ["name", "descendantFeeder"],
+            "rows": [["house1", {"fields": ["name", "height"], "rows": [["feeder1", 1]]}]],
+        }
+    }
+    houses = conn.read_graphql("{ House { name descendantFeeder { height } } }", "columns")["House"]
+    assert houses["fields"] == ["name", "descendantFeeder"]
+    assert sorted(houses["columns"][0]) == ["house0", "house1"]
+    assert houses["columns"][1][0] == {"fields": ["height"], "columns": [[int(houses["columns"][0][0][-1])]]}
+    assert conn.read_graphql("{ Feeder(height: 7) { name } }", "columns") == {
+        "Feeder": {"fields": ["name"], "columns": [[]]}
+    }
+
+    request = FakeRequest("POST", "/graphql", {"query": query, "variables": {"name": "house0"}, "layout": "rows"})
+    chunks, status = conn.generic_graphql_stream(request)
+    assert json.loads(b"".join(chunks)) == json.loads(json.dumps(conn.generic_graphql(request)[0]))
+    request.json["layout"] = "columns"
+    assert conn.generic_graphql_stream(request)[1] == 400
+    assert conn.generic_graphql(request)[1] == 200
+    conn.close()
+    drop_server("test_graphql_layouts")
+
+
+def test_parallel_graphql():
+    """Top level fields run at the same time, merged in query order"""
+    conn = CastNetConn(
+        "memory://test_parallel_graphql", None, None, SCHEMA, URL_KEY, graphql_workers=3
+    )
+    house = conn.generic_post(FakeRequest("POST", "/houses", {"name": "house"}))[0][0]
+    conn.generic_post(FakeRequest("POST", "/feeders", {"name": "f", "IS_IN": house["id"], "height": 2}))
+    query = "{ House(name: $name) { id } Feeder { height } }"
+    expected = conn.read_graphql(query, parallel=False, name="house")
+
+    server = get_server("test_parallel_graphql")
+    server.latency = 0.1
+    queries = server.queries
+    start = time.perf_counter()
+    result = conn.read_graphql(query, name="house")
+    assert time.perf_counter() - start < 0.18
+    assert server.queries - queries == 2
+    assert result == expected == {"House": [{"id": house["id"]}], "Feeder": [{"height": 2}]}
+    assert list(result) == ["House", "Feeder"]
+
+    # a failed field is retried without closing the driver its sibling is using
+    driver = conn.driver
+    server.inject_fault(RuntimeError("Injected fault"), match="Feeder")
+    assert conn.read_graphql(query, name="house") == expected
+    assert server.faults_raised == 1
+    assert conn.driver is driver and not driver.closed
+    assert asyncio.run(conn.read_graphql_async("{ Feeder { height } }", "columns")) == {
+        "Feeder": {"fields": ["height"], "columns": [[2]]}
+    }
+    conn.close()
+    drop_server("test_parallel_graphql")
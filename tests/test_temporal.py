@@ -0,0 +1,101 @@
+"""
+Test native temporal storage
+"""
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+from castnet import CastNetConn
+from castnet.casting import to_temporal
+from castnet.encoding import to_python
+from castnet.exporter import iter_label
+from castnet.loadtest import FakeRequest
+from castnet.memory import drop_server
+
+SCHEMA = {
+    "House": {"attributes": {"built": date, "seen": datetime}},
+    "Feeder": {"IS_IN": "House", "attributes": {"installed": datetime}},
+}
+URL_KEY = {"houses": "House", "feeders": "Feeder"}
+
+
+def test_to_temporal():
+    """ISO strings become dates and zoned datetimes, and back"""
+    assert to_temporal("2021-01-02", date) == date(2021, 1, 2)
+    assert to_temporal(datetime(2021, 1, 2, 10), date) == date(2021, 1, 2)
+    assert to_temporal("2021-01-02T10:00:00", datetime) == datetime(
+        2021, 1, 2, 10, tzinfo=timezone.utc
+    )
+    zoned = to_temporal("2021-01-02T10:00:00+05:00", datetime)
+    assert zoned.utcoffset() == timedelta(hours=5)
+    with pytest.raises(ValueError):
+        to_temporal("2021-13-01", date)
+    assert to_python({"a": [zoned, date(2021, 1, 2)], "b": 1}) == {
+        "a": ["2021-01-02T10:00:00+05:00", "2021-01-02"],
+        "b": 1,
+    }
+
+
+def test_native_temporal():
+    """Native values are written, compared in the database and read as ISO strings"""
+    conn = CastNetConn("memory://test_native_temporal", None, None, SCHEMA, URL_KEY)
+    conn.generic_post(
+        FakeRequest("POST", "/houses", {"name": "old", "built": "1990-05-01", "seen": "2021-01-01T10:00:00"})
+    )
+    native = CastNetConn(
+        "memory://test_native_temporal", None, None, SCHEMA, URL_KEY, temporal="native"
+    )
+    data, status = native.generic_post(
+        FakeRequest("POST", "/houses", {"name": "new", "built": "2020-05-01", "seen": "2021-01-01T10:00:00+05:00"})
+    )
+    assert status == 200
+    assert data[0]["seen"] == "2021-01-01T10:00:00+05:00"
+
+    # the old string values are converted in batches, only once
+    assert native.migrate_temporal(batch_size=1) == {
+        "House": {"built": 1, "seen": 1},
+        "Feeder": {"installed": 0},
+    }
+    assert native.migrate_temporal()["House"] == {"built": 0, "seen": 0}
+    records = native.read(
+        "MATCH (h:House) WHERE h.seen < datetime('2021-01-01T09:00:00Z') RETURN h.name AS name"
+    )
+    assert [r["name"] for r in records] == ["new"]
+    houses = native.read_graphql("{ House { name built seen } }")["House"]
+    assert sorted(houses, key=lambda h: h["name"]) == [
+        {"name": "new", "built": "2020-05-01", "seen": "2021-01-01T10:00:00+05:00"},
+        {"name": "old", "built": "1990-05-01", "seen": "2021-01-01T10:00:00+00:00"},
+    ]
+    assert {row["built"] for row in iter_label(native, "House")} == {"1990-05-01", "2020-05-01"}
+    assert (
+        "CREATE RANGE INDEX castnet_House_seen IF NOT EXISTS FOR (n:House) ON (n.seen)"
+        in native.index_cypher()
+    )
+    assert not any("seen" in statement for statement in conn.index_cypher())
+    with pytest.raises(ValueError):
+        CastNetConn(None, None, None, SCHEMA, URL_KEY, temporal="local")
+    conn.close()
+    native.close()
+    drop_server("test_native_temporal")
+
+
+@pytest.mark.parametrize("compiler", ["subquery", "projection"])
+def test_native_graphql_conditions(compiler):
+    """GraphQL conditions on temporal attributes match native values"""
+    name = f"test_native_conditions_{compiler}"
+    conn = CastNetConn(
+        f"memory://{name}", None, None, SCHEMA, URL_KEY, temporal="native", graphql_compiler=compiler
+    )
+    house = {"name": "h", "built": "2020-01-02", "seen": "2021-01-01T10:00:00"}
+    house_id = conn.generic_post(FakeRequest("POST", "/houses", house))[0][0]["id"]
+    feeder = {"name": "f", "IS_IN": house_id, "installed": "2021-03-04T05:06:07"}
+    conn.generic_post(FakeRequest("POST", "/feeders", feeder))
+    assert conn.read_graphql('{ House(built: "2020-01-02") { name } }') == {"House": [{"name": "h"}]}
+    assert conn.read_graphql('{ House(built: "2020-01-03") { name } }') == {"House": []}
+    query = "query { House(name: $n, seen: $s) { name descendantFeeder(installed: $i) { name } } }"
+    data = conn.read_graphql(
+        query, n="h", s="2021-01-01T10:00:00", i="2021-03-04T05:06:07Z"
+    )
+    assert data == {"House": [{"name": "h", "descendantFeeder": [{"name": "f"}]}]}
+    conn.close()
+    drop_server(name)
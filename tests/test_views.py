@@ -0,0 +1,111 @@
+"""
+Test materialized views
+"""
+import pytest
+
+from castnet import CastNetConn
+from castnet.loadtest import FakeRequest
+from castnet.memory import drop_server, get_server
+from castnet.views import LocalViewStore
+
+SCHEMA = {
+    "House": {},
+    "Feeder": {"IS_IN": "House", "attributes": {"height": int}},
+    "Scan": {"IS_IN": "Feeder"},
+}
+URL_KEY = {"houses": "House", "feeders": "Feeder", "scans": "Scan"}
+
+
+class FailingStore(LocalViewStore):
+    """A store whose writes fail once"""
+
+    def __init__(self):
+        super().__init__()
+        self.fail = False
+
+    def put(self, view, rows):
+        if self.fail:
+            self.fail = False
+            raise RuntimeError("store unavailable")
+        super().put(view, rows)
+
+
+@pytest.mark.parametrize("store", ["local", "node"])
+def test_views(store):
+    """Writes refresh the roots they affect, through the IS_IN hierarchy"""
+    name = f"test_views_{store}"
+    conn = CastNetConn(f"memory://{name}", None, None, SCHEMA, URL_KEY)
+    view = conn.register_view(
+        "tree", "House", "{ name descendantFeeder { height descendantScan { name } } }", store
+    )
+    assert view.query == (
+        "query { House(id: $id) { id name descendantFeeder { height descendantScan { name } } } }"
+    )
+    house_id = conn.generic_post(FakeRequest("POST", "/houses", {"name": "home"}))[0][0]["id"]
+    feeder = {"name": "f", "IS_IN": house_id, "height": 1}
+    feeder_id = conn.generic_post(FakeRequest("POST", "/feeders", feeder))[0][0]["id"]
+    scan_id = conn.generic_post(FakeRequest("POST", "/scans", {"name": "s", "IS_IN": feeder_id}))[0][0]["id"]
+    conn.generic_patch(FakeRequest("PATCH", f"/feeders/{feeder_id}", {"height": 7}))
+    queries = get_server(name).queries
+    assert conn.read_view("tree", house_id) == {
+        "id": house_id,
+        "name": "home",
+        "descendantFeeder": [{"height": 7, "descendantScan": [{"name": "s"}]}],
+    }
+    # a single lookup, or none at all in process
+    assert get_server(name).queries - queries == (1 if store == "node" else 0)
+
+    conn.generic_delete(FakeRequest("DELETE", f"/scans/{scan_id}"))
+    assert conn.read_view("tree", house_id)["descendantFeeder"][0]["descendantScan"] == []
+    assert conn.refresh_view("tree") == 1
+    conn.generic_delete(FakeRequest("DELETE", f"/houses/{house_id}"), cascade=True)
+    assert conn.read_view("tree", house_id) is None
+    assert conn.view_metrics()["tree"]["misses"] == 1
+    with pytest.raises(ValueError):
+        conn.register_view("broken", "House", "{ nothing }")
+    conn.close()
+    drop_server(name)
+
+
+def test_archived_roots_are_forgotten():
+    """Archiving or purging a subtree drops the view roots inside it"""
+    name = "test_archived_roots"
+    conn = CastNetConn(f"memory://{name}", None, None, SCHEMA, URL_KEY)
+    conn.register_view("feeder", "Feeder", "{ height descendantScan { name } }")
+    house_id = conn.generic_post(FakeRequest("POST", "/houses", {"name": "home"}))[0][0]["id"]
+    feeder = {"name": "f", "IS_IN": house_id, "height": 1}
+    feeder_id = conn.generic_post(FakeRequest("POST", "/feeders", feeder))[0][0]["id"]
+    assert conn.read_view("feeder", feeder_id)["height"] == 1
+    conn.generic_delete(FakeRequest("DELETE", f"/houses/{house_id}"), cascade=True)
+    assert conn.read_view("feeder", feeder_id) is None
+
+    # archived by hand, the view only learns of it when it is purged
+    house_id = conn.generic_post(FakeRequest("POST", "/houses", {"name": "home2"}))[0][0]["id"]
+    feeder_id = conn.generic_post(
+        FakeRequest("POST", "/feeders", dict(feeder, IS_IN=house_id))
+    )[0][0]["id"]
+    assert conn.read_view("feeder", feeder_id)["height"] == 1
+    conn.write(
+        "MATCH (f:Feeder {id: $id}) REMOVE f:Feeder SET f:_archived_Feeder", id=feeder_id
+    )
+    assert conn.read_view("feeder", feeder_id)["height"] == 1
+    assert conn.purge_archived("Feeder")["nodes"] == 2
+    assert conn.read_view("feeder", feeder_id) is None
+    conn.close()
+    drop_server(name)
+
+
+def test_failed_refresh_invalidates():
+    """A failed refresh drops the roots, the next read recomputes them"""
+    conn = CastNetConn("memory://test_failed_refresh", None, None, SCHEMA, URL_KEY)
+    store = FailingStore()
+    conn.register_view("tree", "House", "{ descendantFeeder { height } }", store)
+    house_id = conn.generic_post(FakeRequest("POST", "/houses", {"name": "home"}))[0][0]["id"]
+    store.fail = True
+    feeder = {"name": "f", "IS_IN": house_id, "height": 1}
+    assert conn.generic_post(FakeRequest("POST", "/feeders", feeder))[1] == 200
+    assert store.get("tree", house_id) is None
+    assert conn.read_view("tree", house_id)["descendantFeeder"] == [{"height": 1}]
+    assert conn.view_metrics()["tree"]["failures"] == 1
+    conn.close()
+    drop_server("test_failed_refresh")